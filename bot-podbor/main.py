@@ -120,12 +120,11 @@ def connect_db():
 
 pool = connect_db()
 
-# Создание таблиц при необходимости
-def init_db(pool):
-    try:
-        conn = pool.get_connection()
-        cursor = conn.cursor(buffered=True)
-        cursor.execute('''
+# Версионированные миграции схемы: (версия, описание, список SQL-выражений).
+# Новые изменения добавляются только в конец списка с очередной версией.
+SCHEMA_MIGRATIONS = [
+    (1, "Базовые таблицы", [
+        '''
             CREATE TABLE IF NOT EXISTS users (
                 user_id BIGINT PRIMARY KEY,
                 username VARCHAR(255),
@@ -136,8 +135,8 @@ def init_db(pool):
                 city VARCHAR(255),
                 join_date DATE
             )
-        ''')
-        cursor.execute('''
+        ''',
+        '''
             CREATE TABLE IF NOT EXISTS statistics (
                 stat_id INT AUTO_INCREMENT PRIMARY KEY,
                 date DATE,
@@ -146,8 +145,8 @@ def init_db(pool):
                 messages_sent INT,
                 links_sent INT
             )
-        ''')
-        cursor.execute('''
+        ''',
+        '''
             CREATE TABLE IF NOT EXISTS user_requests (
                 request_id INT AUTO_INCREMENT PRIMARY KEY,
                 user_id BIGINT,
@@ -155,14 +154,14 @@ def init_db(pool):
                 timestamp DATETIME,
                 FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
             )
-        ''')
-        cursor.execute('''
+        ''',
+        '''
             CREATE TABLE IF NOT EXISTS prizes (
                 prize_id INT AUTO_INCREMENT PRIMARY KEY,
                 prize_name VARCHAR(255)
             )
-        ''')
-        cursor.execute('''
+        ''',
+        '''
             CREATE TABLE IF NOT EXISTS user_prizes (
                 user_id BIGINT PRIMARY KEY,
                 prize_id INT,
@@ -171,8 +170,70 @@ def init_db(pool):
                 FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
                 FOREIGN KEY (prize_id) REFERENCES prizes(prize_id) ON DELETE CASCADE
             )
-        ''')
-        conn.commit()
+        ''',
+    ]),
+    (2, "Индексы для частых запросов", [
+        # Новые пользователи за день и выгрузка по дате: WHERE join_date = / >= %s
+        'CREATE INDEX idx_users_join_date ON users (join_date)',
+        # Последний запрос пользователя: WHERE user_id = %s ORDER BY timestamp DESC LIMIT 1
+        'CREATE INDEX idx_user_requests_user_time ON user_requests (user_id, timestamp)',
+        # Статистика за день: WHERE date = %s
+        'CREATE INDEX idx_statistics_date ON statistics (date)',
+        # Поиск приза по названию: WHERE prize_name = %s
+        'CREATE INDEX idx_prizes_name ON prizes (prize_name)',
+    ]),
+]
+
+# Коды ошибок MySQL, означающие, что изменение уже применено (дубликат столбца/индекса)
+MIGRATION_ALREADY_APPLIED = (errorcode.ER_DUP_FIELDNAME, errorcode.ER_DUP_KEYNAME)
+
+# Получение текущей версии схемы (None, если таблицы миграций еще нет)
+def get_schema_version(cursor):
+    try:
+        cursor.execute('SELECT MAX(version) FROM schema_migrations')
+    except mysql.connector.Error as err:
+        if err.errno == errorcode.ER_NO_SUCH_TABLE:
+            return None
+        raise
+    return cursor.fetchone()[0] or 0
+
+# Применение недостающих миграций. Если схема актуальна, выполняется один SELECT без DDL.
+def init_db(pool):
+    latest_version = SCHEMA_MIGRATIONS[-1][0]
+    try:
+        conn = pool.get_connection()
+        cursor = conn.cursor(buffered=True)
+        current_version = get_schema_version(cursor)
+        if current_version == latest_version:
+            logger.info(f"Схема базы данных актуальна (версия {current_version}).")
+            cursor.close()
+            conn.close()
+            return
+        if current_version is None:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INT PRIMARY KEY,
+                    description VARCHAR(255),
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            current_version = 0
+        for version, description, statements in SCHEMA_MIGRATIONS:
+            if version <= current_version:
+                continue
+            for statement in statements:
+                try:
+                    cursor.execute(statement)
+                except mysql.connector.Error as err:
+                    if err.errno not in MIGRATION_ALREADY_APPLIED:
+                        raise
+                    logger.info(f"Миграция {version}: изменение уже применено ({err.msg}).")
+            cursor.execute(
+                'INSERT INTO schema_migrations (version, description) VALUES (%s, %s)',
+                (version, description)
+            )
+            conn.commit()
+            logger.info(f"Применена миграция {version}: {description}.")
         cursor.close()
         conn.close()
         logger.info("База данных и таблицы инициализированы.")
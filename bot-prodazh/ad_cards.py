@@ -0,0 +1,123 @@
+# ad_cards.py
+
+import logging
+from collections import OrderedDict
+
+from aiogram import types
+from aiogram.types import InputMediaPhoto
+
+from config import AD_CARD_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Подписи первых фото в наборах, которые открываются кнопками карточки
+MEDIA_TITLES = {
+    'photo': "Все фото объявления",
+    'inspection': "Акт осмотра",
+    'thickness': "Фото толщиномера",
+}
+
+PREV_BUTTON = types.InlineKeyboardButton("« Предыдущее", callback_data="prev_ad")
+NEXT_BUTTON = types.InlineKeyboardButton("Следующее »", callback_data="next_ad")
+
+
+# Подпись карточки объявления (и inline-результата)
+def ad_caption(ad):
+    return f"{ad['title']}\nМодель: {ad['model']}\nГод выпуска: {ad['year']}\nЦена: {ad['price']} KZT"
+
+
+# Готовая к отправке карточка объявления: подпись, общие для всех строки клавиатуры, обложка
+# для edit_media и собранные по требованию наборы фото. У пользователя отличаются только кнопка
+# избранного и строка навигации, их добавляет keyboard(). Объекты карточки общие, изменять их нельзя.
+class AdCard:
+    __slots__ = ('ad', 'generation', 'caption', 'top_rows', 'add_fav_row', 'remove_fav_row', 'photos_row',
+                 'cover_media', 'media')
+
+    def __init__(self, ad, generation):
+        ad_id = ad['ad_id']
+        self.ad = ad
+        self.generation = generation
+        self.caption = ad_caption(ad)
+        self.top_rows = [
+            [
+                types.InlineKeyboardButton("Купить", callback_data=f"buy_{ad_id}"),
+                types.InlineKeyboardButton("Запросить скидку", callback_data=f"discount_{ad_id}"),
+            ],
+            [
+                types.InlineKeyboardButton("Полное описание", callback_data=f"description_{ad_id}"),
+                types.InlineKeyboardButton("Акт осмотра", callback_data=f"inspection_{ad_id}"),
+                types.InlineKeyboardButton("Толщиномер", callback_data=f"thickness_{ad_id}"),
+            ],
+        ]
+        self.add_fav_row = [types.InlineKeyboardButton("Добавить в избранное 🤍", callback_data=f"add_fav_{ad_id}")]
+        self.remove_fav_row = [types.InlineKeyboardButton("Убрать из избранного ❤️", callback_data=f"remove_fav_{ad_id}")]
+        self.photos_row = [types.InlineKeyboardButton("Показать все фото", callback_data=f"show_photos_{ad_id}")]
+        self.cover_media = InputMediaPhoto(media=ad['cover_photo'], caption=self.caption) if ad['cover_photo'] else None
+        self.media = {}
+
+    def keyboard(self, is_fav, has_prev=False, has_next=False):
+        rows = self.top_rows + [self.remove_fav_row if is_fav else self.add_fav_row, self.photos_row]
+        navigation = [button for button, shown in ((PREV_BUTTON, has_prev), (NEXT_BUTTON, has_next)) if shown]
+        if navigation:
+            rows.append(navigation)
+        return types.InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+# Кэш карточек по ad_id (LRU, не больше max_size). Версия карточки - запись объявления, по которой
+# она собрана: если в кэше каталога запись другая, карточка собирается заново. Пока кэш каталога
+# не перезагружался (generation не изменилась), карточка отдается без обращения к каталогу;
+# удаленное объявление убирается через discard.
+class AdCardCache:
+    def __init__(self, db, max_size: int = AD_CARD_CACHE_SIZE):
+        self.db = db
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._cards = OrderedDict()
+
+    # Карточка для уже полученной записи объявления
+    def card(self, ad):
+        card = self._cards.get(ad['ad_id'])
+        if card is not None and (card.ad is ad or card.ad == ad):
+            self.hits += 1
+            card.generation = self.db.ads_cache.generation
+            self._cards.move_to_end(ad['ad_id'])
+            return card
+        self.misses += 1
+        card = AdCard(ad, self.db.ads_cache.generation)
+        self._cards[ad['ad_id']] = card
+        self._cards.move_to_end(ad['ad_id'])
+        while len(self._cards) > self.max_size:
+            self._cards.popitem(last=False)
+        return card
+
+    # Карточка по ad_id или None, если объявления нет
+    async def get(self, ad_id):
+        card = self._cards.get(ad_id)
+        if card is not None and card.generation == self.db.ads_cache.generation and self.db.ads_cache.is_fresh:
+            self.hits += 1
+            self._cards.move_to_end(ad_id)
+            return card
+        ad = await self.db.get_ad(ad_id)
+        if ad is None:
+            self.discard(ad_id)
+            return None
+        return self.card(ad)
+
+    # Набор фото вида kind ('photo', 'inspection', 'thickness') для send_media_group, пустой список - фото нет
+    async def media_group(self, card, kind):
+        media = card.media.get(kind)
+        if media is None:
+            photos = await self.db.get_ad_photos(card.ad['ad_id'], kind)
+            media = [
+                InputMediaPhoto(media=file_id, caption=f"{MEDIA_TITLES[kind]}: {card.ad['title']}" if index == 0 else None)
+                for index, file_id in enumerate(photos)
+            ]
+            card.media[kind] = media
+        return media
+
+    def discard(self, ad_id):
+        self._cards.pop(ad_id, None)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._cards)}
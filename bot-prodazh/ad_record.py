@@ -0,0 +1,142 @@
+# ad_record.py
+
+import time
+from datetime import datetime
+
+
+# Компактная запись объявления вместо словаря DictCursor.
+# Поля хранятся в слотах, без __dict__ на каждый объект; ad['title'] продолжает работать,
+# поэтому обработчики и индекс подписок используют запись так же, как прежний словарь.
+# Наборы фотографий (см. ad_photos) в записи не хранятся: get_ad_photos загружает их при первом
+# обращении и запоминает здесь, пока объявление остается в кэше каталога.
+class Ad:
+    FIELDS = ('ad_id', 'title', 'model', 'year', 'price', 'description', 'added_date', 'cover_photo')
+    __slots__ = FIELDS + ('_photos',)
+
+    def __init__(self, ad_id, title, model, year, price, description, added_date, cover_photo=None):
+        self.ad_id = ad_id
+        self.title = title
+        self.model = model
+        self.year = year
+        self.price = price
+        self.description = description
+        self.added_date = added_date
+        self.cover_photo = cover_photo
+        self._photos = None
+
+    # Строка выборки в порядке FIELDS (обычный курсор) или словарь (DictCursor)
+    @classmethod
+    def from_row(cls, row):
+        if isinstance(row, dict):
+            return cls(**{field: row.get(field) for field in cls.FIELDS})
+        return cls(*row)
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.FIELDS else default
+
+    # Записи сравниваются по полям (так AdCardCache замечает измененное объявление), хэш - по тем же
+    # полям. Поля после создания записи не меняются, меняется только _photos, который в сравнении не участвует
+    def __eq__(self, other):
+        if not isinstance(other, Ad):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field) for field in self.FIELDS)
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, field) for field in self.FIELDS))
+
+    def __repr__(self):
+        return f"Ad(ad_id={self.ad_id!r}, title={self.title!r})"
+
+    # Запомненный набор фотографий вида kind или None, если он еще не загружался
+    def get_photos(self, kind):
+        return self._photos.get(kind) if self._photos else None
+
+    def set_photos(self, kind, file_ids):
+        if self._photos is None:
+            self._photos = {}
+        self._photos[kind] = list(file_ids)
+
+    # Сериализация для кэшей и хранилищ: JSON-совместимый словарь и обратно.
+    # Запомненные наборы фотографий не сериализуются, они загружаются заново.
+    def as_dict(self):
+        data = {field: getattr(self, field) for field in self.FIELDS}
+        if isinstance(self.added_date, datetime):
+            data['added_date'] = self.added_date.isoformat()
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        ad = cls.from_row(data)
+        if isinstance(ad.added_date, str):
+            ad.added_date = datetime.fromisoformat(ad.added_date)
+        return ad
+
+    def __getstate__(self):
+        return tuple(getattr(self, field) for field in self.FIELDS)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+
+# Бенчмарк: python ad_record.py [количество объявлений]
+if __name__ == '__main__':
+    import gc
+    import json
+    import pickle
+    import sys
+    import tracemalloc
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    rows = [
+        (
+            ad_id, f"Toyota Camry {ad_id}", "Toyota Camry", 2015 + ad_id % 10, 10_000_000 + ad_id,
+            "Один владелец, обслуживание у дилера, два комплекта резины.",
+            datetime(2024, 1, 1, ad_id % 24, ad_id % 60), f"AgACAgIAAxkBAAI{ad_id:012d}",
+        )
+        for ad_id in range(1, count + 1)
+    ]
+    photo_json = json.dumps([f"AgACAgIAAxkBAAI{index:012d}" for index in range(10)])
+
+    # Прежний вариант: словарь DictCursor со всеми колонками и декодированием трех JSON-колонок
+    def build_dicts():
+        ads = []
+        for row in rows:
+            ad = dict(zip(Ad.FIELDS[:-1], row[:-1]))
+            ad['photos'] = json.loads(photo_json)
+            ad['inspection_photos'] = json.loads(photo_json)
+            ad['thickness_photos'] = json.loads(photo_json)
+            ads.append(ad)
+        return ads
+
+    # Тот же словарь, но с колонками как после ad_photos (только обложка)
+    def build_plain_dicts():
+        return [dict(zip(Ad.FIELDS, row)) for row in rows]
+
+    def build_records():
+        return [Ad.from_row(row) for row in rows]
+
+    def measure(build):
+        gc.collect()
+        tracemalloc.start()
+        started = time.perf_counter()
+        result = build()
+        elapsed = time.perf_counter() - started
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return result, size, elapsed
+
+    print(f"Объявлений: {count}")
+    for name, build in (("dict + JSON", build_dicts), ("dict", build_plain_dicts), ("Ad", build_records)):
+        result, size, elapsed = measure(build)
+        print(f"{name:12} память {size / 1024 / 1024:7.2f} МБ, построение {elapsed * 1000:7.1f} мс")
+        del result
+
+    records = build_records()
+    assert pickle.loads(pickle.dumps(records[0])) == records[0]
+    assert len({records[0], pickle.loads(pickle.dumps(records[0])), records[1]}) == 2
+    assert Ad.from_dict(json.loads(json.dumps(records[0].as_dict()))) == records[0]
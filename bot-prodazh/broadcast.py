@@ -0,0 +1,198 @@
+# broadcast.py
+
+import asyncio
+import logging
+import time
+
+from aiogram.utils.exceptions import (
+    BotBlocked, ChatNotFound, MessageNotModified, RetryAfter, TelegramAPIError, UserDeactivated,
+)
+
+from config import BROADCAST_RATE, BROADCAST_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+# Ошибки, после которых повторять отправку этому получателю бессмысленно
+PERMANENT_ERRORS = (BotBlocked, ChatNotFound, UserDeactivated)
+
+
+# Глобальный лимит отправки: rate токенов в секунду, не больше capacity подряд.
+# pause() задерживает всех отправителей, когда Telegram отвечает RetryAfter.
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+class BroadcastResult:
+    def __init__(self, total=None):
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        self.started_at = time.monotonic()
+
+    @property
+    def processed(self):
+        return self.sent + self.failed
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started_at
+
+    def progress_text(self, finished=False):
+        total = self.total if self.total is not None else '?'
+        header = "Рассылка завершена." if finished else "Идет рассылка..."
+        return (
+            f"{header}\nОбработано: {self.processed}/{total}\n"
+            f"Успешно отправлено: {self.sent}\nОшибок: {self.failed}\nПрошло: {int(self.elapsed)} с"
+        )
+
+
+# Рассылка с ограниченным числом одновременных отправок и общим лимитом скорости.
+# recipients - итерируемый (или асинхронно итерируемый) набор пар (chat_id, text).
+# on_result(chat_id, delivered, error) вызывается после окончательной судьбы каждого получателя.
+# Если передан status_message, прогресс показывается редактированием этого сообщения.
+class Broadcaster:
+    def __init__(self, bot, rate: float = BROADCAST_RATE, concurrency: int = BROADCAST_CONCURRENCY,
+                 max_retries: int = 3, progress_interval: float = 5.0):
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.progress_interval = progress_interval
+
+    async def run(self, recipients, total=None, status_message=None, on_result=None, **send_kwargs):
+        result = BroadcastResult(total)
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [
+            asyncio.create_task(self._worker(queue, result, on_result, send_kwargs))
+            for _ in range(self.concurrency)
+        ]
+        progress = asyncio.create_task(self._report_progress(status_message, result)) if status_message else None
+        try:
+            if hasattr(recipients, '__aiter__'):
+                async for item in recipients:
+                    await queue.put(item)
+            else:
+                for item in recipients:
+                    await queue.put(item)
+            await queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            if progress:
+                progress.cancel()
+        if status_message:
+            await self._edit_status(status_message, result.progress_text(finished=True))
+        logger.info(f"Рассылка завершена: отправлено {result.sent}, ошибок {result.failed} за {result.elapsed:.1f} с.")
+        return result
+
+    async def _worker(self, queue, result, on_result, send_kwargs):
+        while True:
+            chat_id, text = await queue.get()
+            try:
+                error = await self._send(chat_id, text, send_kwargs)
+                if error is None:
+                    result.sent += 1
+                else:
+                    result.failed += 1
+                    logger.error(f"Ошибка отправки сообщения пользователю {chat_id}: {error}")
+                if on_result:
+                    try:
+                        await on_result(chat_id, error is None, error)
+                    except Exception as e:
+                        logger.error(f"Ошибка при сохранении результата рассылки для {chat_id}: {e}")
+            finally:
+                queue.task_done()
+
+    # Возвращает None при успехе или исключение, из-за которого отправка не удалась
+    async def _send(self, chat_id, text, send_kwargs):
+        attempt = 0
+        while True:
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id, text, **send_kwargs)
+                return None
+            except RetryAfter as e:
+                # Flood control касается всего бота, поэтому приостанавливаем всех отправителей
+                logger.warning(f"Превышен лимит Telegram, пауза {e.timeout} с.")
+                self.bucket.pause(e.timeout)
+            except PERMANENT_ERRORS as e:
+                return e
+            except (TelegramAPIError, asyncio.TimeoutError, OSError) as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    return e
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                return e
+
+    async def _report_progress(self, status_message, result):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            await self._edit_status(status_message, result.progress_text())
+
+    async def _edit_status(self, status_message, text):
+        try:
+            await status_message.edit_text(text)
+        except MessageNotModified:
+            pass
+        except Exception as e:
+            logger.error(f"Не удалось обновить статус рассылки: {e}")
+
+
+# Выполнение сохраненного в базе задания рассылки (см. broadcast_jobs/broadcast_deliveries).
+# Получатели забираются из базы пачками по batch_size (pending -> sending), результаты
+# сохраняются такими же пачками - это контрольные точки. После перезапуска recover_broadcast_job
+# помечает незафиксированных получателей как 'unknown', так что повторной отправки не бывает.
+async def run_broadcast_job(broadcaster, db, job_id, text, total=None, status_message=None, batch_size=100):
+    results = {}
+    checkpoint_lock = asyncio.Lock()
+
+    async def checkpoint():
+        async with checkpoint_lock:
+            if not results:
+                return
+            batch = dict(results)
+            results.clear()
+            await db.save_broadcast_results(job_id, batch)
+
+    async def on_result(chat_id, delivered, error):
+        results[chat_id] = ('sent', None) if delivered else ('failed', str(error)[:255])
+        if len(results) >= batch_size:
+            await checkpoint()
+
+    async def recipients():
+        while True:
+            user_ids = await db.claim_broadcast_batch(job_id, batch_size)
+            if not user_ids:
+                return
+            for user_id in user_ids:
+                yield user_id, text
+
+    result = await broadcaster.run(recipients(), total=total, status_message=status_message, on_result=on_result)
+    await checkpoint()
+    await db.finish_broadcast_job(job_id)
+    return result
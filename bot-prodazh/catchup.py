@@ -0,0 +1,164 @@
+# catchup.py
+
+import asyncio
+import logging
+import time
+from collections import deque
+
+from config import CATCHUP_CONCURRENCY, CATCHUP_CALLBACK_MAX_AGE, UPDATE_WATERMARK_FLUSH_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+WATERMARK_KEY = 'last_update_id'
+
+
+# Отметка обработанных апдейтов (update_id), сохраняется в bot_settings.
+# Защищает только от повторов: апдейт с update_id не больше отметки или недавно начатый отбрасывается
+# (повторная доставка вебхука, пересечение replay_updates.py или catch_up с уже обработанными апдейтами).
+# Восстановления после падения отметка не дает: Telegram считает апдейт доставленным, как только
+# getUpdates вызван со следующим offset или вебхук ответил 200, и заново его не пришлет. Апдейты,
+# которые обрабатывались или ждали в очереди пользователя (lanes.py) в момент падения, теряются;
+# при штатной остановке очереди дорабатываются до закрытия пула (LaneDispatcher.drain).
+# Сохраняемое значение - наибольший update_id, до которого все начатые апдейты завершены
+# (ожидающие в очереди пользователя здесь не учитываются).
+class UpdateWatermark:
+    def __init__(self, recent_size: int = 10000):
+        self.value = 0
+        self._saved = 0
+        self._max_seen = 0
+        self._in_flight = set()
+        self._recent = set()
+        self._recent_order = deque()
+        self._recent_size = recent_size
+        self._task = None
+
+    async def load(self, db):
+        value = await db.get_setting(WATERMARK_KEY)
+        self.value = self._saved = self._max_seen = int(value) if value else 0
+        return self.value
+
+    # Отмечает апдейт как начатый; False - апдейт уже обработан или обрабатывается
+    def start(self, update_id):
+        if update_id <= self.value or update_id in self._recent:
+            return False
+        self._in_flight.add(update_id)
+        self._recent.add(update_id)
+        self._recent_order.append(update_id)
+        if len(self._recent_order) > self._recent_size:
+            self._recent.discard(self._recent_order.popleft())
+        self._max_seen = max(self._max_seen, update_id)
+        return True
+
+    def finish(self, update_id):
+        self._in_flight.discard(update_id)
+
+    @property
+    def safe_value(self):
+        if self._in_flight:
+            return max(self.value, min(self._in_flight) - 1)
+        return self._max_seen
+
+    async def save(self, db):
+        value = self.safe_value
+        if value <= self._saved:
+            return
+        await db.set_setting(WATERMARK_KEY, str(value))
+        self._saved = value
+
+    async def _flusher(self, db, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.save(db)
+            except Exception as e:
+                logger.error(f"Ошибка при сохранении отметки апдейтов: {e}")
+
+    def start_flusher(self, db, interval: int = UPDATE_WATERMARK_FLUSH_INTERVAL):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flusher(db, interval))
+
+    async def close(self, db):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.save(db)
+
+
+# Чат апдейта для сохранения порядка: апдейты одного чата обрабатываются последовательно
+def update_chat_id(update):
+    for message in (update.message, update.edited_message, update.channel_post, update.edited_channel_post):
+        if message:
+            return message.chat.id
+    for event in (update.callback_query, update.inline_query, update.chosen_inline_result,
+                  update.shipping_query, update.pre_checkout_query):
+        if event:
+            return event.from_user.id
+    for event in (update.my_chat_member, update.chat_member, update.chat_join_request):
+        if event:
+            return event.chat.id
+    return None
+
+
+def _update_date(update):
+    message = update.message or update.edited_message or update.channel_post or update.edited_channel_post
+    if message:
+        return (message.edit_date or message.date) if message is update.edited_message else message.date
+    return None
+
+
+# Нажатия кнопок, которые заведомо старше max_age: у callback_query нет даты, но update_id растут
+# со временем, поэтому дата любого более позднего апдейта с датой - верхняя оценка времени нажатия.
+# Если оценки нет (после нажатия ничего не приходило), нажатие обрабатывается.
+def stale_callback_ids(updates, max_age, now=None):
+    now = now or time.time()
+    stale = set()
+    later_date = None
+    for update in sorted(updates, key=lambda update: update.update_id, reverse=True):
+        date = _update_date(update)
+        if date is not None:
+            later_date = date.timestamp()
+        elif update.callback_query and later_date is not None and now - later_date > max_age:
+            stale.add(update.update_id)
+    return stale
+
+
+# Обработка очереди апдейтов, накопившейся за время перезапуска (вместо skip_updates).
+# Апдейты забираются getUpdates пачками, разные чаты обрабатываются параллельно (до concurrency),
+# внутри чата - по порядку update_id. После каждой пачки очередь подтверждается следующим offset.
+# Повторы отсекает UpdateWatermark в middleware, заведомо устаревшие нажатия кнопок пропускаются.
+async def catch_up(dp, watermark, concurrency: int = CATCHUP_CONCURRENCY,
+                   callback_max_age: int = CATCHUP_CALLBACK_MAX_AGE, limit: int = 100):
+    semaphore = asyncio.Semaphore(concurrency)
+    offset = watermark.value + 1 if watermark.value else None
+    processed = skipped = 0
+    started = time.monotonic()
+
+    async def process_chat(updates):
+        async with semaphore:
+            for update in updates:
+                try:
+                    await dp.process_updates([update])
+                except Exception as e:
+                    logger.error(f"Ошибка при обработке апдейта {update.update_id} из очереди: {e}")
+
+    while True:
+        updates = await dp.bot.get_updates(offset=offset, limit=limit, timeout=0)
+        if not updates:
+            break
+        offset = max(update.update_id for update in updates) + 1
+        stale = stale_callback_ids(updates, callback_max_age)
+        chats = {}
+        for update in updates:
+            if update.update_id in stale or update.update_id <= watermark.value:
+                skipped += 1
+                continue
+            chats.setdefault(update_chat_id(update) or f"update:{update.update_id}", []).append(update)
+        await asyncio.gather(*(process_chat(chat_updates) for chat_updates in chats.values()))
+        processed += sum(len(chat_updates) for chat_updates in chats.values())
+
+    if processed or skipped:
+        logger.info(
+            f"Очередь апдейтов после перезапуска обработана: {processed} апдейтов, "
+            f"пропущено {skipped} (повторы и устаревшие нажатия) за {time.monotonic() - started:.1f} с."
+        )
+    return processed
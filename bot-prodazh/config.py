@@ -27,4 +27,51 @@ DB_PORT = int(os.environ.get("DB_PORT", "3306"))
 DB_USER = os.environ.get("DB_USER", "root")
 DB_PASSWORD = os.environ.get("DB_PASSWORD", "")
 DB_NAME = os.environ.get("DB_NAME", "zakbot")
-DB_SSL_CA = os.environ.get("DB_SSL_CA")
\ No newline at end of file
+DB_SSL_CA = os.environ.get("DB_SSL_CA")
+# "mysql" (default) or "sqlite" - a single SQLITE_PATH file for tests and small deployments
+DB_BACKEND = os.environ.get("DB_BACKEND", "mysql")
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "bot.sqlite3")
+
+# Cache configuration
+AD_CACHE_TTL = int(os.environ.get("AD_CACHE_TTL", "300"))
+FAVORITES_CACHE_SIZE = int(os.environ.get("FAVORITES_CACHE_SIZE", "10000"))
+ACCESS_CACHE_TTL = int(os.environ.get("ACCESS_CACHE_TTL", "30"))
+AD_CARD_CACHE_SIZE = int(os.environ.get("AD_CARD_CACHE_SIZE", "5000"))  # pre-rendered ad cards (see ad_cards.py)
+MESSAGE_VIEWS_CACHE_SIZE = int(os.environ.get("MESSAGE_VIEWS_CACHE_SIZE", "20000"))  # catalog messages for minimal edits (see message_views.py)
+
+# Write-behind configuration
+LAST_ACTIVE_FLUSH_INTERVAL = int(os.environ.get("LAST_ACTIVE_FLUSH_INTERVAL", "5"))
+
+# Broadcast configuration (Telegram allows about 30 messages per second per bot)
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "10"))
+
+# Database instrumentation: queries and pool waits slower than this are logged
+SLOW_QUERY_THRESHOLD_MS = int(os.environ.get("SLOW_QUERY_THRESHOLD_MS", "200"))
+
+# Run mode: "polling" (default) or "webhook" (aiohttp server from webhook.py)
+RUN_MODE = os.environ.get("RUN_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")  # public base URL; empty - do not call setWebhook (local replay)
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+WEBAPP_HOST = os.environ.get("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.environ.get("PORT", "8080"))
+
+# Catch-up of updates queued during a restart (see catchup.py)
+CATCHUP_CONCURRENCY = int(os.environ.get("CATCHUP_CONCURRENCY", "20"))
+CATCHUP_CALLBACK_MAX_AGE = int(os.environ.get("CATCHUP_CALLBACK_MAX_AGE", "300"))
+UPDATE_WATERMARK_FLUSH_INTERVAL = int(os.environ.get("UPDATE_WATERMARK_FLUSH_INTERVAL", "5"))
+
+# Per-user update lanes (see lanes.py): max queued updates per user before new ones are dropped
+LANE_QUEUE_SIZE = int(os.environ.get("LANE_QUEUE_SIZE", "100"))
+LANE_DRAIN_TIMEOUT = float(os.environ.get("LANE_DRAIN_TIMEOUT", "10"))  # seconds to finish queued updates on shutdown
+
+# FSM storage in the database (see fsm_storage.py); set both FSM_HOT_TTL and FSM_FLUSH_INTERVAL to 0 for several replicas
+FSM_FLUSH_INTERVAL = int(os.environ.get("FSM_FLUSH_INTERVAL", "1"))
+FSM_HOT_TTL = int(os.environ.get("FSM_HOT_TTL", "600"))
+FSM_SESSION_TTL_DAYS = int(os.environ.get("FSM_SESSION_TTL_DAYS", "30"))
+
+# Inline mode (see inline_search.py): results per page (max 50), Telegram-side cache seconds, typing debounce
+INLINE_PAGE_SIZE = int(os.environ.get("INLINE_PAGE_SIZE", "20"))
+INLINE_CACHE_TIME = int(os.environ.get("INLINE_CACHE_TIME", "30"))
+INLINE_DEBOUNCE_MS = int(os.environ.get("INLINE_DEBOUNCE_MS", "40"))
@@ -1,25 +1,365 @@
 # database.py
 
 import aiomysql
-import json
+import asyncio
+import bisect
+import contextvars
+import itertools
 import logging
 import ssl
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 
-from config import DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME, DB_SSL_CA
+from config import (
+    DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME, DB_SSL_CA, DB_BACKEND, SQLITE_PATH,
+    AD_CACHE_TTL, FAVORITES_CACHE_SIZE, ACCESS_CACHE_TTL, LAST_ACTIVE_FLUSH_INTERVAL,
+)
+from ad_record import Ad
+from db_metrics import QueryMetrics
+from search import CatalogIndex
+from sql_dialects import MYSQL, SQLITE
+from sqlite_pool import create_sqlite_pool
+from subscription_index import SubscriptionIndex
 
 logger = logging.getLogger(__name__)
 
+
+# Виды фотографий объявления в таблице ad_photos
+PHOTO_KINDS = ('photo', 'inspection', 'thickness')
+
+# Выборка объявлений для каталога: из фотографий берется только обложка (первое фото),
+# остальные наборы загружаются по запросу через get_ad_photos. Порядок колонок совпадает с Ad.FIELDS.
+AD_SELECT = """
+    SELECT a.ad_id, a.title, a.model, a.year, a.price, a.description, a.added_date,
+           p.file_id AS cover_photo
+    FROM ads a
+    LEFT JOIN ad_photos p ON p.ad_id = a.ad_id AND p.kind = 'photo' AND p.position = 0
+"""
+
+
+def _ad_sort_key(ad):
+    return (ad.added_date, ad.ad_id)
+
+
+# Единица работы: одно соединение на серию запросов подряд при обработке апдейта (или другом коротком сценарии).
+# Соединение берется из пула при первом обращении к базе и остается у единицы работы, только пока
+# запросы идут друг за другом без других ожиданий: после запроса возврат в пул планируется через
+# call_soon и отменяется, если следующий запрос начался в том же шаге цикла событий. Как только
+# обработчик ждет что-то другое (вызов Bot API, другую задачу, sleep), соединение возвращается в пул.
+# Так единица работы не держит соединение во время чужих ожиданий: обработчик, который ждет задачу,
+# которой самой нужно соединение, не может занять пул целиком и остановить бота.
+# Цена: запросы, разделенные вызовом Bot API, берут соединение из пула заново.
+# Общим соединением пользуется только задача, открывшая единицу работы, и только когда оно свободно
+# (например, не занято потоковым курсором асинхронного генератора); остальные обращения, включая
+# фоновые задачи, запущенные из обработчика, идут в пул как обычно.
+class UnitOfWork:
+    def __init__(self, pool, stats):
+        self._pool = pool
+        self._stats = stats
+        self._conn_context = None
+        self._conn = None
+        self._release_handle = None
+        self._releasing = set()
+        self.task = asyncio.current_task()
+        self.busy = False
+        self.closed = False
+
+    def can_share(self):
+        return not self.closed and not self.busy and self.task is asyncio.current_task()
+
+    @asynccontextmanager
+    async def acquire(self):
+        self.busy = True
+        if self._release_handle is not None:
+            self._release_handle.cancel()
+            self._release_handle = None
+        try:
+            if self._conn is None:
+                self._conn_context = self._pool.acquire()
+                self._conn = await self._conn_context.__aenter__()
+                self._stats['connections'] += 1
+            else:
+                self._stats['reuses'] += 1
+            try:
+                yield self._conn
+            except BaseException:
+                # После ошибки состояние соединения неизвестно: возвращаем его в пул, следующий запрос возьмет новое
+                await self.release()
+                raise
+        finally:
+            self.busy = False
+            if self._conn is not None:
+                self._release_handle = asyncio.get_running_loop().call_soon(self._release_soon)
+
+    # Запрос завершился, и до следующего шага цикла событий новый не начался - соединение возвращается в пул
+    def _release_soon(self):
+        self._release_handle = None
+        if self._conn_context is None or self.busy:
+            return
+        conn_context, self._conn_context, self._conn = self._conn_context, None, None
+        task = asyncio.create_task(conn_context.__aexit__(None, None, None))
+        self._releasing.add(task)
+        task.add_done_callback(self._released)
+
+    def _released(self, task):
+        self._releasing.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Ошибка при возврате соединения в пул: {task.exception()}")
+
+    async def release(self):
+        if self._release_handle is not None:
+            self._release_handle.cancel()
+            self._release_handle = None
+        if self._conn_context is not None:
+            conn_context, self._conn_context, self._conn = self._conn_context, None, None
+            await conn_context.__aexit__(None, None, None)
+        if self._releasing:
+            await asyncio.gather(*self._releasing, return_exceptions=True)
+
+
+_current_unit_of_work = contextvars.ContextVar('current_unit_of_work', default=None)
+
+
+# Кэш каталога объявлений в памяти процесса.
+# Хранит объявления (без наборов фотографий, только обложку) по возрастанию (added_date, ad_id),
+# get_ads отдает их в обратном порядке (новые первыми), как раньше делал SQL.
+# Возвращаемые записи Ad общие для всех вызывающих, изменять их нельзя.
+class AdCatalogCache:
+    def __init__(self, ttl: int = AD_CACHE_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._ads = None
+        self._by_id = {}
+        self._loaded_at = 0.0
+        # Номер загрузки каталога: индексы, построенные по каталогу (search.py), по нему видят перезагрузку
+        self.generation = 0
+        self.lock = asyncio.Lock()
+
+    @property
+    def is_fresh(self):
+        return self._ads is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    def load(self, ads):
+        self._ads = sorted(ads, key=_ad_sort_key)
+        self._by_id = {ad.ad_id: ad for ad in self._ads}
+        self._loaded_at = time.monotonic()
+        self.generation += 1
+
+    def invalidate(self):
+        self._ads = None
+        self._by_id = {}
+
+    def get_all(self):
+        if not self.is_fresh:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.snapshot()
+
+    def snapshot(self):
+        return self._ads[::-1] if self._ads is not None else []
+
+    def get(self, ad_id):
+        if self.is_fresh and ad_id in self._by_id:
+            self.hits += 1
+            return self._by_id[ad_id]
+        self.misses += 1
+        return None
+
+    # Соседние объявления относительно курсора (added_date, ad_id) в порядке просмотра.
+    # direction='next' - более старые, 'prev' - более новые; без курсора - с начала каталога.
+    # only - необязательное множество ad_id, которыми ограничивается выборка (избранное).
+    def page(self, cursor, direction, limit, only=None):
+        if not self.is_fresh:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if cursor is None or direction == 'next':
+            start = len(self._ads) if cursor is None else bisect.bisect_left(self._ads, cursor, key=_ad_sort_key)
+            indexes = range(start - 1, -1, -1)
+        else:
+            indexes = range(bisect.bisect_right(self._ads, cursor, key=_ad_sort_key), len(self._ads))
+        ads = (self._ads[index] for index in indexes)
+        if only is not None:
+            ads = (ad for ad in ads if ad.ad_id in only)
+        return list(itertools.islice(ads, limit))
+
+    def put(self, ad):
+        if self._ads is None:
+            return
+        self.remove(ad.ad_id)
+        bisect.insort(self._ads, ad, key=_ad_sort_key)
+        self._by_id[ad.ad_id] = ad
+
+    def remove(self, ad_id):
+        if self._ads is None:
+            return
+        ad = self._by_id.pop(ad_id, None)
+        if ad is not None:
+            position = bisect.bisect_left(self._ads, _ad_sort_key(ad), key=_ad_sort_key)
+            del self._ads[position]
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._by_id),
+            'age': round(time.monotonic() - self._loaded_at, 1) if self._ads is not None else None,
+        }
+
+
+# Кэш избранного: для каждого пользователя множество ad_id, загружается один раз.
+# Хранится не больше max_users пользователей, давно не обращавшиеся вытесняются (LRU).
+class FavoritesCache:
+    def __init__(self, max_users: int = FAVORITES_CACHE_SIZE):
+        self.max_users = max_users
+        self.hits = 0
+        self.misses = 0
+        self._sets = OrderedDict()
+
+    def get(self, user_id):
+        ad_ids = self._sets.get(user_id)
+        if ad_ids is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._sets.move_to_end(user_id)
+        return ad_ids
+
+    def put(self, user_id, ad_ids):
+        self._sets[user_id] = set(ad_ids)
+        self._sets.move_to_end(user_id)
+        while len(self._sets) > self.max_users:
+            self._sets.popitem(last=False)
+
+    def add(self, user_id, ad_id):
+        if user_id in self._sets:
+            self._sets[user_id].add(ad_id)
+
+    def discard(self, user_id, ad_id):
+        if user_id in self._sets:
+            self._sets[user_id].discard(ad_id)
+
+    # Объявление удалено - записи избранного удаляются каскадно, убираем его из всех множеств
+    def discard_ad(self, ad_id):
+        for ad_ids in self._sets.values():
+            ad_ids.discard(ad_id)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'users': len(self._sets)}
+
+
+# Небольшой кэш с ограниченным временем жизни записей (настройки бота, статусы пользователей).
+# get возвращает пару (значение, возраст в секундах) или None, если записи нет или она устарела.
+class TTLCache:
+    def __init__(self, ttl: int = ACCESS_CACHE_TTL, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, stored_at = entry
+            age = time.monotonic() - stored_at
+            if age < self.ttl:
+                self.hits += 1
+                return value, age
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        self._entries[key] = (value, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def stats(self):
+        now = time.monotonic()
+        ages = [now - stored_at for _, stored_at in self._entries.values()]
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'max_age': round(max(ages), 1) if ages else None,
+        }
+
+
 class Database:
-    def __init__(self, host: str = DB_HOST, port: int = DB_PORT, user: str = DB_USER, password: str = DB_PASSWORD, db: str = DB_NAME, ssl_ca: str | None = DB_SSL_CA):
+    def __init__(self, host: str = DB_HOST, port: int = DB_PORT, user: str = DB_USER, password: str = DB_PASSWORD, db: str = DB_NAME, ssl_ca: str | None = DB_SSL_CA,
+                 backend: str = DB_BACKEND, sqlite_path: str = SQLITE_PATH):
         self.host = host
         self.port = port
         self.user = user
         self.password = password
         self.db = db
         self.ssl_ca = ssl_ca
+        self.backend = backend
+        self.sqlite_path = sqlite_path
+        # Различия SQL между MySQL и SQLite (sql_dialects.py)
+        self.dialect = SQLITE if backend == 'sqlite' else MYSQL
         self.pool = None
+        self.ads_cache = AdCatalogCache()
+        self.favorites_cache = FavoritesCache()
+        self.settings_cache = TTLCache(max_size=16)
+        self.status_cache = TTLCache()
+        # Буфер отложенной записи last_active: user_id -> time.monotonic() последней активности
+        self._last_active = {}
+        self._last_active_task = None
+        # Индекс подписок загружается при первом сопоставлении и поддерживается add/delete_subscription
+        self.subscription_index = None
+        self._subscription_index_lock = asyncio.Lock()
+        # Поисковый индекс каталога строится при первом поиске и поддерживается add_ad/delete_ad
+        self.search_index = None
+        # Гистограммы ожидания пула, выполнения и строк по именам запросов, лог медленных запросов
+        self.metrics = QueryMetrics()
+        self.unit_of_work_stats = {'units': 0, 'connections': 0, 'reuses': 0}
+
+    # Соединение из пула с замером метрик; name - имя запроса в отчете (обычно имя метода).
+    # Внутри единицы работы повторно используется ее соединение.
+    def acquire(self, name):
+        unit = _current_unit_of_work.get()
+        if unit is not None and unit.can_share():
+            return self.metrics.acquire(self.pool, name, connections=unit)
+        return self.metrics.acquire(self.pool, name)
+
+    # Начало единицы работы в текущем контексте; возвращает токен для end_unit_of_work
+    def begin_unit_of_work(self):
+        self.unit_of_work_stats['units'] += 1
+        return _current_unit_of_work.set(UnitOfWork(self.pool, self.unit_of_work_stats))
+
+    async def end_unit_of_work(self, token):
+        unit = _current_unit_of_work.get()
+        _current_unit_of_work.reset(token)
+        if unit is not None:
+            unit.closed = True
+            await unit.release()
+
+    @asynccontextmanager
+    async def unit_of_work(self):
+        token = self.begin_unit_of_work()
+        try:
+            yield
+        finally:
+            await self.end_unit_of_work(token)
 
     async def connect(self):
+        if self.backend == 'sqlite':
+            try:
+                self.pool = await create_sqlite_pool(self.sqlite_path, maxsize=10)
+                logger.info(f"Подключение к базе данных SQLite {self.sqlite_path} установлено.")
+            except Exception as e:
+                logger.critical(f"Не удалось открыть базу данных SQLite {self.sqlite_path}: {e}")
+                raise
+            return
         try:
             ssl_context = None
             if self.ssl_ca:
@@ -42,32 +382,44 @@ class Database:
             raise
 
     async def close(self):
+        if self._last_active_task:
+            self._last_active_task.cancel()
+            self._last_active_task = None
         if self.pool:
+            try:
+                await self.flush_last_active()
+            except Exception as e:
+                logger.error(f"Не удалось сохранить last_active при закрытии: {e}")
             self.pool.close()
             await self.pool.wait_closed()
+            # Повторное закрытие и проверки "if self.pool" после остановки видят, что пула нет
+            self.pool = None
             logger.info("Подключение к базе данных закрыто.")
 
     # Метод для добавления нового пользователя
+    # Новый пользователь получает отметку last_seen_ad_id на последнее объявление: в первое ежедневное
+    # уведомление попадут только объявления, добавленные после регистрации. У существующего отметка не меняется.
     async def add_user(self, user_id, username=None, status='pending'):
-        async with self.pool.acquire() as conn:
+        async with self.acquire('add_user') as conn:
             async with conn.cursor() as cur:
                 try:
+                    await cur.execute("SELECT COALESCE(MAX(ad_id), 0) FROM ads")
+                    (last_ad_id,) = await cur.fetchone()
                     await cur.execute(
-                        """
-                        INSERT INTO users (user_id, username, status)
-                        VALUES (%s, %s, %s)
-                        ON DUPLICATE KEY UPDATE username=VALUES(username), status=VALUES(status)
-                        """,
-                        (user_id, username, status)
+                        self.dialect.upsert(
+                            'users', ('user_id', 'username', 'status', 'last_seen_ad_id'), ('user_id',), ('username', 'status')
+                        ),
+                        (user_id, username, status, last_ad_id)
                     )
                     logger.info(f"Пользователь {user_id} добавлен/обновлен с статусом {status}.")
                 except Exception as e:
                     logger.error(f"Ошибка при добавлении пользователя {user_id}: {e}")
                     raise
+        self.status_cache.invalidate(user_id)
 
     # Метод для получения информации о пользователе
     async def get_user(self, user_id):
-        async with self.pool.acquire() as conn:
+        async with self.acquire('get_user') as conn:
             async with conn.cursor(aiomysql.DictCursor) as cur:
                 await cur.execute(
                     "SELECT * FROM users WHERE user_id=%s",
@@ -76,9 +428,27 @@ class Database:
                 user = await cur.fetchone()
                 return user
 
+    # Метод для получения статуса пользователя (кэшируется на ACCESS_CACHE_TTL секунд, None - нет пользователя)
+    async def get_user_status(self, user_id):
+        cached = self.status_cache.get(user_id)
+        if cached is not None:
+            status, age = cached
+            logger.debug(f"Статус пользователя {user_id} взят из кэша (возраст {age:.1f} с).")
+            return status
+        async with self.acquire('get_user_status') as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    "SELECT status FROM users WHERE user_id=%s",
+                    (user_id,)
+                )
+                result = await cur.fetchone()
+        status = result[0] if result else None
+        self.status_cache.set(user_id, status)
+        return status
+
     # Метод для обновления контактной информации пользователя
     async def update_user_contact(self, user_id, name, phone, city):
-        async with self.pool.acquire() as conn:
+        async with self.acquire('update_user_contact') as conn:
             async with conn.cursor() as cur:
                 try:
                     await cur.execute(
@@ -96,7 +466,7 @@ class Database:
 
     # Метод для обновления статуса пользователя
     async def update_user_status(self, user_id, status):
-        async with self.pool.acquire() as conn:
+        async with self.acquire('update_user_status') as conn:
             async with conn.cursor() as cur:
                 try:
                     await cur.execute(
@@ -111,107 +481,263 @@ class Database:
                 except Exception as e:
                     logger.error(f"Ошибка при обновлении статуса пользователя {user_id}: {e}")
                     raise
+        self.status_cache.invalidate(user_id)
 
-    # Метод для обновления последней активности пользователя
+    # Метод для обновления последней активности пользователя.
+    # Запись отложенная: время запоминается в памяти и сбрасывается в базу пачкой
+    # раз в LAST_ACTIVE_FLUSH_INTERVAL секунд (см. start_last_active_flusher).
     async def update_last_active(self, user_id):
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                try:
-                    await cur.execute(
-                        """
-                        UPDATE users
-                        SET last_active=NOW()
-                        WHERE user_id=%s
-                        """,
-                        (user_id,)
-                    )
-                    logger.debug(f"Обновлено время последней активности для пользователя {user_id}.")
-                except Exception as e:
-                    logger.error(f"Ошибка при обновлении last_active для пользователя {user_id}: {e}")
-                    raise
+        self._last_active[user_id] = time.monotonic()
+
+    # Метод для сброса накопленных last_active одним UPDATE ... CASE на пачку пользователей
+    async def flush_last_active(self, batch_size=500):
+        if not self._last_active:
+            return
+        pending, self._last_active = self._last_active, {}
+        now = time.monotonic()
+        items = list(pending.items())
+        try:
+            for start in range(0, len(items), batch_size):
+                batch = items[start:start + batch_size]
+                # Время передается как смещение от NOW() базы, чтобы не зависеть от часового пояса сервера
+                cases = " ".join(f"WHEN %s THEN {self.dialect.ago('%s', 'SECOND')}" for _ in batch)
+                placeholders = ", ".join(["%s"] * len(batch))
+                params = [value for user_id, seen_at in batch for value in (user_id, int(now - seen_at))]
+                params.extend(user_id for user_id, _ in batch)
+                async with self.acquire('flush_last_active') as conn:
+                    async with conn.cursor() as cur:
+                        await cur.execute(
+                            f"UPDATE users SET last_active = CASE user_id {cases} END WHERE user_id IN ({placeholders})",
+                            params
+                        )
+            logger.debug(f"Сохранено время последней активности для {len(items)} пользователей.")
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении last_active: {e}")
+            # Возвращаем несохраненные записи в буфер, не затирая более свежие
+            for user_id, seen_at in pending.items():
+                if self._last_active.get(user_id, 0) < seen_at:
+                    self._last_active[user_id] = seen_at
+            raise
 
-    # Метод для проверки состояния бота (открыт/закрыт)
+    async def _last_active_flusher(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush_last_active()
+            except Exception:
+                pass  # Ошибка уже залогирована, записи остались в буфере до следующей попытки
+
+    # Метод для запуска фоновой задачи сброса last_active (останавливается в close)
+    def start_last_active_flusher(self, interval: int = LAST_ACTIVE_FLUSH_INTERVAL):
+        if self._last_active_task is None:
+            self._last_active_task = asyncio.create_task(self._last_active_flusher(interval))
+
+    # Метод для проверки состояния бота (открыт/закрыт), кэшируется на ACCESS_CACHE_TTL секунд
     async def is_bot_open(self):
-        async with self.pool.acquire() as conn:
+        cached = self.settings_cache.get('is_open')
+        if cached is not None:
+            is_open, age = cached
+            logger.debug(f"Состояние бота взято из кэша (возраст {age:.1f} с).")
+            return is_open
+        async with self.acquire('is_bot_open') as conn:
             async with conn.cursor() as cur:
                 await cur.execute(
                     "SELECT `value` FROM bot_settings WHERE `key`='is_open'"
                 )
                 result = await cur.fetchone()
-                if result and result[0].lower() == 'true':
-                    return True
-                return False
+        is_open = bool(result and result[0].lower() == 'true')
+        self.settings_cache.set('is_open', is_open)
+        return is_open
+
+    # Метод для чтения произвольной настройки из bot_settings (None, если не задана)
+    async def get_setting(self, key):
+        async with self.acquire('get_setting') as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    "SELECT `value` FROM bot_settings WHERE `key`=%s",
+                    (key,)
+                )
+                result = await cur.fetchone()
+                return result[0] if result else None
+
+    # Метод для записи произвольной настройки в bot_settings
+    async def set_setting(self, key, value):
+        async with self.acquire('set_setting') as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    self.dialect.upsert('bot_settings', ('`key`', '`value`'), ('`key`',), ('`value`',)),
+                    (key, value)
+                )
 
     # Метод для установки состояния бота
     async def set_bot_state(self, state: bool):
-        async with self.pool.acquire() as conn:
+        async with self.acquire('set_bot_state') as conn:
             async with conn.cursor() as cur:
                 value = 'true' if state else 'false'
                 await cur.execute(
-                    """
-                    INSERT INTO bot_settings (`key`, `value`)
-                    VALUES ('is_open', %s)
-                    ON DUPLICATE KEY UPDATE `value`=VALUES(`value`)
-                    """,
-                    (value,)
+                    self.dialect.upsert('bot_settings', ('`key`', '`value`'), ('`key`',), ('`value`',)),
+                    ('is_open', value)
                 )
                 logger.info(f"Состояние бота установлено на {'открыт' if state else 'закрыт'}.")
+        self.settings_cache.invalidate('is_open')
 
     # Метод для добавления объявления
     async def add_ad(self, title, price, description, photos, inspection_photos, thickness_photos, model, year):
-        async with self.pool.acquire() as conn:
+        async with self.acquire('add_ad') as conn:
             async with conn.cursor() as cur:
                 try:
-                    photos_json = json.dumps(photos)
-                    inspection_photos_json = json.dumps(inspection_photos)
-                    thickness_photos_json = json.dumps(thickness_photos)
+                    # Объявление и его фотографии записываются одной транзакцией
+                    await conn.begin()
                     await cur.execute(
                         """
-                        INSERT INTO ads (title, model, year, price, description, photos, inspection_photos, thickness_photos)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                        INSERT INTO ads (title, model, year, price, description)
+                        VALUES (%s, %s, %s, %s, %s)
                         """,
-                        (title, model, year, price, description, photos_json, inspection_photos_json, thickness_photos_json)
+                        (title, model, year, price, description)
                     )
                     ad_id = cur.lastrowid
+                    rows = [
+                        (ad_id, kind, position, file_id)
+                        for kind, file_ids in zip(PHOTO_KINDS, (photos, inspection_photos, thickness_photos))
+                        for position, file_id in enumerate(file_ids)
+                    ]
+                    if rows:
+                        await cur.executemany(
+                            "INSERT INTO ad_photos (ad_id, kind, position, file_id) VALUES (%s, %s, %s, %s)",
+                            rows
+                        )
+                    await conn.commit()
                     logger.info(f"Объявление '{title}' добавлено с ID {ad_id}.")
-                    return ad_id
                 except Exception as e:
+                    await conn.rollback()
                     logger.error(f"Ошибка при добавлении объявления '{title}': {e}")
                     raise
+        # Дописываем новое объявление в кэш, чтобы не перечитывать весь каталог
+        ad = await self._fetch_ad(ad_id)
+        if ad:
+            self.ads_cache.put(ad)
+            if self.search_index is not None:
+                self.search_index.add(ad)
+        else:
+            self.ads_cache.invalidate()
+        return ad_id
 
-    # Метод для получения всех объявлений
+    # Метод для получения всех объявлений (из кэша каталога, если он актуален)
     async def get_ads(self):
-        async with self.pool.acquire() as conn:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(
-                    "SELECT * FROM ads ORDER BY added_date DESC"
-                )
-                ads = await cur.fetchall()
-                # Преобразование JSON-полей обратно в списки
-                for ad in ads:
-                    ad['photos'] = json.loads(ad['photos']) if ad['photos'] else []
-                    ad['inspection_photos'] = json.loads(ad['inspection_photos']) if ad['inspection_photos'] else []
-                    ad['thickness_photos'] = json.loads(ad['thickness_photos']) if ad['thickness_photos'] else []
-                return ads
+        ads = self.ads_cache.get_all()
+        if ads is not None:
+            return ads
+        async with self.ads_cache.lock:
+            # Пока ждали блокировку, каталог мог загрузить другой запрос
+            if self.ads_cache.is_fresh:
+                return self.ads_cache.snapshot()
+            async with self.acquire('get_ads') as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(
+                        f"{AD_SELECT} ORDER BY a.added_date DESC, a.ad_id DESC"
+                    )
+                    ads = [Ad.from_row(row) for row in await cur.fetchall()]
+            self.ads_cache.load(ads)
+            logger.info(f"Кэш каталога загружен: {len(ads)} объявлений.")
+            return self.ads_cache.snapshot()
 
     # Метод для получения конкретного объявления по ID
     async def get_ad(self, ad_id):
-        async with self.pool.acquire() as conn:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
+        ad = self.ads_cache.get(ad_id)
+        if ad is not None:
+            return ad
+        ad = await self._fetch_ad(ad_id)
+        if ad:
+            self.ads_cache.put(ad)
+        return ad
+
+    async def _fetch_ad(self, ad_id):
+        async with self.acquire('fetch_ad') as conn:
+            async with conn.cursor() as cur:
                 await cur.execute(
-                    "SELECT * FROM ads WHERE ad_id=%s",
+                    f"{AD_SELECT} WHERE a.ad_id=%s",
                     (ad_id,)
                 )
-                ad = await cur.fetchone()
-                if ad:
-                    ad['photos'] = json.loads(ad['photos']) if ad['photos'] else []
-                    ad['inspection_photos'] = json.loads(ad['inspection_photos']) if ad['inspection_photos'] else []
-                    ad['thickness_photos'] = json.loads(ad['thickness_photos']) if ad['thickness_photos'] else []
-                return ad
+                row = await cur.fetchone()
+                return Ad.from_row(row) if row else None
+
+    # Метод для получения фотографий объявления одного вида ('photo', 'inspection', 'thickness') по порядку.
+    # Вызывается только когда пользователь открывает набор фото, в каталоге хранится лишь обложка.
+    # Загруженный набор запоминается в записи объявления из кэша каталога.
+    async def get_ad_photos(self, ad_id, kind):
+        ad = self.ads_cache.get(ad_id)
+        if ad is not None:
+            photos = ad.get_photos(kind)
+            if photos is not None:
+                return photos
+        async with self.acquire('get_ad_photos') as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    "SELECT file_id FROM ad_photos WHERE ad_id=%s AND kind=%s ORDER BY position",
+                    (ad_id, kind)
+                )
+                rows = await cur.fetchall()
+        photos = [row[0] for row in rows]
+        if ad is not None:
+            ad.set_photos(kind, photos)
+        return photos
+
+    # Метод для keyset-пагинации каталога: объявления за курсором (added_date, ad_id).
+    # Возвращает до limit объявлений в порядке просмотра, ближайшее к курсору первым.
+    # Если задан user_id, листаются только избранные объявления пользователя.
+    async def get_ads_page(self, cursor=None, direction='next', user_id=None, limit=2):
+        only = await self.get_favorite_ids(user_id) if user_id is not None else None
+        ads = self.ads_cache.page(cursor, direction, limit, only=only)
+        if ads is not None:
+            return ads
+        conditions = []
+        params = []
+        if user_id is not None:
+            conditions.append("a.ad_id IN (SELECT ad_id FROM favorites WHERE user_id=%s)")
+            params.append(user_id)
+        if cursor is None or direction == 'next':
+            order = "DESC"
+            if cursor is not None:
+                conditions.append("(a.added_date < %s OR (a.added_date = %s AND a.ad_id < %s))")
+                params.extend((cursor[0], cursor[0], cursor[1]))
+        else:
+            order = "ASC"
+            conditions.append("(a.added_date > %s OR (a.added_date = %s AND a.ad_id > %s))")
+            params.extend((cursor[0], cursor[0], cursor[1]))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        params.append(limit)
+        async with self.acquire('get_ads_page') as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    f"{AD_SELECT} {where} ORDER BY a.added_date {order}, a.ad_id {order} LIMIT %s",
+                    params
+                )
+                return [Ad.from_row(row) for row in await cur.fetchall()]
+
+    # Метод для поиска по каталогу (query - search.SearchQuery): (всего найдено, объявления страницы).
+    # Точный подсчет стоит прохода по всем кандидатам, поэтому нужен только там, где число показывается.
+    async def search_ads(self, query, offset=0, limit=10):
+        return (await self._search_index()).search(query, offset, limit)
+
+    # Метод для листания результатов поиска без подсчета: (объявления страницы, есть ли следующие)
+    async def search_ads_page(self, query, offset=0, limit=10):
+        return (await self._search_index()).page(query, offset, limit)
+
+    # Индекс строится по кэшу каталога и перестраивается, когда кэш перезагружается после AD_CACHE_TTL
+    async def _search_index(self):
+        index = self.search_index
+        if index is None or not self.ads_cache.is_fresh or index.generation != self.ads_cache.generation:
+            ads = await self.get_ads()
+            if self.search_index is None or self.search_index.generation != self.ads_cache.generation:
+                started = time.perf_counter()
+                self.search_index = CatalogIndex(ads, generation=self.ads_cache.generation)
+                logger.info(f"Поисковый индекс построен: {len(ads)} объявлений за {(time.perf_counter() - started) * 1000:.0f} мс.")
+            index = self.search_index
+        return index
 
     # Метод для удаления объявления
     async def delete_ad(self, ad_id):
-        async with self.pool.acquire() as conn:
+        async with self.acquire('delete_ad') as conn:
             async with conn.cursor() as cur:
                 try:
                     await cur.execute(
@@ -222,39 +748,48 @@ class Database:
                 except Exception as e:
                     logger.error(f"Ошибка при удалении объявления {ad_id}: {e}")
                     raise
+        self.ads_cache.remove(ad_id)
+        self.favorites_cache.discard_ad(ad_id)
+        if self.search_index is not None:
+            self.search_index.remove(ad_id)
 
-    # Метод для проверки, является ли объявление избранным для пользователя
-    async def is_favorite(self, user_id, ad_id):
-        async with self.pool.acquire() as conn:
+    # Метод для получения множества избранных ad_id пользователя (из кэша избранного)
+    async def get_favorite_ids(self, user_id):
+        ad_ids = self.favorites_cache.get(user_id)
+        if ad_ids is not None:
+            return ad_ids
+        async with self.acquire('get_favorite_ids') as conn:
             async with conn.cursor() as cur:
                 await cur.execute(
-                    "SELECT 1 FROM favorites WHERE user_id=%s AND ad_id=%s",
-                    (user_id, ad_id)
+                    "SELECT ad_id FROM favorites WHERE user_id=%s",
+                    (user_id,)
                 )
-                result = await cur.fetchone()
-                return bool(result)
+                rows = await cur.fetchall()
+        self.favorites_cache.put(user_id, (row[0] for row in rows))
+        return self.favorites_cache.get(user_id)
+
+    # Метод для проверки, является ли объявление избранным для пользователя
+    async def is_favorite(self, user_id, ad_id):
+        return ad_id in await self.get_favorite_ids(user_id)
 
     # Метод для добавления объявления в избранное
     async def add_to_favorites(self, user_id, ad_id):
-        async with self.pool.acquire() as conn:
+        async with self.acquire('add_to_favorites') as conn:
             async with conn.cursor() as cur:
                 try:
                     await cur.execute(
-                        """
-                        INSERT INTO favorites (user_id, ad_id)
-                        VALUES (%s, %s)
-                        ON DUPLICATE KEY UPDATE ad_id=ad_id
-                        """,
+                        self.dialect.upsert('favorites', ('user_id', 'ad_id'), ('user_id', 'ad_id'), ()),
                         (user_id, ad_id)
                     )
                     logger.info(f"Объявление {ad_id} добавлено в избранное пользователя {user_id}.")
                 except Exception as e:
                     logger.error(f"Ошибка при добавлении объявления {ad_id} в избранное пользователя {user_id}: {e}")
                     raise
+        self.favorites_cache.add(user_id, ad_id)
 
     # Метод для удаления объявления из избранного
     async def remove_from_favorites(self, user_id, ad_id):
-        async with self.pool.acquire() as conn:
+        async with self.acquire('remove_from_favorites') as conn:
             async with conn.cursor() as cur:
                 try:
                     await cur.execute(
@@ -265,31 +800,18 @@ class Database:
                 except Exception as e:
                     logger.error(f"Ошибка при удалении объявления {ad_id} из избранного пользователя {user_id}: {e}")
                     raise
+        self.favorites_cache.discard(user_id, ad_id)
 
-    # Метод для получения избранных объявлений пользователя
+    # Метод для получения избранных объявлений пользователя (каталог фильтруется по кэшу избранного)
     async def get_favorite_ads(self, user_id):
-        async with self.pool.acquire() as conn:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(
-                    """
-                    SELECT ads.*
-                    FROM ads
-                    JOIN favorites ON ads.ad_id = favorites.ad_id
-                    WHERE favorites.user_id=%s
-                    ORDER BY ads.added_date DESC
-                    """,
-                    (user_id,)
-                )
-                ads = await cur.fetchall()
-                for ad in ads:
-                    ad['photos'] = json.loads(ad['photos']) if ad['photos'] else []
-                    ad['inspection_photos'] = json.loads(ad['inspection_photos']) if ad['inspection_photos'] else []
-                    ad['thickness_photos'] = json.loads(ad['thickness_photos']) if ad['thickness_photos'] else []
-                return ads
+        ad_ids = await self.get_favorite_ids(user_id)
+        if not ad_ids:
+            return []
+        return [ad for ad in await self.get_ads() if ad.ad_id in ad_ids]
 
     # Метод для добавления подписки
     async def add_subscription(self, user_id, model=None, price_min=None, price_max=None, year_min=None, year_max=None):
-        async with self.pool.acquire() as conn:
+        async with self.acquire('add_subscription') as conn:
             async with conn.cursor() as cur:
                 try:
                     await cur.execute(
@@ -299,14 +821,21 @@ class Database:
                         """,
                         (user_id, model, price_min, price_max, year_min, year_max)
                     )
+                    rowid = cur.lastrowid
                     logger.info(f"Пользователь {user_id} добавил новую подписку.")
                 except Exception as e:
                     logger.error(f"Ошибка при добавлении подписки для пользователя {user_id}: {e}")
                     raise
+        if self.subscription_index is not None:
+            self.subscription_index.add({
+                'rowid': rowid, 'user_id': user_id, 'model': model,
+                'price_min': price_min, 'price_max': price_max, 'year_min': year_min, 'year_max': year_max,
+            })
+        return rowid
 
     # Метод для получения подписок пользователя
     async def get_subscriptions(self, user_id):
-        async with self.pool.acquire() as conn:
+        async with self.acquire('get_subscriptions') as conn:
             async with conn.cursor(aiomysql.DictCursor) as cur:
                 await cur.execute(
                     """
@@ -320,7 +849,7 @@ class Database:
 
     # Метод для удаления подписки
     async def delete_subscription(self, rowid):
-        async with self.pool.acquire() as conn:
+        async with self.acquire('delete_subscription') as conn:
             async with conn.cursor() as cur:
                 try:
                     await cur.execute(
@@ -331,10 +860,12 @@ class Database:
                 except Exception as e:
                     logger.error(f"Ошибка при удалении подписки {rowid}: {e}")
                     raise
+        if self.subscription_index is not None:
+            self.subscription_index.remove(rowid)
 
     # Метод для получения контактных данных пользователей
     async def get_user_contacts(self):
-        async with self.pool.acquire() as conn:
+        async with self.acquire('get_user_contacts') as conn:
             async with conn.cursor() as cur:
                 await cur.execute(
                     """
@@ -345,9 +876,25 @@ class Database:
                 contacts = await cur.fetchall()
                 return contacts
 
+    # Метод для потокового чтения контактных данных пачками через server-side cursor (для экспорта)
+    async def iter_user_contacts(self, batch_size=1000):
+        async with self.acquire('iter_user_contacts') as conn:
+            async with conn.cursor(aiomysql.SSCursor) as cur:
+                await cur.execute(
+                    """
+                    SELECT name, city, phone FROM users
+                    WHERE name IS NOT NULL AND city IS NOT NULL AND phone IS NOT NULL
+                    """
+                )
+                while True:
+                    rows = await cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield rows
+
     # Метод для получения всех подписок (для уведомления при добавлении нового объявления)
     async def get_all_subscriptions(self):
-        async with self.pool.acquire() as conn:
+        async with self.acquire('get_all_subscriptions') as conn:
             async with conn.cursor(aiomysql.DictCursor) as cur:
                 await cur.execute(
                     "SELECT * FROM subscriptions"
@@ -355,9 +902,19 @@ class Database:
                 subscriptions = await cur.fetchall()
                 return subscriptions
 
+    # Метод для получения подписок, которым соответствует объявление (через индекс подписок)
+    async def match_subscriptions(self, ad):
+        if self.subscription_index is None:
+            async with self._subscription_index_lock:
+                if self.subscription_index is None:
+                    subscriptions = await self.get_all_subscriptions()
+                    self.subscription_index = SubscriptionIndex(subscriptions)
+                    logger.info(f"Индекс подписок загружен: {len(subscriptions)} подписок.")
+        return self.subscription_index.match(ad)
+
     # Метод для получения одобренных пользователей (для рассылок)
     async def get_approved_users(self):
-        async with self.pool.acquire() as conn:
+        async with self.acquire('get_approved_users') as conn:
             async with conn.cursor() as cur:
                 await cur.execute(
                     "SELECT user_id FROM users WHERE status='approved'"
@@ -365,9 +922,136 @@ class Database:
                 users = await cur.fetchall()
                 return [user[0] for user in users]
 
+    # Метод для создания задания рассылки: получатели (одобренные пользователи) сохраняются в базе
+    async def create_broadcast_job(self, text, created_by):
+        async with self.acquire('create_broadcast_job') as conn:
+            async with conn.cursor() as cur:
+                try:
+                    # Задание и получатели записываются одной транзакцией: задание 'running' без получателей
+                    # resume_broadcast_jobs подхватывал бы при каждом перезапуске
+                    await conn.begin()
+                    await cur.execute(
+                        "INSERT INTO broadcast_jobs (text, created_by) VALUES (%s, %s)",
+                        (text, created_by)
+                    )
+                    job_id = cur.lastrowid
+                    await cur.execute(
+                        """
+                        INSERT INTO broadcast_deliveries (job_id, user_id)
+                        SELECT %s, user_id FROM users WHERE status='approved'
+                        """,
+                        (job_id,)
+                    )
+                    total = cur.rowcount
+                    await conn.commit()
+                    logger.info(f"Создано задание рассылки {job_id} на {total} получателей.")
+                    return job_id, total
+                except Exception as e:
+                    await conn.rollback()
+                    logger.error(f"Ошибка при создании задания рассылки: {e}")
+                    raise
+
+    # Метод для получения незавершенных заданий рассылки
+    async def get_unfinished_broadcast_jobs(self):
+        async with self.acquire('get_unfinished_broadcast_jobs') as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                await cur.execute(
+                    "SELECT * FROM broadcast_jobs WHERE status='running' ORDER BY job_id"
+                )
+                return await cur.fetchall()
+
+    # Метод для подготовки задания к возобновлению.
+    # Получатели в статусе 'sending' могли уже получить сообщение до перезапуска,
+    # поэтому они помечаются 'unknown' и повторно не отправляются.
+    async def recover_broadcast_job(self, job_id):
+        async with self.acquire('recover_broadcast_job') as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    "UPDATE broadcast_deliveries SET status='unknown' WHERE job_id=%s AND status='sending'",
+                    (job_id,)
+                )
+                if cur.rowcount:
+                    logger.warning(f"Рассылка {job_id}: {cur.rowcount} получателей с неизвестным статусом доставки.")
+                await cur.execute(
+                    "SELECT COUNT(*) FROM broadcast_deliveries WHERE job_id=%s AND status='pending'",
+                    (job_id,)
+                )
+                return (await cur.fetchone())[0]
+
+    # Метод для захвата следующей пачки получателей рассылки (pending -> sending)
+    async def claim_broadcast_batch(self, job_id, limit):
+        async with self.acquire('claim_broadcast_batch') as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    "SELECT user_id FROM broadcast_deliveries WHERE job_id=%s AND status='pending' ORDER BY user_id LIMIT %s",
+                    (job_id, limit)
+                )
+                user_ids = [row[0] for row in await cur.fetchall()]
+                if user_ids:
+                    placeholders = ", ".join(["%s"] * len(user_ids))
+                    await cur.execute(
+                        f"UPDATE broadcast_deliveries SET status='sending' WHERE job_id=%s AND user_id IN ({placeholders})",
+                        [job_id, *user_ids]
+                    )
+                return user_ids
+
+    # Метод для сохранения результатов доставки пачкой: results - {user_id: (status, error)}
+    async def save_broadcast_results(self, job_id, results):
+        if not results:
+            return
+        items = list(results.items())
+        status_cases = " ".join("WHEN %s THEN %s" for _ in items)
+        error_cases = " ".join("WHEN %s THEN %s" for _ in items)
+        placeholders = ", ".join(["%s"] * len(items))
+        params = [value for user_id, (status, _) in items for value in (user_id, status)]
+        params += [value for user_id, (_, error) in items for value in (user_id, error)]
+        params += [job_id, *(user_id for user_id, _ in items)]
+        async with self.acquire('save_broadcast_results') as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    f"""
+                    UPDATE broadcast_deliveries
+                    SET status = CASE user_id {status_cases} END, error = CASE user_id {error_cases} END
+                    WHERE job_id=%s AND user_id IN ({placeholders})
+                    """,
+                    params
+                )
+
+    # Метод для завершения задания рассылки
+    async def finish_broadcast_job(self, job_id):
+        async with self.acquire('finish_broadcast_job') as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    f"UPDATE broadcast_jobs SET status='finished', finished_at={self.dialect.now()} WHERE job_id=%s",
+                    (job_id,)
+                )
+                logger.info(f"Задание рассылки {job_id} завершено.")
+
+    # Метод для получения последних заданий рассылки со счетчиками по статусам доставки
+    async def get_broadcast_jobs_status(self, limit=5):
+        async with self.acquire('get_broadcast_jobs_status') as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                await cur.execute(
+                    """
+                    SELECT j.job_id, j.status, j.created_at, j.finished_at,
+                           COUNT(d.user_id) AS total,
+                           COALESCE(SUM(d.status='sent'), 0) AS sent,
+                           COALESCE(SUM(d.status='failed'), 0) AS failed,
+                           COALESCE(SUM(d.status='unknown'), 0) AS unknown,
+                           COALESCE(SUM(d.status IN ('pending', 'sending')), 0) AS pending
+                    FROM broadcast_jobs j
+                    LEFT JOIN broadcast_deliveries d ON d.job_id = j.job_id
+                    GROUP BY j.job_id
+                    ORDER BY j.job_id DESC
+                    LIMIT %s
+                    """,
+                    (limit,)
+                )
+                return await cur.fetchall()
+
     # Метод для получения статистики
     async def get_statistics(self):
-        async with self.pool.acquire() as conn:
+        async with self.acquire('get_statistics') as conn:
             async with conn.cursor() as cur:
                 # Общее количество пользователей
                 await cur.execute("SELECT COUNT(*) FROM users")
@@ -379,12 +1063,13 @@ class Database:
 
     # Метод для получения количества активных пользователей (за последние 7 дней)
     async def get_active_users_count(self):
-        async with self.pool.acquire() as conn:
+        await self.flush_last_active()
+        async with self.acquire('get_active_users_count') as conn:
             async with conn.cursor() as cur:
                 await cur.execute(
-                    """
+                    f"""
                     SELECT COUNT(*) FROM users
-                    WHERE last_active >= NOW() - INTERVAL 7 DAY
+                    WHERE last_active >= {self.dialect.ago(7, 'DAY')}
                     """
                 )
                 active_users = (await cur.fetchone())[0]
@@ -392,7 +1077,8 @@ class Database:
 
     # Метод для получения неактивных пользователей (которые были активны до cutoff_time)
     async def get_inactive_users(self, cutoff_time):
-        async with self.pool.acquire() as conn:
+        await self.flush_last_active()
+        async with self.acquire('get_inactive_users') as conn:
             async with conn.cursor() as cur:
                 await cur.execute(
                     """
@@ -404,9 +1090,56 @@ class Database:
                 users = await cur.fetchall()
                 return [user[0] for user in users]
 
+    # Метод для пакетной выборки неактивных одобренных пользователей с количеством непросмотренных объявлений.
+    # Один сгруппированный запрос на пачку: объявления с ad_id больше отметки last_seen_ad_id пользователя.
+    # Пачки идут по user_id (keyset), соединение не удерживается, пока идет отправка уведомлений.
+    async def iter_users_with_unseen_ads(self, inactive_hours=24, batch_size=500):
+        await self.flush_last_active()
+        last_user_id = 0
+        while True:
+            async with self.acquire('iter_users_with_unseen_ads') as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(
+                        f"""
+                        SELECT u.user_id, COUNT(a.ad_id), MAX(a.ad_id)
+                        FROM users u
+                        JOIN ads a ON a.ad_id > u.last_seen_ad_id
+                        WHERE u.status='approved' AND u.last_active <= {self.dialect.ago('%s', 'HOUR')} AND u.user_id > %s
+                        GROUP BY u.user_id
+                        ORDER BY u.user_id
+                        LIMIT %s
+                        """,
+                        (inactive_hours, last_user_id, batch_size)
+                    )
+                    rows = await cur.fetchall()
+            for row in rows:
+                yield row
+            if len(rows) < batch_size:
+                return
+            last_user_id = rows[-1][0]
+
+    # Метод для сдвига отметки "последнее просмотренное объявление" для нескольких пользователей
+    # watermarks - {user_id: ad_id}; отметка только растет.
+    # last_active присваивается явно, иначе ON UPDATE CURRENT_TIMESTAMP посчитает пользователя активным
+    # (в SQLite его заменяет триггер, который last_seen_ad_id не отслеживает).
+    async def mark_ads_seen(self, watermarks):
+        if not watermarks:
+            return
+        items = list(watermarks.items())
+        cases = " ".join(f"WHEN %s THEN {self.dialect.greatest('last_seen_ad_id', '%s')}" for _ in items)
+        placeholders = ", ".join(["%s"] * len(items))
+        params = [value for item in items for value in item]
+        params.extend(user_id for user_id, _ in items)
+        async with self.acquire('mark_ads_seen') as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    f"UPDATE users SET last_seen_ad_id = CASE user_id {cases} END, last_active = last_active WHERE user_id IN ({placeholders})",
+                    params
+                )
+
     # Метод для обновления чекового file_id пользователя
     async def update_user_cheque(self, user_id, cheque_file_id):
-        async with self.pool.acquire() as conn:
+        async with self.acquire('update_user_cheque') as conn:
             async with conn.cursor() as cur:
                 try:
                     await cur.execute(
@@ -424,7 +1157,7 @@ class Database:
 
     # Метод для получения контактных данных пользователей (для экспорта)
     async def get_user_contacts_for_export(self):
-        async with self.pool.acquire() as conn:
+        async with self.acquire('get_user_contacts_for_export') as conn:
             async with conn.cursor(aiomysql.DictCursor) as cur:
                 await cur.execute(
                     """
@@ -433,4 +1166,47 @@ class Database:
                     """
                 )
                 contacts = await cur.fetchall()
-                return contacts
\ No newline at end of file
+                return contacts
+
+    # Метод для чтения сессии FSM: (state, data, bucket) или None (см. fsm_storage.py)
+    async def load_fsm_session(self, chat_id, user_id):
+        async with self.acquire('load_fsm_session') as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    "SELECT state, data, bucket FROM fsm_sessions WHERE chat_id=%s AND user_id=%s",
+                    (chat_id, user_id)
+                )
+                return await cur.fetchone()
+
+    # Метод для сохранения пачки сессий FSM: строки (chat_id, user_id, state, data, bucket)
+    async def save_fsm_sessions(self, rows):
+        async with self.acquire('save_fsm_sessions') as conn:
+            async with conn.cursor() as cur:
+                await cur.executemany(
+                    self.dialect.upsert(
+                        'fsm_sessions', ('chat_id', 'user_id', 'state', 'data', 'bucket'), ('chat_id', 'user_id'),
+                        ('state', 'data', 'bucket', ('updated_at', self.dialect.now()))
+                    ),
+                    rows
+                )
+
+    # Метод для удаления пустых сессий FSM по ключам (chat_id, user_id).
+    # Условие через OR, а не (chat_id, user_id) IN (...): SQLite не принимает список кортежей в IN.
+    async def delete_fsm_sessions(self, keys):
+        conditions = " OR ".join(["(chat_id=%s AND user_id=%s)"] * len(keys))
+        async with self.acquire('delete_fsm_sessions') as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    f"DELETE FROM fsm_sessions WHERE {conditions}",
+                    [value for key in keys for value in key]
+                )
+
+    # Метод для удаления сессий FSM, которые не менялись days дней; возвращает количество удаленных
+    async def delete_idle_fsm_sessions(self, days):
+        async with self.acquire('delete_idle_fsm_sessions') as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    f"DELETE FROM fsm_sessions WHERE updated_at < {self.dialect.ago('%s', 'DAY')}",
+                    (days,)
+                )
+                return cur.rowcount
@@ -0,0 +1,211 @@
+# db_metrics.py
+
+import logging
+import time
+from contextlib import asynccontextmanager
+
+from config import SLOW_QUERY_THRESHOLD_MS
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм: время в миллисекундах и количество строк
+TIME_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000)
+
+# Значение rowcount у потокового курсора (SSCursor), пока результат не прочитан целиком
+UNKNOWN_ROWCOUNT = 2 ** 64 - 1
+
+
+# Гистограмма с фиксированными корзинами: count/total/max и оценка перцентиля по верхней границе корзины
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'count', 'total', 'max')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.bounds) and value > self.bounds[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        if not self.count:
+            return 0
+        threshold = self.count * p / 100
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= threshold:
+                return self.bounds[index] if index < len(self.bounds) else self.max
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+
+# Метрики одного именованного запроса (имя - метод Database, например 'get_ads_page')
+class QueryStats:
+    __slots__ = ('name', 'wait', 'hold', 'execute', 'rows', 'slow')
+
+    def __init__(self, name):
+        self.name = name
+        self.wait = Histogram(TIME_BUCKETS_MS)     # ожидание соединения из пула, мс
+        self.hold = Histogram(TIME_BUCKETS_MS)     # время удержания соединения, мс
+        self.execute = Histogram(TIME_BUCKETS_MS)  # выполнение отдельных запросов, мс
+        self.rows = Histogram(ROW_BUCKETS)         # строк на запрос
+        self.slow = 0
+
+    def summary(self):
+        return {
+            'calls': self.hold.count,
+            'queries': self.execute.count,
+            'wait_p50_ms': self.wait.percentile(50),
+            'wait_p99_ms': self.wait.percentile(99),
+            'wait_max_ms': round(self.wait.max, 1),
+            'exec_p50_ms': self.execute.percentile(50),
+            'exec_p99_ms': self.execute.percentile(99),
+            'exec_max_ms': round(self.execute.max, 1),
+            'hold_total_ms': round(self.hold.total, 1),
+            'rows_mean': round(self.rows.mean, 1),
+            'rows_max': self.rows.max,
+            'slow': self.slow,
+        }
+
+
+# Форма параметров запроса без самих значений (в них бывают телефоны и тексты пользователей):
+# (5, 'abc', None) -> "tuple[3](int, str, NoneType)", список пачки -> "list[500](tuple[4])"
+def param_shape(params):
+    if params is None:
+        return "None"
+    if isinstance(params, (list, tuple)):
+        kinds = []
+        for value in params:
+            kind = param_shape(value) if isinstance(value, (list, tuple, dict)) else type(value).__name__
+            if kind not in kinds:
+                kinds.append(kind)
+        return f"{type(params).__name__}[{len(params)}]({', '.join(kinds)})"
+    if isinstance(params, dict):
+        return f"dict[{len(params)}]({', '.join(sorted(params))})"
+    return type(params).__name__
+
+
+class QueryMetrics:
+    def __init__(self, slow_threshold_ms: int = SLOW_QUERY_THRESHOLD_MS):
+        self.slow_threshold_ms = slow_threshold_ms
+        self._stats = {}
+
+    def stats(self, name):
+        stats = self._stats.get(name)
+        if stats is None:
+            stats = self._stats[name] = QueryStats(name)
+        return stats
+
+    # Соединение из пула с учетом ожидания и удержания; курсоры соединения измеряют каждый execute.
+    # connections - откуда брать соединение, по умолчанию сам пул (см. UnitOfWork в database.py)
+    @asynccontextmanager
+    async def acquire(self, pool, name, connections=None):
+        stats = self.stats(name)
+        started = time.perf_counter()
+        async with (connections or pool).acquire() as conn:
+            acquired = time.perf_counter()
+            wait_ms = (acquired - started) * 1000
+            stats.wait.observe(wait_ms)
+            if wait_ms > self.slow_threshold_ms:
+                logger.warning(
+                    f"Долгое ожидание соединения для {name}: {wait_ms:.0f} мс "
+                    f"(занято {pool.size - pool.freesize} из {pool.maxsize}), "
+                    f"дольше всего удерживают: {self.top_holders()}"
+                )
+            try:
+                yield InstrumentedConnection(conn, stats, self)
+            finally:
+                stats.hold.observe((time.perf_counter() - acquired) * 1000)
+
+    def observe_query(self, stats, query, params, elapsed_ms, rows):
+        stats.execute.observe(elapsed_ms)
+        if rows is not None:
+            stats.rows.observe(rows)
+        if elapsed_ms > self.slow_threshold_ms:
+            stats.slow += 1
+            statement = ' '.join(query.split())[:200]
+            logger.warning(
+                f"Медленный запрос {stats.name}: {elapsed_ms:.0f} мс, строк {rows if rows is not None else '?'}, "
+                f"параметры {param_shape(params)}: {statement}"
+            )
+
+    # Имена запросов с наибольшим суммарным временем удержания соединений
+    def top_holders(self, limit=3):
+        top = sorted(self._stats.values(), key=lambda stats: stats.hold.total, reverse=True)[:limit]
+        return ", ".join(f"{stats.name} ({stats.hold.total:.0f} мс)" for stats in top) or "нет данных"
+
+    def report(self, limit=None):
+        top = sorted(self._stats.values(), key=lambda stats: stats.hold.total, reverse=True)
+        return {stats.name: stats.summary() for stats in top[:limit]}
+
+
+class InstrumentedConnection:
+    def __init__(self, conn, stats, metrics):
+        self._conn = conn
+        self._stats = stats
+        self._metrics = metrics
+
+    def cursor(self, *cursor_classes):
+        return InstrumentedCursor(self._conn.cursor(*cursor_classes), self._stats, self._metrics)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+# Обертка курсора: замеряет execute/executemany, остальное передается курсору aiomysql.
+# У потокового курсора строки считаются по мере чтения и учитываются при закрытии.
+class InstrumentedCursor:
+    def __init__(self, cursor_context, stats, metrics):
+        self._cursor_context = cursor_context
+        self._cursor = None
+        self._stats = stats
+        self._metrics = metrics
+        self._streamed = None
+
+    async def __aenter__(self):
+        self._cursor = await self._cursor_context.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self._streamed is not None:
+            self._stats.rows.observe(self._streamed)
+        return await self._cursor_context.__aexit__(*exc_info)
+
+    async def execute(self, query, args=None):
+        return await self._measure(self._cursor.execute, query, args)
+
+    async def executemany(self, query, args):
+        return await self._measure(self._cursor.executemany, query, args)
+
+    async def _measure(self, method, query, args):
+        started = time.perf_counter()
+        try:
+            return await method(query, args)
+        finally:
+            rowcount = self._cursor.rowcount
+            rows = rowcount if rowcount is not None and 0 <= rowcount < UNKNOWN_ROWCOUNT else None
+            if rows is None and self._streamed is None:
+                self._streamed = 0
+            self._metrics.observe_query(self._stats, query, args, (time.perf_counter() - started) * 1000, rows)
+
+    async def fetchmany(self, size=None):
+        rows = await self._cursor.fetchmany(size)
+        if self._streamed is not None:
+            self._streamed += len(rows)
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
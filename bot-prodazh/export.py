@@ -0,0 +1,41 @@
+# export.py
+
+import asyncio
+import logging
+import tempfile
+
+from openpyxl import Workbook
+
+logger = logging.getLogger(__name__)
+
+CONTACT_HEADERS = ['Имя', 'Город', 'Телефон']
+
+
+def _append_rows(worksheet, rows):
+    for row in rows:
+        worksheet.append(list(row))
+
+
+# Потоковый экспорт контактов в XLSX.
+# Строки читаются из базы пачками (server-side cursor) и дописываются в write-only книгу
+# openpyxl в пуле потоков, поэтому цикл событий не блокируется, а память не растет с числом
+# пользователей. Каждый вызов пишет в свой временный файл; возвращает (файл, количество строк).
+# Файл нужно закрыть после отправки, при закрытии он удаляется.
+async def export_contacts_xlsx(db, batch_size=1000):
+    loop = asyncio.get_running_loop()
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet('Контакты')
+    worksheet.append(CONTACT_HEADERS)
+    count = 0
+    async for rows in db.iter_user_contacts(batch_size):
+        await loop.run_in_executor(None, _append_rows, worksheet, rows)
+        count += len(rows)
+    output = tempfile.TemporaryFile(suffix='.xlsx')
+    try:
+        await loop.run_in_executor(None, workbook.save, output)
+        output.seek(0)
+    except Exception:
+        output.close()
+        raise
+    logger.info(f"Экспортировано контактов: {count}.")
+    return output, count
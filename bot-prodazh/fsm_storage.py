@@ -0,0 +1,219 @@
+# fsm_storage.py
+
+import asyncio
+import copy
+import json
+import logging
+import time
+
+from aiogram.dispatcher.storage import BaseStorage
+
+from config import FSM_FLUSH_INTERVAL, FSM_HOT_TTL, FSM_SESSION_TTL_DAYS
+
+logger = logging.getLogger(__name__)
+
+# Как часто удалять из базы сессии, которые не менялись FSM_SESSION_TTL_DAYS дней
+IDLE_CLEANUP_INTERVAL = 3600
+
+
+class _Session:
+    __slots__ = ('state', 'data', 'bucket', 'loaded_at', 'touched_at')
+
+    def __init__(self, state=None, data=None, bucket=None):
+        self.state = state
+        self.data = data or {}
+        self.bucket = bucket or {}
+        self.loaded_at = self.touched_at = time.monotonic()
+
+    def is_empty(self):
+        return self.state is None and not self.data and not self.bucket
+
+
+# Хранилище состояний FSM в базе данных (таблица fsm_sessions) вместо MemoryStorage.
+# Сессии читаются в память при первом обращении (горячий слой) и доверяются ему hot_ttl секунд,
+# изменения копятся и записываются в базу пачкой раз в flush_interval секунд.
+# Сессии, к которым не обращались дольше hot_ttl, вытесняются из памяти после записи.
+# Для нескольких реплик бота задайте FSM_HOT_TTL=0 и FSM_FLUSH_INTERVAL=0: тогда каждое чтение
+# идет в базу, а каждое изменение записывается сразу.
+class DatabaseStorage(BaseStorage):
+    def __init__(self, db, flush_interval: int = FSM_FLUSH_INTERVAL, hot_ttl: int = FSM_HOT_TTL,
+                 session_ttl_days: int = FSM_SESSION_TTL_DAYS):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.hot_ttl = hot_ttl
+        self.session_ttl_days = session_ttl_days
+        self.hits = 0
+        self.misses = 0
+        self._sessions = {}
+        self._dirty = set()
+        self._task = None
+        self._closed = False
+        self._last_cleanup = time.monotonic()
+
+    def _key(self, chat, user):
+        chat, user = self.check_address(chat=chat, user=user)
+        return int(chat), int(user)
+
+    async def _session(self, chat, user):
+        key = self._key(chat, user)
+        session = self._sessions.get(key)
+        now = time.monotonic()
+        if session is not None and (key in self._dirty or now - session.loaded_at < self.hot_ttl):
+            self.hits += 1
+            session.touched_at = now
+            return key, session
+        self.misses += 1
+        row = await self.db.load_fsm_session(*key)
+        current = self._sessions.get(key)
+        if current is not None and current is not session:
+            # Пока читали из базы, сессию загрузил или изменил другой обработчик - она свежее
+            return key, current
+        if row:
+            state, data, bucket = row
+            session = _Session(state, json.loads(data) if data else {}, json.loads(bucket) if bucket else {})
+        else:
+            session = _Session()
+        self._sessions[key] = session
+        return key, session
+
+    async def _changed(self, key, session):
+        session.loaded_at = session.touched_at = time.monotonic()
+        self._dirty.add(key)
+        if not self.flush_interval:
+            await self.flush()
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        _, session = await self._session(chat, user)
+        return session.state if session.state is not None else self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        _, session = await self._session(chat, user)
+        return copy.deepcopy(session.data)
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        key, session = await self._session(chat, user)
+        session.state = self.resolve_state(state)
+        await self._changed(key, session)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        key, session = await self._session(chat, user)
+        session.data = copy.deepcopy(data) if data else {}
+        await self._changed(key, session)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        key, session = await self._session(chat, user)
+        session.data.update(copy.deepcopy(data or {}), **copy.deepcopy(kwargs))
+        await self._changed(key, session)
+
+    async def reset_state(self, *, chat=None, user=None, with_data=True):
+        key, session = await self._session(chat, user)
+        session.state = None
+        if with_data:
+            session.data = {}
+        await self._changed(key, session)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None):
+        _, session = await self._session(chat, user)
+        return copy.deepcopy(session.bucket)
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        key, session = await self._session(chat, user)
+        session.bucket = copy.deepcopy(bucket) if bucket else {}
+        await self._changed(key, session)
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        key, session = await self._session(chat, user)
+        session.bucket.update(copy.deepcopy(bucket or {}), **copy.deepcopy(kwargs))
+        await self._changed(key, session)
+
+    # Запись измененных сессий одной пачкой; пустые сессии удаляются из базы
+    async def flush(self):
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        rows, empty = [], []
+        for key in keys:
+            session = self._sessions.get(key)
+            if session is None:
+                continue
+            if session.is_empty():
+                empty.append(key)
+                continue
+            try:
+                rows.append((*key, session.state, json.dumps(session.data), json.dumps(session.bucket)))
+            except (TypeError, ValueError) as e:
+                # Такая сессия остается только в памяти, остальные сохраняются
+                logger.error(f"Данные FSM пользователя {key[1]} в чате {key[0]} не сериализуются в JSON: {e}")
+        try:
+            if rows:
+                await self.db.save_fsm_sessions(rows)
+            if empty:
+                await self.db.delete_fsm_sessions(empty)
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении состояний FSM: {e}")
+            self._dirty |= keys
+            raise
+
+    # Вытеснение из памяти сессий без обращений дольше hot_ttl (только уже записанных)
+    def evict_idle(self):
+        now = time.monotonic()
+        idle = [
+            key for key, session in self._sessions.items()
+            if key not in self._dirty and now - session.touched_at >= self.hot_ttl
+        ]
+        for key in idle:
+            del self._sessions[key]
+        return len(idle)
+
+    async def _flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_interval or 1)
+            try:
+                await self.flush()
+            except Exception:
+                continue  # Ошибка уже залогирована, сессии остались в очереди на запись
+            self.evict_idle()
+            if time.monotonic() - self._last_cleanup >= IDLE_CLEANUP_INTERVAL:
+                self._last_cleanup = time.monotonic()
+                try:
+                    deleted = await self.db.delete_idle_fsm_sessions(self.session_ttl_days)
+                    if deleted:
+                        logger.info(f"Удалено {deleted} сессий FSM без изменений дольше {self.session_ttl_days} дней.")
+                except Exception as e:
+                    logger.error(f"Ошибка при удалении старых сессий FSM: {e}")
+
+    # Запуск фоновой записи и вытеснения (после подключения к базе)
+    def start_flusher(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flusher())
+
+    # Закрытие вызывается дважды: из on_shutdown до закрытия пула и потом из executor (или webhook.py),
+    # когда пул уже закрыт. Записывает только первое
+    async def close(self):
+        if self._closed:
+            if self._dirty:
+                logger.warning(f"Хранилище FSM уже закрыто, не записано изменений сессий: {len(self._dirty)}.")
+            return
+        self._closed = True
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._dirty and self.db.pool:
+            try:
+                await self.flush()
+            except Exception:
+                pass  # Ошибка уже залогирована
+
+    async def wait_closed(self):
+        pass
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'sessions': len(self._sessions),
+            'dirty': len(self._dirty),
+        }
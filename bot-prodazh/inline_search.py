@@ -0,0 +1,116 @@
+# inline_search.py
+
+import asyncio
+import logging
+import time
+
+from aiogram import types
+from aiogram.utils.exceptions import BadRequest
+
+from config import INLINE_CACHE_TIME, INLINE_DEBOUNCE_MS, INLINE_PAGE_SIZE
+from db_metrics import Histogram, TIME_BUCKETS_MS
+from search import SearchQuery
+
+logger = logging.getLogger(__name__)
+
+
+class InlineSearchStats:
+    def __init__(self):
+        self.answered = 0
+        self.superseded = 0
+        self.failed = 0
+        self.latency = Histogram(TIME_BUCKETS_MS)  # от получения запроса до ответа Telegram, мс
+
+
+# Ответы на inline-запросы "@bot camry 2018" из поискового индекса каталога (Database.search_ads_page).
+# Пока пользователь печатает, Telegram присылает запрос на каждое изменение текста. Новый запрос
+# пользователя заменяет его предыдущий, еще не отвеченный: ответ на устаревший текст никто не увидит.
+# Перед поиском запрос ждет debounce_ms, чтобы серия быстрых нажатий клавиш дала один ответ.
+# Страница - page_size результатов, следующая запрашивается клиентом по next_offset.
+# Поиск идет в задаче обработчика апдейта, а не в отдельной: обработчик держит соединение единицы
+# работы (get_user_status), и ожидание чужой задачи, которой самой нужно соединение из пула,
+# при пустом кэше каталога и пуле, занятом такими же обработчиками, никогда бы не закончилось.
+# Замененный запрос поэтому не отменяется, а сам сдается, когда видит, что он уже не последний.
+class InlineSearch:
+    def __init__(self, db, caption, page_size: int = INLINE_PAGE_SIZE, cache_time: int = INLINE_CACHE_TIME,
+                 debounce_ms: int = INLINE_DEBOUNCE_MS):
+        self.db = db
+        self.caption = caption  # подпись объявления, та же, что в каталоге бота
+        self.page_size = min(page_size, 50)  # Telegram принимает не больше 50 результатов
+        self.cache_time = cache_time
+        self.debounce = debounce_ms / 1000
+        self.stats = InlineSearchStats()
+        self._latest = {}  # user_id -> id последнего inline-запроса пользователя
+
+    async def handle(self, inline_query: types.InlineQuery, is_personal: bool):
+        started = time.perf_counter()
+        user_id = inline_query.from_user.id
+        debounce = user_id in self._latest
+        self._latest[user_id] = inline_query.id
+        try:
+            answered = await self._answer(inline_query, is_personal, debounce)
+        except Exception as e:
+            self.stats.failed += 1
+            logger.error(f"Ошибка при ответе на inline-запрос пользователя {user_id}: {e}")
+            return
+        finally:
+            if self._latest.get(user_id) == inline_query.id:
+                del self._latest[user_id]
+        if not answered:
+            self.stats.superseded += 1
+            return
+        self.stats.answered += 1
+        self.stats.latency.observe((time.perf_counter() - started) * 1000)
+
+    def _superseded(self, inline_query):
+        return self._latest.get(inline_query.from_user.id) != inline_query.id
+
+    # Первый запрос серии отвечается сразу, следующие ждут debounce: отдельный запрос пользователя
+    # не теряет время, а быстрый набор текста заменяет ожидающий запрос, не доходя до поиска.
+    # Возвращает False, если запрос заменен следующим и ответ не отправлялся.
+    async def _answer(self, inline_query, is_personal, debounce):
+        if debounce and self.debounce:
+            await asyncio.sleep(self.debounce)
+        if self._superseded(inline_query):
+            return False
+        offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+        try:
+            query = SearchQuery.parse(inline_query.query)
+        except ValueError:
+            # Незаконченный фильтр вроде "цена:5000" - пустой ответ, клиент пришлет следующий текст
+            await self._send(inline_query, [], '', is_personal)
+            return True
+        ads, has_more = await self.db.search_ads_page(query, offset=offset, limit=self.page_size)
+        if self._superseded(inline_query):
+            return False
+        next_offset = str(offset + len(ads)) if has_more else ''
+        await self._send(inline_query, [self.result(ad) for ad in ads], next_offset, is_personal)
+        return True
+
+    async def _send(self, inline_query, results, next_offset, is_personal):
+        try:
+            await inline_query.answer(results, cache_time=self.cache_time, is_personal=is_personal,
+                                      next_offset=next_offset)
+        except BadRequest as e:
+            # Запрос устарел (пользователь уже ввел другой текст или ответ опоздал) - отвечать некому
+            logger.info(f"Inline-запрос {inline_query.id} не принят Telegram: {e}")
+
+    def result(self, ad):
+        caption = self.caption(ad)
+        if ad['cover_photo']:
+            return types.InlineQueryResultCachedPhoto(
+                id=str(ad['ad_id']), photo_file_id=ad['cover_photo'], title=ad['title'], caption=caption,
+            )
+        return types.InlineQueryResultArticle(
+            id=str(ad['ad_id']), title=ad['title'], description=f"{ad['year']}, {ad['price']} KZT",
+            input_message_content=types.InputTextMessageContent(caption),
+        )
+
+    def inline_stats(self):
+        return {
+            'answered': self.stats.answered,
+            'superseded': self.stats.superseded,
+            'failed': self.stats.failed,
+            'latency_p50_ms': self.stats.latency.percentile(50),
+            'latency_p99_ms': self.stats.latency.percentile(99),
+        }
@@ -0,0 +1,144 @@
+# lanes.py
+
+import asyncio
+import logging
+import time
+
+from aiogram import Dispatcher
+
+from config import LANE_DRAIN_TIMEOUT, LANE_QUEUE_SIZE
+from db_metrics import Histogram, TIME_BUCKETS_MS
+
+logger = logging.getLogger(__name__)
+
+# Апдейты, которые не трогают FSM и должны отвечаться сразу, идут мимо очередей
+BYPASS_LANES = ('inline_query', 'chosen_inline_result')
+
+
+# Пользователь апдейта: по нему апдейты раскладываются по очередям.
+# Для апдейтов без пользователя (посты каналов) - чат, для остальных None (без очереди).
+def lane_key(update):
+    for name in BYPASS_LANES:
+        if getattr(update, name):
+            return None
+    for event in (update.message, update.edited_message, update.callback_query, update.shipping_query,
+                  update.pre_checkout_query, update.my_chat_member, update.chat_member, update.chat_join_request):
+        if event and event.from_user:
+            return event.from_user.id
+    for message in (update.channel_post, update.edited_channel_post):
+        if message:
+            return message.chat.id
+    return None
+
+
+class LaneStats:
+    def __init__(self):
+        self.processed = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.max_lanes = 0
+        self.wait = Histogram(TIME_BUCKETS_MS)  # от постановки в очередь до начала обработки, мс
+
+
+# Диспетчер с очередями по пользователям: апдейты одного пользователя обрабатываются строго
+# по порядку (быстрые нажатия "Следующее »", альбомы фото в AdStates.photos не гоняются за данными FSM),
+# разные пользователи - параллельно. Очередь пользователя ограничена lane_queue_size: лишние апдейты
+# при переполнении отбрасываются, чтобы один пользователь не задерживал обработку остальных.
+# Очередь и ее задача существуют, только пока в очереди есть апдейты.
+class LaneDispatcher(Dispatcher):
+    def __init__(self, *args, lane_queue_size: int = LANE_QUEUE_SIZE, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lane_queue_size = lane_queue_size
+        self.lane_stats = LaneStats()
+        self._lanes = {}
+        self._lane_tasks = set()
+        self._direct_tasks = set()
+
+    async def process_updates(self, updates, fast: bool = True):
+        futures = []
+        for update in updates:
+            key = lane_key(update)
+            if key is None:
+                task = asyncio.ensure_future(self.updates_handler.notify(update))
+                self._direct_tasks.add(task)
+                task.add_done_callback(self._direct_tasks.discard)
+                futures.append(task)
+            else:
+                futures.append(self._enqueue(key, update))
+        return await asyncio.gather(*futures)
+
+    def _enqueue(self, key, update):
+        future = asyncio.get_running_loop().create_future()
+        queue = self._lanes.get(key)
+        if queue is None:
+            queue = self._lanes[key] = asyncio.Queue(maxsize=self.lane_queue_size)
+            task = asyncio.create_task(self._run_lane(key, queue))
+            self._lane_tasks.add(task)
+            task.add_done_callback(self._lane_tasks.discard)
+            self.lane_stats.max_lanes = max(self.lane_stats.max_lanes, len(self._lanes))
+        try:
+            queue.put_nowait((update, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.lane_stats.dropped += 1
+            logger.warning(f"Очередь пользователя {key} переполнена ({queue.qsize()}), апдейт {update.update_id} отброшен.")
+            future.set_result([])
+            return future
+        self.lane_stats.max_depth = max(self.lane_stats.max_depth, queue.qsize())
+        return future
+
+    async def _run_lane(self, key, queue):
+        try:
+            while True:
+                try:
+                    update, future, enqueued_at = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                self.lane_stats.wait.observe((time.perf_counter() - enqueued_at) * 1000)
+                try:
+                    result = await self.updates_handler.notify(update)
+                except asyncio.CancelledError:
+                    future.cancel()
+                    raise
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+                finally:
+                    self.lane_stats.processed += 1
+        finally:
+            # Без await между проверкой пустой очереди и удалением: новый апдейт создаст очередь заново
+            if self._lanes.get(key) is queue:
+                del self._lanes[key]
+            while not queue.empty():
+                _, future, _ = queue.get_nowait()
+                future.cancel()
+
+    # Дождаться обработки начатых и стоящих в очередях апдейтов перед закрытием хранилища и пула.
+    # Вызывается после остановки приема апдейтов; не успевшие за timeout секунд задачи отменяются.
+    async def drain(self, timeout: float = LANE_DRAIN_TIMEOUT):
+        tasks = self._lane_tasks | self._direct_tasks
+        if not tasks:
+            return
+        queued = sum(queue.qsize() for queue in self._lanes.values())
+        logger.info(f"Ожидание обработки апдейтов перед остановкой: задач {len(tasks)}, в очередях {queued}.")
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        if pending:
+            for task in pending:
+                task.cancel()
+            await asyncio.wait(pending)
+            logger.warning(f"Не дождались обработки апдейтов за {timeout} с, отменено задач: {len(pending)}.")
+
+    def lanes_stats(self):
+        depths = [queue.qsize() for queue in self._lanes.values()]
+        return {
+            'active_lanes': len(depths),
+            'queued': sum(depths),
+            'deepest_lane': max(depths, default=0),
+            'max_depth': self.lane_stats.max_depth,
+            'max_lanes': self.lane_stats.max_lanes,
+            'processed': self.lane_stats.processed,
+            'dropped': self.lane_stats.dropped,
+            'wait_p50_ms': self.lane_stats.wait.percentile(50),
+            'wait_p99_ms': self.lane_stats.wait.percentile(99),
+            'wait_max_ms': round(self.lane_stats.wait.max, 1),
+        }
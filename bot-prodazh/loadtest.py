@@ -0,0 +1,407 @@
+# loadtest.py
+#
+# Нагрузочный прогон бота без Telegram и MySQL:
+#   python loadtest.py --users 200 --journeys 3 --ads 500 --json before.json
+# Поднимает локальную замену Bot API (FakeBotAPI), базу SQLite во временном файле, заполняет ее
+# объявлениями и прогоняет сценарии пользователей (регистрация, каталог, избранное, подписка, покупка)
+# через dp.process_updates со всеми middleware. В отчете - пропускная способность, p50/p99 обработки
+# апдейта по шагам сценариев, запросы к базе на апдейт и вызовы Bot API. Два отчета --json удобно
+# сравнивать до и после изменения.
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer
+from aiohttp import web
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'LoadTestBot', 'username': 'loadtest_bot'}
+
+# Методы Bot API, которые возвращают отправленное или измененное сообщение
+MESSAGE_METHODS = (
+    'sendmessage', 'sendphoto', 'senddocument', 'editmessagetext', 'editmessagecaption',
+    'editmessagemedia', 'editmessagereplymarkup',
+)
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+# Замена Bot API на aiohttp: отвечает правдоподобными объектами, считает вызовы и время ответа
+# по методам и помнит последнюю inline-клавиатуру в каждом чате, чтобы сценарии нажимали ее кнопки.
+class FakeBotAPI:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.timings = defaultdict(list)
+        self.keyboards = {}
+        self._message_ids = itertools.count(1)
+
+    async def handle(self, request: web.Request):
+        started = time.perf_counter()
+        method = request.match_info['method'].lower()
+        params = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        result = self.result(method, params)
+        self.calls[method] += 1
+        self.timings[method].append((time.perf_counter() - started) * 1000)
+        return web.json_response({'ok': True, 'result': result})
+
+    def _message(self, chat_id, message_id=None, **fields):
+        message = {
+            'message_id': message_id or next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+        }
+        message.update(fields)
+        return message
+
+    def _remember_keyboard(self, chat_id, message_id, params):
+        markup = json.loads(params['reply_markup']) if params.get('reply_markup') else {}
+        if 'inline_keyboard' in markup:
+            self.keyboards[chat_id] = (message_id, markup['inline_keyboard'])
+
+    def result(self, method, params):
+        if method == 'getme':
+            return BOT_USER
+        if method == 'getupdates':
+            return []
+        if method == 'sendmediagroup':
+            chat_id = int(params['chat_id'])
+            return [
+                self._message(chat_id, photo=[{'file_id': item['media'], 'file_unique_id': item['media'], 'width': 1280, 'height': 960}])
+                for item in json.loads(params['media'])
+            ]
+        if method not in MESSAGE_METHODS:
+            return True
+        if 'chat_id' not in params:
+            return True  # Редактирование inline-сообщения
+        chat_id = int(params['chat_id'])
+        message_id = int(params['message_id']) if method.startswith('edit') else None
+        fields = {}
+        if method == 'sendphoto':
+            fields['photo'] = [{'file_id': params['photo'], 'file_unique_id': params['photo'], 'width': 1280, 'height': 960}]
+        if params.get('caption'):
+            fields['caption'] = params['caption']
+        if params.get('text'):
+            fields['text'] = params['text']
+        message = self._message(chat_id, message_id, **fields)
+        self._remember_keyboard(chat_id, message['message_id'], params)
+        return message
+
+    # Кнопка последней inline-клавиатуры чата с callback_data, начинающейся с prefix
+    def find_button(self, chat_id, prefix):
+        message_id, keyboard = self.keyboards.get(chat_id, (None, []))
+        for row in keyboard:
+            for button in row:
+                if button.get('callback_data', '').startswith(prefix):
+                    return message_id, button['callback_data']
+        return None, None
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+
+# Сценарии пользователей: ('text', текст сообщения), ('press', префикс callback_data кнопки)
+# или ('inline', текст inline-запроса, набираемый по буквам: запрос на каждую букву через TYPING_INTERVAL)
+TYPING_INTERVAL = 0.02
+INLINE_BURST_TIMEOUT = 10  # с, см. LoadTest.inline_cold_burst
+REGISTRATION = [
+    ('text', '/start'),
+    ('text', 'Иван'),
+    ('text', '+77010000000'),
+    ('text', 'Алматы'),
+]
+JOURNEYS = {
+    'browse': [
+        ('text', 'Список всех объявлений'),
+        ('press', 'next_ad'),
+        ('press', 'next_ad'),
+        ('press', 'next_ad'),
+        ('press', 'prev_ad'),
+    ],
+    'favorite': [
+        ('text', 'Список всех объявлений'),
+        ('press', 'next_ad'),
+        ('press', 'add_fav_'),
+        ('text', 'Избранные объявления'),
+        ('press', 'remove_fav_'),
+    ],
+    'subscribe': [
+        ('text', 'Подписки'),
+        ('text', 'Создать подписку'),
+        ('text', 'Toyota'),
+        ('text', '0'),
+        ('text', '20000000'),
+        ('text', '2015'),
+        ('text', '0'),
+        ('text', 'Мои подписки'),
+    ],
+    'buy': [
+        ('text', 'Список всех объявлений'),
+        ('press', 'description_'),
+        ('press', 'show_photos_'),
+        ('press', 'inspection_'),
+        ('press', 'buy_'),
+        ('press', 'discount_'),
+        ('text', '99999999'),
+    ],
+    'search': [
+        ('text', 'Поиск'),
+        ('text', 'toyota цена:<20000000 сорт:дешевые'),
+        ('press', 'next_ad'),
+        ('press', 'prev_ad'),
+    ],
+    'inline': [
+        ('inline', 'camry'),
+        ('inline', 'kia 2020'),
+    ],
+}
+
+
+class LoadTest:
+    def __init__(self, dp, api: FakeBotAPI):
+        self.dp = dp
+        self.api = api
+        self.latencies = defaultdict(list)
+        self.errors = 0
+        self.skipped = 0
+        self._update_ids = itertools.count(1)
+
+    def _user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}", 'username': f"user{user_id}"}
+
+    def _update(self, user_id, kind, value):
+        update_id = next(self._update_ids)
+        if kind == 'text':
+            return {'update_id': update_id, 'message': {
+                'message_id': update_id, 'date': int(time.time()), 'text': value,
+                'chat': {'id': user_id, 'type': 'private'}, 'from': self._user(user_id),
+            }}
+        message_id, data = self.api.find_button(user_id, value)
+        if data is None:
+            return None
+        return {'update_id': update_id, 'callback_query': {
+            'id': str(update_id), 'from': self._user(user_id), 'chat_instance': str(user_id), 'data': data,
+            'message': {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'}, 'from': BOT_USER},
+        }}
+
+    def _inline_update(self, user_id, text):
+        update_id = next(self._update_ids)
+        return types.Update(**{'update_id': update_id, 'inline_query': {
+            'id': str(update_id), 'from': self._user(user_id), 'query': text, 'offset': '',
+        }})
+
+    # Набор текста inline-запроса: апдейты приходят, не дожидаясь ответа на предыдущие
+    async def _type_inline(self, user_id, text):
+        tasks = []
+        for length in range(1, len(text) + 1):
+            tasks.append(asyncio.create_task(self.dp.process_updates([self._inline_update(user_id, text[:length])])))
+            await asyncio.sleep(TYPING_INTERVAL)
+        await asyncio.gather(*tasks)
+
+    async def run_steps(self, user_id, steps):
+        for kind, value in steps:
+            if kind == 'inline':
+                step = self._type_inline(user_id, value)
+            else:
+                update = self._update(user_id, kind, value)
+                if update is None:
+                    self.skipped += 1  # Нужной кнопки нет (например, "Следующее »" на последнем объявлении)
+                    continue
+                step = self.dp.process_updates([types.Update(**update)])
+            started = time.perf_counter()
+            try:
+                await step
+            except Exception as e:
+                self.errors += 1
+                logging.getLogger(__name__).error(f"Ошибка при обработке шага {kind}:{value} пользователя {user_id}: {e}")
+            self.latencies[f"{kind}:{value}"].append((time.perf_counter() - started) * 1000)
+
+    # Регрессия зависания inline-поиска: кэш каталога сброшен, и одновременных inline-запросов больше,
+    # чем соединений в пуле. Каждый обработчик держит соединение единицы работы и должен достроить
+    # индекс на нем же, не дожидаясь соединения для другой задачи. Возвращает время ответов, мс.
+    async def inline_cold_burst(self, db, user_ids, timeout):
+        db.ads_cache.invalidate()
+        updates = [self._inline_update(user_id, 'toyota') for user_id in user_ids]
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.gather(*(self.dp.process_updates([update]) for update in updates)), timeout)
+        except asyncio.TimeoutError:
+            raise RuntimeError(f"{len(updates)} inline-запросов при пустом кэше каталога не получили ответ "
+                               f"за {timeout} с (пул {db.pool.maxsize} соединений)") from None
+        return (time.perf_counter() - started) * 1000
+
+    async def run_user(self, user_id, journeys, rng, semaphore):
+        async with semaphore:
+            await self.run_steps(user_id, REGISTRATION)
+            for name in rng.choices(list(JOURNEYS), k=journeys):
+                await self.run_steps(user_id, JOURNEYS[name])
+
+
+async def seed_ads(db, count, rng):
+    models = ['Toyota Camry', 'Hyundai Tucson', 'Kia Sportage', 'Lexus RX', 'Chevrolet Cobalt', 'Volkswagen Polo']
+    for number in range(count):
+        model = rng.choice(models)
+        await db.add_ad(
+            title=f"{model} #{number}", price=rng.randrange(3_000_000, 40_000_000, 10_000),
+            description=f"Тестовое объявление {number}", photos=[f"photo-{number}-{index}" for index in range(3)],
+            inspection_photos=[f"inspection-{number}-0"], thickness_photos=[f"thickness-{number}-0"],
+            model=model, year=rng.randint(2005, 2024),
+        )
+
+
+async def run(args):
+    # Импорт после настройки окружения: конфигурация читается при импорте
+    import main_bot
+    from db_metrics import QueryMetrics
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    api = FakeBotAPI(latency=args.api_latency / 1000)
+    runner = web.AppRunner(api.make_app())
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    main_bot.bot.server = TelegramAPIServer.from_base(f"http://127.0.0.1:{port}")
+    Bot.set_current(main_bot.bot)
+    Dispatcher.set_current(main_bot.dp)
+
+    db = main_bot.db
+    rng = random.Random(args.seed)
+    await main_bot.on_startup(main_bot.dp)
+    if db.pool is None:
+        raise RuntimeError("database is not connected, see the log above")
+    try:
+        await db.set_bot_state(True)
+        await seed_ads(db, args.ads, rng)
+        # Метрики считаются только для прогона, без заполнения базы
+        db.metrics = QueryMetrics()
+        db.unit_of_work_stats.update(units=0, connections=0, reuses=0)
+        api.calls.clear()
+        api.timings.clear()
+
+        test = LoadTest(main_bot.dp, api)
+        semaphore = asyncio.Semaphore(args.concurrency)
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            test.run_user(1_000_000 + number, args.journeys, random.Random(rng.random()), semaphore)
+            for number in range(args.users)
+        ))
+        elapsed = time.perf_counter() - started
+        inline_stats = main_bot.inline_search.inline_stats()
+        user_ids = [1_000_000 + number for number in range(min(args.users, db.pool.maxsize * 3))]
+        burst_ms = await test.inline_cold_burst(db, user_ids, INLINE_BURST_TIMEOUT)
+        report = build_report(test, api, db, main_bot.dp, elapsed, inline_stats)
+        report['inline_cold_burst'] = {'queries': len(user_ids), 'ms': round(burst_ms, 1)}
+    finally:
+        await main_bot.on_shutdown(main_bot.dp)
+        session = await main_bot.bot.get_session()
+        await session.close()
+        await runner.cleanup()
+    return report
+
+
+def build_report(test, api, db, dp, elapsed, inline_stats=None):
+    all_latencies = [value for values in test.latencies.values() for value in values]
+    updates = len(all_latencies)
+    queries = sum(stats['queries'] for stats in db.metrics.report().values())
+    return {
+        'updates': updates,
+        'errors': test.errors,
+        'skipped_steps': test.skipped,
+        'seconds': round(elapsed, 2),
+        'updates_per_second': round(updates / elapsed, 1) if elapsed else 0,
+        'p50_ms': round(percentile(all_latencies, 50), 1),
+        'p99_ms': round(percentile(all_latencies, 99), 1),
+        'max_ms': round(max(all_latencies, default=0), 1),
+        'queries_per_update': round(queries / updates, 2) if updates else 0,
+        'connections_per_update': round(db.unit_of_work_stats['connections'] / updates, 2) if updates else 0,
+        'api_calls_per_update': round(sum(api.calls.values()) / updates, 2) if updates else 0,
+        'steps': {
+            step: {'count': len(values), 'p50_ms': round(percentile(values, 50), 1), 'p99_ms': round(percentile(values, 99), 1)}
+            for step, values in sorted(test.latencies.items())
+        },
+        'api': {
+            method: {'calls': api.calls[method], 'p50_ms': round(percentile(values, 50), 1), 'p99_ms': round(percentile(values, 99), 1)}
+            for method, values in sorted(api.timings.items())
+        },
+        'queries': db.metrics.report(limit=10),
+        'lanes': dp.lanes_stats(),
+        'inline': inline_stats,
+    }
+
+
+def print_report(report):
+    print(f"Апдейтов: {report['updates']} за {report['seconds']} с - {report['updates_per_second']} апдейтов/с, "
+          f"ошибок {report['errors']}, пропущено шагов {report['skipped_steps']}")
+    print(f"Обработка апдейта: p50 {report['p50_ms']} мс, p99 {report['p99_ms']} мс, max {report['max_ms']} мс")
+    print(f"На апдейт: запросов к базе {report['queries_per_update']}, соединений {report['connections_per_update']}, "
+          f"вызовов Bot API {report['api_calls_per_update']}")
+    if report['inline']:
+        inline = report['inline']
+        print(f"Inline-запросы: отвечено {inline['answered']}, заменено следующими {inline['superseded']}, "
+              f"ошибок {inline['failed']}, ответ p50 {inline['latency_p50_ms']} мс, p99 {inline['latency_p99_ms']} мс")
+    if report.get('inline_cold_burst'):
+        burst = report['inline_cold_burst']
+        print(f"Inline-запросы при пустом кэше каталога: {burst['queries']} одновременно, все отвечены за {burst['ms']} мс")
+    print("\nШаги сценариев:")
+    for step, stats in report['steps'].items():
+        print(f"  {step:<40} {stats['count']:>6}  p50 {stats['p50_ms']:>7} мс  p99 {stats['p99_ms']:>7} мс")
+    print("\nBot API:")
+    for method, stats in report['api'].items():
+        print(f"  {method:<40} {stats['calls']:>6}  p50 {stats['p50_ms']:>7} мс  p99 {stats['p99_ms']:>7} мс")
+    print("\nЗапросы к базе (по суммарному удержанию соединения):")
+    for name, stats in report['queries'].items():
+        print(f"  {name:<40} {stats['queries']:>6}  exec p99 {stats['exec_p99_ms']:>5} мс  удержание {stats['hold_total_ms']} мс")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота с локальной заменой Bot API")
+    parser.add_argument('--users', type=int, default=100, help="количество пользователей")
+    parser.add_argument('--journeys', type=int, default=3, help="сценариев на пользователя после регистрации")
+    parser.add_argument('--concurrency', type=int, default=50, help="пользователей одновременно")
+    parser.add_argument('--ads', type=int, default=200, help="объявлений в каталоге")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="задержка ответа Bot API, мс")
+    parser.add_argument('--seed', type=int, default=1, help="зерно случайных сценариев")
+    parser.add_argument('--json', help="сохранить отчет в JSON-файл")
+    parser.add_argument('--db-from-env', action='store_true',
+                        help="использовать базу из переменных окружения вместо временного файла SQLite "
+                             "(в нее будут записаны тестовые данные)")
+    parser.add_argument('--verbose', action='store_true', help="не приглушать логи бота")
+    args = parser.parse_args()
+
+    os.environ['MAIN_BOT_TOKEN'] = '123456:LOADTEST'
+    os.environ['MANAGER_IDS'] = '2'
+    os.environ['ADMIN_IDS'] = ''
+    sqlite_dir = None
+    if not args.db_from_env:
+        sqlite_dir = tempfile.TemporaryDirectory()
+        os.environ['DB_BACKEND'] = 'sqlite'
+        os.environ['SQLITE_PATH'] = os.path.join(sqlite_dir.name, 'loadtest.sqlite3')
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        if sqlite_dir:
+            sqlite_dir.cleanup()
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
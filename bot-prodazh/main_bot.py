@@ -1,20 +1,31 @@
 # main_bot.py
 
 import logging
-import os
-import pandas as pd
 import asyncio
-from datetime import datetime, timedelta
-from aiogram import Bot, Dispatcher, executor, types
-from aiogram.types import MediaGroup, InputMediaPhoto, InputFile
+import signal
+import sys
+from datetime import datetime
+from aiogram import Bot, executor, types
+from aiogram.types import InputFile
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.dispatcher import FSMContext
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.dispatcher.handler import CancelHandler
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from pytz import utc
-from config import MAIN_BOT_TOKEN, ADMIN_IDS, MANAGER_IDS
+from config import MAIN_BOT_TOKEN, ADMIN_IDS, MANAGER_IDS, RUN_MODE
 from database import Database
+from broadcast import Broadcaster, run_broadcast_job
+from export import export_contacts_xlsx
+from migrations import apply_migrations
+from webhook import start_webhook
+from catchup import UpdateWatermark, catch_up
+from lanes import LaneDispatcher
+from fsm_storage import DatabaseStorage
+from inline_search import InlineSearch
+from ad_cards import AdCardCache, ad_caption
+from message_views import MessageEditPlanner
+from search import SearchQuery
 from aiogram.utils.exceptions import Throttled
 
 # Configure logging
@@ -23,10 +34,29 @@ logger = logging.getLogger(__name__)
 
 # Initialize bot and dispatcher
 bot = Bot(token=MAIN_BOT_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(bot, storage=storage)
 db = Database()
+# Состояния FSM хранятся в базе и переживают перезапуск
+storage = DatabaseStorage(db)
+# Апдейты одного пользователя обрабатываются по порядку, разных пользователей - параллельно
+dp = LaneDispatcher(bot, storage=storage)
 scheduler = AsyncIOScheduler(timezone=utc)
+broadcaster = Broadcaster(bot)
+# Готовые карточки объявлений: подпись, клавиатура и наборы фото собираются один раз на объявление
+ad_cards = AdCardCache(db)
+# Сообщения каталога правятся минимальным вызовом: смена избранного меняет только кнопки
+message_edits = MessageEditPlanner()
+
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора до завершения
+background_tasks = set()
+
+# Отметка обработанных апдейтов: отсекает повторы после перезапуска и повторной доставки вебхука
+update_watermark = UpdateWatermark()
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
 
 # Define FSM States
 class ContactInfoState(StatesGroup):
@@ -64,7 +94,32 @@ class SupportState(StatesGroup):
 class PaymentState(StatesGroup):
     waiting_for_receipt = State()
 
-# Middleware to update last_active timestamp
+class SearchState(StatesGroup):
+    query = State()
+
+# Middleware to skip updates that were already processed (see catchup.UpdateWatermark)
+class UpdateWatermarkMiddleware(BaseMiddleware):
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        if not update_watermark.start(update.update_id):
+            logger.info(f"Апдейт {update.update_id} уже обработан, пропускаем.")
+            raise CancelHandler()
+
+    async def on_post_process_update(self, update: types.Update, result, data: dict):
+        update_watermark.finish(update.update_id)
+
+# Middleware to share one database connection per update (see Database.begin_unit_of_work)
+# Соединение берется при первом запросе к базе в middleware или обработчике и возвращается в пул
+# после обработки апдейта, поэтому апдейт занимает не больше одного соединения за раз.
+class UnitOfWorkMiddleware(BaseMiddleware):
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        data['unit_of_work'] = db.begin_unit_of_work()
+
+    async def on_post_process_update(self, update: types.Update, result, data: dict):
+        token = data.pop('unit_of_work', None)
+        if token is not None:
+            await db.end_unit_of_work(token)
+
+# Middleware to update last_active timestamp (buffered in Database, flushed in batches)
 class LastActiveMiddleware(BaseMiddleware):
     async def on_pre_process_message(self, message: types.Message, data: dict):
         try:
@@ -79,6 +134,8 @@ class LastActiveMiddleware(BaseMiddleware):
             logger.error(f"Ошибка при обновлении last_active для пользователя {callback_query.from_user.id}: {e}")
 
 # Middleware to check if the bot is open
+# Состояние бота и статусы пользователей берутся из кэша Database (ACCESS_CACHE_TTL),
+# поэтому в обычном случае проверка доступа не обращается к базе данных.
 class AccessMiddleware(BaseMiddleware):
     async def on_pre_process_message(self, message: types.Message, data: dict):
         user_id = message.from_user.id
@@ -92,22 +149,22 @@ class AccessMiddleware(BaseMiddleware):
             await message.answer("Произошла ошибка. Пожалуйста, попробуйте позже.")
             raise Throttled()  # Прекратить дальнейшую обработку
 
+        if is_open:
+            return  # Бот открыт, доступ разрешен всем
+
         try:
-            user = await db.get_user(user_id)
+            status = await db.get_user_status(user_id)
         except Exception as e:
             logger.error(f"Ошибка при получении пользователя {user_id}: {e}")
             await message.answer("Произошла ошибка. Пожалуйста, попробуйте позже.")
             raise Throttled()
 
-        if is_open:
-            return  # Бот открыт, доступ разрешен всем
-        else:
-            if user and user['status'] == 'approved':
-                return  # Одобренные пользователи имеют доступ, даже если бот закрыт
-            # Если бот закрыт и пользователь не одобрен
-            if message.chat.type == 'private':
-                await message.answer("Бот в данный момент закрыт для новых пользователей. Пожалуйста, попробуйте позже.")
-                raise Throttled()  # Прекратить дальнейшую обработку
+        if status == 'approved':
+            return  # Одобренные пользователи имеют доступ, даже если бот закрыт
+        # Если бот закрыт и пользователь не одобрен
+        if message.chat.type == 'private':
+            await message.answer("Бот в данный момент закрыт для новых пользователей. Пожалуйста, попробуйте позже.")
+            raise Throttled()  # Прекратить дальнейшую обработку
 
     async def on_pre_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
         user_id = callback_query.from_user.id
@@ -121,67 +178,106 @@ class AccessMiddleware(BaseMiddleware):
             await callback_query.answer("Произошла ошибка. Пожалуйста, попробуйте позже.", show_alert=True)
             raise Throttled()
 
+        if is_open:
+            return  # Бот открыт, доступ разрешен всем
+
         try:
-            user = await db.get_user(user_id)
+            status = await db.get_user_status(user_id)
         except Exception as e:
             logger.error(f"Ошибка при получении пользователя {user_id}: {e}")
             await callback_query.answer("Произошла ошибка. Пожалуйста, попробуйте позже.", show_alert=True)
             raise Throttled()
 
-        if is_open:
-            return  # Бот открыт, доступ разрешен всем
-        else:
-            if user and user['status'] == 'approved':
-                return  # Одобренные пользователи имеют доступ, даже если бот закрыт
-            # Если бот закрыт и пользователь не одобрен
-            await callback_query.answer("Бот в данный момент закрыт для новых пользователей.", show_alert=True)
-            raise Throttled()  # Прекратить дальнейшую обработку
+        if status == 'approved':
+            return  # Одобренные пользователи имеют доступ, даже если бот закрыт
+        # Если бот закрыт и пользователь не одобрен
+        await callback_query.answer("Бот в данный момент закрыт для новых пользователей.", show_alert=True)
+        raise Throttled()  # Прекратить дальнейшую обработку
 
 # Setup middlewares
+dp.middleware.setup(UpdateWatermarkMiddleware())
+dp.middleware.setup(UnitOfWorkMiddleware())
 dp.middleware.setup(LastActiveMiddleware())
 dp.middleware.setup(AccessMiddleware())
 
 # Function to send daily notifications
+# Неактивным больше суток пользователям сообщается, сколько объявлений появилось с их последнего
+# визита (отметка users.last_seen_ad_id). После доставки отметка сдвигается, чтобы те же
+# объявления не анонсировались повторно.
 async def send_daily_notifications():
-    cutoff_time = datetime.utcnow() - timedelta(hours=24)
-    try:
-        users = await db.get_inactive_users(cutoff_time)
-    except Exception as e:
-        logger.error(f"Ошибка при получении неактивных пользователей: {e}")
-        return
-
-    if not users:
-        logger.info("Нет неактивных пользователей для уведомления.")
-        return
+    last_ad_ids = {}
+    delivered = {}
+
+    async def recipients():
+        async for user_id, new_ads_count, last_ad_id in db.iter_users_with_unseen_ads(inactive_hours=24):
+            last_ad_ids[user_id] = last_ad_id
+            yield user_id, f"С вашего последнего визита появилось {new_ads_count} новых объявлений! Зайдите в бота, чтобы посмотреть."
+
+    async def on_result(user_id, is_delivered, error):
+        last_ad_id = last_ad_ids.pop(user_id)
+        if is_delivered:
+            delivered[user_id] = last_ad_id
+        if len(delivered) >= 500:
+            batch = dict(delivered)
+            delivered.clear()
+            await db.mark_ads_seen(batch)
 
     try:
-        new_ads_count = await db.get_new_ads_count(cutoff_time)
+        result = await broadcaster.run(recipients(), on_result=on_result)
+        await db.mark_ads_seen(delivered)
     except Exception as e:
-        logger.error(f"Ошибка при получении количества новых объявлений: {e}")
+        logger.error(f"Ошибка при отправке ежедневных уведомлений: {e}")
         return
-
-    if new_ads_count == 0:
-        logger.info("Нет новых объявлений за последние 24 часа.")
-        return
-
-    for user in users:
-        user_id = user['user_id']
-        try:
-            await bot.send_message(user_id, f"У нас появилось {new_ads_count} новых объявлений! Зайдите в бота, чтобы посмотреть.")
-            logger.info(f"Уведомление отправлено пользователю {user_id}.")
-        except Exception as e:
-            logger.error(f"Не удалось отправить уведомление пользователю {user_id}: {e}")
+    if result.processed == 0:
+        logger.info("Нет пользователей с новыми объявлениями для уведомления.")
+    else:
+        logger.info(f"Ежедневные уведомления: отправлено {result.sent}, ошибок {result.failed}.")
 
 # Function to run on startup
 async def on_startup(dp):
     try:
-        await bot.delete_webhook(drop_pending_updates=True)
+        if RUN_MODE != 'webhook':
+            # Очередь апдейтов не сбрасывается: ее обрабатывает catch_up ниже
+            await bot.delete_webhook()
         await db.connect()
+        await apply_migrations(db.pool)
+        await update_watermark.load(db)
+        update_watermark.start_flusher(db)
+        storage.start_flusher()
+        db.start_last_active_flusher()
+        run_in_background(resume_broadcast_jobs())
         scheduler.add_job(send_daily_notifications, 'cron', hour=9, timezone=utc)
         scheduler.start()
         logger.info("Планировщик задач запущен")
+        if RUN_MODE != 'webhook':
+            # В режиме вебхука накопившиеся апдейты Telegram доставит сам
+            await catch_up(dp, update_watermark)
     except Exception as e:
+        # Без схемы, отметки апдейтов и фоновых задач бот работать не должен: процесс завершается
+        # (executor вызовет on_shutdown), и платформа его перезапускает
         logger.critical(f"Ошибка при запуске бота: {e}")
+        raise
+
+# Function to run on shutdown
+async def on_shutdown(dp):
+    try:
+        # executor останавливает polling только после on_shutdown: до этого getUpdates продолжал бы
+        # получать апдейты, которые drain не дождется. wait_closed ждет текущий длинный опрос
+        # (до 20 с), его апдейты успевают попасть в очереди
+        if dp.is_polling():
+            dp.stop_polling()
+            await dp.wait_closed()
+        if scheduler.running:
+            scheduler.shutdown(wait=False)
+        # Начатые и стоящие в очередях апдейты дорабатываются, пока хранилище FSM и пул открыты
+        await dp.drain()
+        await update_watermark.close(db)
+        # Несохраненные состояния FSM записываются до закрытия пула
+        await storage.close()
+        # close() сбрасывает в базу накопленные last_active перед закрытием пула
+        await db.close()
+    except Exception as e:
+        logger.error(f"Ошибка при остановке бота: {e}")
 
 # Handler for /start command
 @dp.message_handler(commands=['start'])
@@ -397,7 +493,7 @@ async def get_city(message: types.Message, state: FSMContext):
 def main_menu_keyboard():
     keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
     keyboard.add("Список всех объявлений", "Избранные объявления", "Подписки")
-    keyboard.add("Поддержка")
+    keyboard.add("Поиск", "Поддержка")
     if ADMIN_IDS:
         keyboard.add("Админ Панель")
     return keyboard
@@ -407,7 +503,7 @@ async def show_menu(message: types.Message):
     await message.answer("Выберите действие:", reply_markup=main_menu_keyboard())
 
 # Handler for main menu options
-@dp.message_handler(lambda message: message.text in ["Список всех объявлений", "Избранные объявления", "Подписки", "Поддержка", "Админ Панель"])
+@dp.message_handler(lambda message: message.text in ["Список всех объявлений", "Избранные объявления", "Подписки", "Поиск", "Поддержка", "Админ Панель"])
 async def process_main_menu(message: types.Message, state: FSMContext):
     try:
         user = await db.get_user(message.from_user.id)
@@ -422,7 +518,7 @@ async def process_main_menu(message: types.Message, state: FSMContext):
 
     if message.text == "Список всех объявлений":
         try:
-            ads = await db.get_ads()
+            ads = await db.get_ads_page()
         except Exception as e:
             logger.error(f"Ошибка при получении объявлений: {e}")
             await message.answer("Произошла ошибка при получении объявлений. Пожалуйста, попробуйте позже.")
@@ -430,12 +526,18 @@ async def process_main_menu(message: types.Message, state: FSMContext):
         if not ads:
             await message.answer("Нет доступных объявлений.")
             return
-        await state.update_data(ads=ads, current_ad_index=0)
-        await show_ad_with_navigation(message, state)
+        await start_browsing(message, state, ads, scope='all')
+        # Каталог открывается с самого нового объявления - считаем, что пользователь видел все до него
+        try:
+            await db.mark_ads_seen({message.from_user.id: max(ad['ad_id'] for ad in ads)})
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении просмотренных объявлений пользователя {message.from_user.id}: {e}")
     elif message.text == "Избранные объявления":
         await show_favorites(message, state)
     elif message.text == "Подписки":
         await manage_subscriptions(message)
+    elif message.text == "Поиск":
+        await start_search(message)
     elif message.text == "Поддержка":
         await start_support(message)
     elif message.text == "Админ Панель":
@@ -450,119 +552,201 @@ async def cancel_handler(message: types.Message, state: FSMContext):
     await state.finish()
     await message.answer("Действие отменено.", reply_markup=main_menu_keyboard())
 
+# Browsing keeps only a cursor (ad_id + added_date) in FSM state, neighbours are fetched on demand
+def ad_cursor(ad):
+    return {'ad_id': ad['ad_id'], 'added_date': ad['added_date'].isoformat()}
+
+def cursor_key(cursor):
+    return (datetime.fromisoformat(cursor['added_date']), cursor['ad_id'])
+
+# Function to start browsing from the first page of ads (get_ads_page result)
+async def start_browsing(message: types.Message, state: FSMContext, ads, scope):
+    await state.update_data(ad_cursor=ad_cursor(ads[0]), ad_scope=scope, has_prev=False, has_next=len(ads) > 1)
+    await show_ad_with_navigation(message, state, ad=ads[0])
+
 # Function to display ads with navigation
-async def show_ad_with_navigation(message_or_callback, state: FSMContext, edit=False):
+async def show_ad_with_navigation(message_or_callback, state: FSMContext, edit=False, ad=None):
     data = await state.get_data()
-    ads = data.get('ads', [])
-    current_ad_index = data.get('current_ad_index', 0)
-    if not ads:
+    cursor = data.get('ad_cursor')
+    if ad is None and cursor:
+        try:
+            ad = await db.get_ad(cursor['ad_id'])
+        except Exception as e:
+            logger.error(f"Ошибка при получении объявления {cursor['ad_id']}: {e}")
+    if not ad:
         if isinstance(message_or_callback, types.Message):
             await message_or_callback.answer("Нет объявлений для отображения.")
         elif isinstance(message_or_callback, types.CallbackQuery):
             await message_or_callback.answer("Нет объявлений для отображения.")
         return
 
-    ad = ads[current_ad_index]
-    # Unpack ad details
-    ad_id = ad['ad_id']
-    title = ad['title']
-    price = ad['price']
-    description = ad['description']
-    photos = ad['photos']
-    inspection_photos = ad['inspection_photos']
-    thickness_photos = ad['thickness_photos']
-    model = ad['model']
-    year = ad['year']
-    added_date = ad['added_date']
-    caption = f"{title}\nМодель: {model}\nГод выпуска: {year}\nЦена: {price} KZT"
-
-    keyboard = types.InlineKeyboardMarkup()
-    keyboard.add(
-        types.InlineKeyboardButton("Купить", callback_data=f"buy_{ad_id}"),
-        types.InlineKeyboardButton("Запросить скидку", callback_data=f"discount_{ad_id}"),
-    )
-    keyboard.add(
-        types.InlineKeyboardButton("Полное описание", callback_data=f"description_{ad_id}"),
-        types.InlineKeyboardButton("Акт осмотра", callback_data=f"inspection_{ad_id}"),
-        types.InlineKeyboardButton("Толщиномер", callback_data=f"thickness_{ad_id}")
-    )
-
-    # Check if ad is in favorites
+    card = ad_cards.card(ad)
     try:
-        is_fav = await db.is_favorite(message_or_callback.from_user.id, ad_id)
+        is_fav = await db.is_favorite(message_or_callback.from_user.id, ad['ad_id'])
     except Exception as e:
         logger.error(f"Ошибка при проверке избранного для пользователя {message_or_callback.from_user.id}: {e}")
         is_fav = False
+    keyboard = card.keyboard(is_fav, data.get('has_prev'), data.get('has_next'))
 
-    if is_fav:
-        fav_button = types.InlineKeyboardButton("Убрать из избранного ❤️", callback_data=f"remove_fav_{ad_id}")
-    else:
-        fav_button = types.InlineKeyboardButton("Добавить в избранное 🤍", callback_data=f"add_fav_{ad_id}")
-    keyboard.add(fav_button)
-
-    # Add "Show all photos" button
-    keyboard.add(types.InlineKeyboardButton("Показать все фото", callback_data=f"show_photos_{ad_id}"))
-
-    # Navigation buttons
-    navigation_buttons = []
-    if current_ad_index > 0:
-        navigation_buttons.append(types.InlineKeyboardButton("« Предыдущее", callback_data="prev_ad"))
-    if current_ad_index < len(ads) - 1:
-        navigation_buttons.append(types.InlineKeyboardButton("Следующее »", callback_data="next_ad"))
-    if navigation_buttons:
-        keyboard.row(*navigation_buttons)
-
-    if photos:
-        file_id = photos[0]  # Показываем только первое фото
-        if edit and isinstance(message_or_callback, types.CallbackQuery):
-            try:
-                media = InputMediaPhoto(media=file_id, caption=caption)
-                await message_or_callback.message.edit_media(media=media, reply_markup=keyboard)
-            except Exception as e:
-                logger.error(f"Ошибка при редактировании медиа: {e}")
-        else:
-            try:
-                await bot.send_photo(chat_id=message_or_callback.from_user.id, photo=file_id, caption=caption, reply_markup=keyboard)
-            except Exception as e:
-                logger.error(f"Ошибка при отправке фото: {e}")
+    if edit and isinstance(message_or_callback, types.CallbackQuery):
+        try:
+            await message_edits.edit(message_or_callback.message, card.caption, keyboard, media=card.cover_media)
+        except Exception as e:
+            logger.error(f"Ошибка при редактировании объявления {ad['ad_id']}: {e}")
+    elif card.cover_media:
+        try:
+            sent = await bot.send_photo(chat_id=message_or_callback.from_user.id, photo=ad['cover_photo'], caption=card.caption, reply_markup=keyboard)
+            message_edits.remember(sent, ad['cover_photo'], card.caption, keyboard)
+        except Exception as e:
+            logger.error(f"Ошибка при отправке фото: {e}")
     else:
-        if edit and isinstance(message_or_callback, types.CallbackQuery):
-            try:
-                await message_or_callback.message.edit_text(caption, reply_markup=keyboard)
-            except Exception as e:
-                logger.error(f"Ошибка при редактировании текста: {e}")
-        else:
-            try:
-                await message_or_callback.answer(caption, reply_markup=keyboard)
-            except Exception as e:
-                logger.error(f"Ошибка при отправке сообщения: {e}")
+        try:
+            sent = await message_or_callback.answer(card.caption, reply_markup=keyboard)
+            message_edits.remember(sent, None, card.caption, keyboard)
+        except Exception as e:
+            logger.error(f"Ошибка при отправке сообщения: {e}")
 
 # Handlers to navigate through ads
 @dp.callback_query_handler(lambda c: c.data in ["prev_ad", "next_ad"])
 async def navigate_ads(callback_query: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
-    ads = data.get('ads', [])
-    current_ad_index = data.get('current_ad_index', 0)
-    if not ads:
+    cursor = data.get('ad_cursor')
+    if not cursor:
         await callback_query.answer("Нет объявлений для отображения.")
         return
 
-    if callback_query.data == "next_ad" and current_ad_index < len(ads) - 1:
-        current_ad_index += 1
-    elif callback_query.data == "prev_ad" and current_ad_index > 0:
-        current_ad_index -= 1
-    else:
+    direction = 'next' if callback_query.data == "next_ad" else 'prev'
+    if data.get('ad_scope') == 'search':
+        await navigate_search(callback_query, state, data, direction)
+        return
+    user_id = callback_query.from_user.id if data.get('ad_scope') == 'favorites' else None
+    try:
+        ads = await db.get_ads_page(cursor_key(cursor), direction, user_id=user_id)
+    except Exception as e:
+        logger.error(f"Ошибка при получении объявлений для навигации: {e}")
+        await callback_query.answer("Произошла ошибка при получении объявлений.", show_alert=True)
+        return
+    if not ads:
         await callback_query.answer("Больше объявлений нет.")
         return
 
-    await state.update_data(current_ad_index=current_ad_index)
-    await show_ad_with_navigation(callback_query, state, edit=True)
+    # Второе объявление в выборке означает, что дальше в этом направлении еще есть куда листать
+    has_more = len(ads) > 1
+    if direction == 'next':
+        has_prev, has_next = True, has_more
+    else:
+        has_prev, has_next = has_more, True
+    await state.update_data(ad_cursor=ad_cursor(ads[0]), has_prev=has_prev, has_next=has_next)
+    await show_ad_with_navigation(callback_query, state, edit=True, ad=ads[0])
     await callback_query.answer()
 
+# Handlers for catalog search (query syntax - see search.SearchQuery)
+SEARCH_HELP = (
+    "Введите запрос, например:\n"
+    "camry 2018\n"
+    "land cruiser цена:<20000000 сорт:дешевые\n"
+    "полный привод год:2015-2020\n\n"
+    "Слова ищутся в названии, модели и описании. Фильтры: цена:от-до, год:от-до, "
+    "сортировка: сорт:новые, сорт:дешевые, сорт:дорогие, сорт:год.\n"
+    "Для отмены отправьте 'Отмена'."
+)
+
+async def start_search(message: types.Message):
+    await message.answer(SEARCH_HELP)
+    await SearchState.query.set()
+
+@dp.message_handler(commands=['search'])
+async def search_command(message: types.Message, state: FSMContext):
+    try:
+        user = await db.get_user(message.from_user.id)
+    except Exception as e:
+        logger.error(f"Ошибка при получении данных пользователя {message.from_user.id}: {e}")
+        await message.answer("Произошла ошибка. Пожалуйста, попробуйте позже.")
+        return
+    if not user or user['status'] != 'approved':
+        await message.answer("У вас нет доступа. Пожалуйста, оплатите доступ.")
+        return
+    if message.get_args():
+        await run_search(message, state, message.get_args())
+    else:
+        await start_search(message)
+
+@dp.message_handler(state=SearchState.query)
+async def process_search_query(message: types.Message, state: FSMContext):
+    if message.text.lower() == 'отмена':
+        await cancel_handler(message, state)
+        return
+    await run_search(message, state, message.text)
+
+# Результаты поиска листаются по позиции в выдаче: в FSM хранится только текст запроса
+async def run_search(message: types.Message, state: FSMContext, text):
+    try:
+        query = SearchQuery.parse(text)
+    except ValueError:
+        await message.answer("Не удалось разобрать запрос. " + SEARCH_HELP)
+        await SearchState.query.set()
+        return
+    if query.is_empty():
+        await message.answer(SEARCH_HELP)
+        await SearchState.query.set()
+        return
+    try:
+        total, ads = await db.search_ads(query, offset=0, limit=2)
+    except Exception as e:
+        logger.error(f"Ошибка при поиске объявлений по запросу пользователя {message.from_user.id}: {e}")
+        await message.answer("Произошла ошибка при поиске. Пожалуйста, попробуйте позже.")
+        return
+    if not ads:
+        await message.answer("Ничего не найдено. Попробуйте изменить запрос или отправьте 'Отмена'.")
+        await SearchState.query.set()
+        return
+    await state.reset_state(with_data=False)
+    await state.update_data(search_query=text, search_position=0)
+    await message.answer(f"Найдено объявлений: {total}.", reply_markup=main_menu_keyboard())
+    await start_browsing(message, state, ads, scope='search')
+
+async def navigate_search(callback_query: types.CallbackQuery, state: FSMContext, data, direction):
+    position = data.get('search_position', 0) + (1 if direction == 'next' else -1)
+    if position < 0:
+        await callback_query.answer("Больше объявлений нет.")
+        return
+    try:
+        ads, has_next = await db.search_ads_page(SearchQuery.parse(data['search_query']), offset=position, limit=1)
+    except Exception as e:
+        logger.error(f"Ошибка при поиске объявлений для навигации: {e}")
+        await callback_query.answer("Произошла ошибка при получении объявлений.", show_alert=True)
+        return
+    if not ads:
+        await callback_query.answer("Больше объявлений нет.")
+        return
+    await state.update_data(ad_cursor=ad_cursor(ads[0]), search_position=position, has_prev=position > 0, has_next=has_next)
+    await show_ad_with_navigation(callback_query, state, edit=True, ad=ads[0])
+    await callback_query.answer()
+
+# Inline mode: "@bot camry 2018" in any chat shares an ad card (see inline_search.py)
+inline_search = InlineSearch(db, ad_caption)
+
+@dp.inline_handler()
+async def process_inline_query(inline_query: types.InlineQuery):
+    user_id = inline_query.from_user.id
+    try:
+        allowed = user_id in ADMIN_IDS or await db.get_user_status(user_id) == 'approved'
+    except Exception as e:
+        logger.error(f"Ошибка при получении пользователя {user_id}: {e}")
+        return
+    if not allowed:
+        await inline_query.answer(
+            [], cache_time=inline_search.cache_time, is_personal=True,
+            switch_pm_text="Получить доступ к каталогу", switch_pm_parameter="inline",
+        )
+        return
+    # Ответы личные: кэш Telegram не должен показывать каталог пользователям без доступа
+    await inline_search.handle(inline_query, is_personal=True)
+
 # Handlers for favorite ads
 async def show_favorites(message: types.Message, state: FSMContext):
     try:
-        ads = await db.get_favorite_ads(message.from_user.id)
+        ads = await db.get_ads_page(user_id=message.from_user.id)
     except Exception as e:
         logger.error(f"Ошибка при получении избранных объявлений пользователя {message.from_user.id}: {e}")
         await message.answer("Произошла ошибка при получении избранных объявлений. Пожалуйста, попробуйте позже.")
@@ -570,8 +754,7 @@ async def show_favorites(message: types.Message, state: FSMContext):
     if not ads:
         await message.answer("У вас нет избранных объявлений.")
         return
-    await state.update_data(ads=ads, current_ad_index=0)
-    await show_ad_with_navigation(message, state)
+    await start_browsing(message, state, ads, scope='favorites')
 
 @dp.callback_query_handler(lambda c: c.data and c.data.startswith('add_fav_'))
 async def add_to_favorites(callback_query: types.CallbackQuery, state: FSMContext):
@@ -599,23 +782,22 @@ async def remove_from_favorites(callback_query: types.CallbackQuery, state: FSMC
 async def show_all_photos(callback_query: types.CallbackQuery):
     ad_id = int(callback_query.data.split('_')[2])
     try:
-        ad = await db.get_ad(ad_id)
+        card = await ad_cards.get(ad_id)
     except Exception as e:
         logger.error(f"Ошибка при получении объявления {ad_id}: {e}")
         await callback_query.answer("Произошла ошибка при получении объявления.", show_alert=True)
         return
 
-    if not ad:
+    if not card:
         await callback_query.answer("Объявление не найдено.")
         return
-    photos = ad['photos']  # Список file_id
-    if photos:
-        media_group = []
-        for index, file_id in enumerate(photos):
-            if index == 0:
-                media_group.append(InputMediaPhoto(media=file_id, caption=f"Все фото объявления: {ad['title']}"))
-            else:
-                media_group.append(InputMediaPhoto(media=file_id))
+    try:
+        media_group = await ad_cards.media_group(card, 'photo')
+    except Exception as e:
+        logger.error(f"Ошибка при получении фотографий объявления {ad_id}: {e}")
+        await callback_query.answer("Произошла ошибка при получении фотографий.", show_alert=True)
+        return
+    if media_group:
         try:
             await bot.send_media_group(chat_id=callback_query.from_user.id, media=media_group)
             await callback_query.answer()
@@ -816,7 +998,7 @@ async def admin_panel(message: types.Message):
         return
     keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
     keyboard.add("Добавить объявление", "Управление объявлениями")
-    keyboard.add("Статистика", "Рассылка")
+    keyboard.add("Статистика", "Рассылка", "Статус рассылок")
     keyboard.add("Экспорт контактов", "Открыть/Закрыть Бот")
     await message.answer("Панель администратора", reply_markup=keyboard)
 
@@ -975,29 +1157,13 @@ async def ad_thickness_photos_done(message: types.Message, state: FSMContext):
 # Function to notify subscribers when a new ad is added
 async def notify_subscribers(ad):
     try:
-        subscriptions = await db.get_all_subscriptions()
+        subscriptions = await db.match_subscriptions(ad)
     except Exception as e:
         logger.error(f"Ошибка при получении подписок: {e}")
         return
 
     for sub in subscriptions:
         user_id = sub['user_id']
-        model = sub['model']
-        price_min = sub['price_min']
-        price_max = sub['price_max']
-        year_min = sub['year_min']
-        year_max = sub['year_max']
-        # Проверяем соответствие объявления подписке
-        if model and model.lower() not in ad['model'].lower():
-            continue
-        if price_min and ad['price'] < price_min:
-            continue
-        if price_max and ad['price'] > price_max:
-            continue
-        if year_min and ad['year'] < year_min:
-            continue
-        if year_max and ad['year'] > year_max:
-            continue
         # Отправляем уведомление
         try:
             await bot.send_message(user_id, f"Появилось новое объявление, соответствующее вашей подписке: {ad['title']}")
@@ -1043,6 +1209,7 @@ async def process_ad_management(callback_query: types.CallbackQuery, state: FSMC
             ad = await db.get_ad(ad_id)
             if ad:
                 await db.delete_ad(ad_id)
+                ad_cards.discard(ad_id)
                 await callback_query.answer("Объявление удалено.", show_alert=True)
                 await callback_query.message.delete()
                 logger.info(f"Объявление {ad_id} удалено администратором {callback_query.from_user.id}.")
@@ -1055,7 +1222,7 @@ async def process_ad_management(callback_query: types.CallbackQuery, state: FSMC
         await callback_query.answer("Редактирование пока не реализовано.", show_alert=True)
 
 # Handlers for admin commands
-@dp.message_handler(lambda message: message.text in ["Статистика", "Рассылка", "Экспорт контактов", "Открыть/Закрыть Бот"])
+@dp.message_handler(lambda message: message.text in ["Статистика", "Рассылка", "Статус рассылок", "Экспорт контактов", "Открыть/Закрыть Бот"])
 async def process_admin_commands(message: types.Message):
     if message.from_user.id not in ADMIN_IDS:
         await message.answer("У вас нет доступа.")
@@ -1065,79 +1232,119 @@ async def process_admin_commands(message: types.Message):
         try:
             users_count, ads_count = await db.get_statistics()
             active_users = await db.get_active_users_count()
-            await message.answer(f"Всего пользователей: {users_count}\nАктивных пользователей: {active_users}\nКоличество объявлений: {ads_count}")
+            cache_stats = db.ads_cache.stats()
+            logger.info(
+                f"Статистика кэша каталога: {cache_stats}, кэша избранного: {db.favorites_cache.stats()}, "
+                f"кэша настроек: {db.settings_cache.stats()}, кэша статусов: {db.status_cache.stats()}, "
+                f"карточек объявлений: {ad_cards.stats()}, правок сообщений каталога: {message_edits.stats()}"
+            )
+            logger.info(f"Метрики запросов к базе: {db.metrics.report()}, единицы работы: {db.unit_of_work_stats}")
+            logger.info(f"Очереди апдейтов пользователей: {dp.lanes_stats()}, хранилище FSM: {storage.stats()}")
+            logger.info(f"Inline-запросы: {inline_search.inline_stats()}")
+            await message.answer(
+                f"Всего пользователей: {users_count}\nАктивных пользователей: {active_users}\nКоличество объявлений: {ads_count}\n"
+                f"Кэш каталога: попаданий {cache_stats['hits']}, промахов {cache_stats['misses']}\n"
+                f"Дольше всего занимают соединения с базой: {db.metrics.top_holders()}"
+            )
         except Exception as e:
             logger.error(f"Ошибка при получении статистики: {e}")
             await message.answer("Произошла ошибка при получении статистики. Пожалуйста, попробуйте позже.")
     elif message.text == "Рассылка":
         await message.answer("Пожалуйста, введите сообщение для рассылки:")
         await MailingStates.message.set()
+    elif message.text == "Статус рассылок":
+        await show_broadcast_status(message)
     elif message.text == "Экспорт контактов":
         await export_contacts(message)
     elif message.text == "Открыть/Закрыть Бот":
         await toggle_bot_state(message)
 
 # Handler for sending mailing
+# Рассылка выполняется в фоне через Broadcaster, обработчик администратора сразу освобождается
 @dp.message_handler(state=MailingStates.message)
 async def process_mailing(message: types.Message, state: FSMContext):
     mailing_message = message.text
     await state.finish()
 
     try:
-        users = await db.get_approved_users()
+        job_id, total = await db.create_broadcast_job(mailing_message, message.from_user.id)
     except Exception as e:
-        logger.error(f"Ошибка при получении списка одобренных пользователей для рассылки: {e}")
+        logger.error(f"Ошибка при создании задания рассылки: {e}")
         await message.answer("Произошла ошибка при получении списка пользователей. Пожалуйста, попробуйте позже.")
         return
 
-    if not users:
+    if not total:
+        await db.finish_broadcast_job(job_id)
         await message.answer("Нет одобренных пользователей для рассылки.")
         return
 
-    total_users = len(users)
-    success_count = 0
+    status_message = await message.answer(f"Рассылка #{job_id} запущена для {total} пользователей.")
+    run_in_background(run_broadcast_job(broadcaster, db, job_id, mailing_message, total=total, status_message=status_message))
 
-    for user_id in users:
+# Function to resume broadcast jobs interrupted by a restart
+async def resume_broadcast_jobs():
+    try:
+        jobs = await db.get_unfinished_broadcast_jobs()
+    except Exception as e:
+        logger.error(f"Ошибка при получении незавершенных рассылок: {e}")
+        return
+    for job in jobs:
+        job_id = job['job_id']
         try:
-            await bot.send_message(user_id, mailing_message)
-            success_count += 1
+            remaining = await db.recover_broadcast_job(job_id)
+            logger.info(f"Возобновление рассылки {job_id}: осталось {remaining} получателей.")
+            status_message = None
+            if job['created_by']:
+                try:
+                    status_message = await bot.send_message(job['created_by'], f"Рассылка #{job_id} возобновлена после перезапуска, осталось {remaining} получателей.")
+                except Exception as e:
+                    logger.error(f"Не удалось уведомить администратора {job['created_by']} о возобновлении рассылки: {e}")
+            await run_broadcast_job(broadcaster, db, job_id, job['text'], total=remaining, status_message=status_message)
         except Exception as e:
-            logger.error(f"Ошибка отправки сообщения пользователю {user_id}: {e}")
-
-    await message.answer(f"Рассылка завершена.\nУспешно отправлено: {success_count}/{total_users}")
+            logger.error(f"Ошибка при возобновлении рассылки {job_id}: {e}")
 
-# Function to export contacts to Excel
-async def export_contacts(message: types.Message):
+# Function to show the status of recent broadcast jobs
+async def show_broadcast_status(message: types.Message):
     try:
-        users = await db.get_user_contacts()
+        jobs = await db.get_broadcast_jobs_status()
     except Exception as e:
-        logger.error(f"Ошибка при получении контактов пользователей: {e}")
-        await message.answer("Произошла ошибка при получении контактов. Пожалуйста, попробуйте позже.")
+        logger.error(f"Ошибка при получении статуса рассылок: {e}")
+        await message.answer("Произошла ошибка при получении статуса рассылок. Пожалуйста, попробуйте позже.")
         return
-    if not users:
-        await message.answer("Нет зарегистрированных пользователей.")
+    if not jobs:
+        await message.answer("Рассылок еще не было.")
         return
-    # Создаем DataFrame
-    df = pd.DataFrame(users, columns=['Имя', 'Город', 'Телефон'])
-    # Сохраняем в Excel
-    file_path = 'contacts.xlsx'
+    lines = []
+    for job in jobs:
+        state_text = "завершена" if job['status'] == 'finished' else "выполняется"
+        lines.append(
+            f"#{job['job_id']} от {job['created_at']:%d.%m.%Y %H:%M} - {state_text}\n"
+            f"Отправлено: {job['sent']}/{job['total']}, ошибок: {job['failed']}, "
+            f"неизвестно: {job['unknown']}, в очереди: {job['pending']}"
+        )
+    await message.answer("\n\n".join(lines))
+
+# Function to export contacts to Excel
+async def export_contacts(message: types.Message):
     try:
-        df.to_excel(file_path, index=False)
+        output, count = await export_contacts_xlsx(db)
     except Exception as e:
-        logger.error(f"Ошибка при сохранении контактов в Excel: {e}")
+        logger.error(f"Ошибка при выгрузке контактов в Excel: {e}")
         await message.answer("Произошла ошибка при сохранении контактов. Пожалуйста, попробуйте позже.")
         return
-    # Отправляем файл администратору
-    try:
-        await bot.send_document(message.chat.id, InputFile(file_path))
-        logger.info(f"Файл контактов отправлен администратору {message.from_user.id}.")
-    except Exception as e:
-        logger.error(f"Ошибка при отправке файла контактов: {e}")
-        await message.answer("Произошла ошибка при отправке файла. Пожалуйста, попробуйте позже.")
-    finally:
-        # Удаляем файл после отправки
-        if os.path.exists(file_path):
-            os.remove(file_path)
+    # Временный файл удаляется при закрытии
+    with output:
+        if not count:
+            await message.answer("Нет зарегистрированных пользователей.")
+            return
+        # Отправляем файл администратору
+        try:
+            filename = f"contacts_{datetime.utcnow():%Y%m%d_%H%M%S}.xlsx"
+            await bot.send_document(message.chat.id, InputFile(output, filename=filename))
+            logger.info(f"Файл контактов отправлен администратору {message.from_user.id}.")
+        except Exception as e:
+            logger.error(f"Ошибка при отправке файла контактов: {e}")
+            await message.answer("Произошла ошибка при отправке файла. Пожалуйста, попробуйте позже.")
 
 # Function to toggle bot state (open/close)
 async def toggle_bot_state(message: types.Message):
@@ -1158,25 +1365,17 @@ async def process_callback_ad(callback_query: types.CallbackQuery, state: FSMCon
     ad_id = int(callback_query.data.split('_')[1])
     action = callback_query.data.split('_')[0]
     try:
-        ad = await db.get_ad(ad_id)
+        card = await ad_cards.get(ad_id)
     except Exception as e:
         logger.error(f"Ошибка при получении объявления {ad_id}: {e}")
         await callback_query.answer("Произошла ошибка при получении объявления.", show_alert=True)
         return
 
-    if not ad:
+    if not card:
         await callback_query.answer("Объявление не найдено.")
         return
-    title = ad['title']
-    price = ad['price']
+    ad = card.ad
     description = ad['description']
-    photos = ad['photos']
-    inspection_photos = ad['inspection_photos']
-    thickness_photos = ad['thickness_photos']
-    model = ad['model']
-    year = ad['year']
-    added_date = ad['added_date']
-    caption = f"{title}\nМодель: {model}\nГод выпуска: {year}\nЦена: {price} KZT"
 
     if action == 'description':
         if description:
@@ -1189,13 +1388,13 @@ async def process_callback_ad(callback_query: types.CallbackQuery, state: FSMCon
             await bot.send_message(callback_query.from_user.id, "Описание отсутствует.")
         await callback_query.answer()
     elif action == 'inspection':
-        if inspection_photos:
-            media = MediaGroup()
-            for index, file_id in enumerate(inspection_photos):
-                if index == 0:
-                    media.attach(InputMediaPhoto(media=file_id, caption=f"Акт осмотра: {title}"))
-                else:
-                    media.attach(InputMediaPhoto(media=file_id))
+        try:
+            media = await ad_cards.media_group(card, 'inspection')
+        except Exception as e:
+            logger.error(f"Ошибка при получении акта осмотра объявления {ad_id}: {e}")
+            await callback_query.answer("Произошла ошибка при получении акта осмотра.", show_alert=True)
+            return
+        if media:
             try:
                 await bot.send_media_group(chat_id=callback_query.from_user.id, media=media)
             except Exception as e:
@@ -1205,13 +1404,13 @@ async def process_callback_ad(callback_query: types.CallbackQuery, state: FSMCon
             await bot.send_message(callback_query.from_user.id, "Нет фотографий акта осмотра.")
         await callback_query.answer()
     elif action == 'thickness':
-        if thickness_photos:
-            media = MediaGroup()
-            for index, file_id in enumerate(thickness_photos):
-                if index == 0:
-                    media.attach(InputMediaPhoto(media=file_id, caption=f"Фото толщиномера: {title}"))
-                else:
-                    media.attach(InputMediaPhoto(media=file_id))
+        try:
+            media = await ad_cards.media_group(card, 'thickness')
+        except Exception as e:
+            logger.error(f"Ошибка при получении фото толщиномера объявления {ad_id}: {e}")
+            await callback_query.answer("Произошла ошибка при получении фото толщиномера.", show_alert=True)
+            return
+        if media:
             try:
                 await bot.send_media_group(chat_id=callback_query.from_user.id, media=media)
             except Exception as e:
@@ -1313,6 +1512,13 @@ async def notify_managers_new_ad(ad):
 # Run the bot
 if __name__ == '__main__':
     try:
-        executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
+        if RUN_MODE == 'webhook':
+            start_webhook(dp, on_startup=on_startup, on_shutdown=on_shutdown)
+        else:
+            # executor.start_polling вызывает on_shutdown только по Ctrl+C (KeyboardInterrupt), а платформа
+            # при перезапуске шлет SIGTERM: он обрабатывается так же (в режиме вебхука - web.run_app)
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown)
     except Exception as e:
-        logger.critical(f"Бот завершился с ошибкой: {e}")
\ No newline at end of file
+        logger.critical(f"Бот завершился с ошибкой: {e}")
+        sys.exit(1)
\ No newline at end of file
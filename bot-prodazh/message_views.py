@@ -0,0 +1,166 @@
+# message_views.py
+
+import logging
+from collections import Counter, OrderedDict
+
+from aiogram import types
+from aiogram.utils.exceptions import MessageCantBeDeleted, MessageNotModified, MessageToDeleteNotFound
+
+from config import MESSAGE_VIEWS_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+# Что сейчас показывает сообщение: file_id фото (None - текстовое сообщение), текст или подпись,
+# клавиатура в JSON
+class MessageView:
+    __slots__ = ('photo', 'text', 'markup')
+
+    def __init__(self, photo, text, markup):
+        self.photo = photo
+        self.text = text
+        self.markup = markup
+
+    def __eq__(self, other):
+        return (self.photo, self.text, self.markup) == (other.photo, other.text, other.markup)
+
+
+def _markup_json(markup):
+    return markup.as_json() if markup is not None else None
+
+
+# Планировщик правок сообщений каталога. Помнит, что показывает каждое отправленное или измененное
+# сообщение (не больше max_size последних, LRU), и меняет его самым дешевым вызовом Bot API:
+# только кнопки - edit_message_reply_markup, только подпись - edit_message_caption,
+# фото - edit_media. Если ничего не изменилось, вызова нет. Для незнакомого сообщения
+# (после перезапуска или вытеснения) выполняется полная правка, как раньше.
+# Фото в текст и текст в фото Bot API не превращает: такое сообщение удаляется и отправляется заново
+# (действие 'replace'). Есть ли фото в незнакомом сообщении, видно по самому message.
+class MessageEditPlanner:
+    def __init__(self, max_size: int = MESSAGE_VIEWS_CACHE_SIZE):
+        self.max_size = max_size
+        self.actions = Counter()
+        self._views = OrderedDict()
+
+    def remember(self, message: types.Message, photo, text, markup):
+        self._store((message.chat.id, message.message_id), MessageView(photo, text, _markup_json(markup)))
+
+    def _store(self, key, view):
+        self._views[key] = view
+        self._views.move_to_end(key)
+        while len(self._views) > self.max_size:
+            self._views.popitem(last=False)
+
+    def plan(self, message: types.Message, view: MessageView):
+        current = self._views.get((message.chat.id, message.message_id))
+        has_photo = bool(message.photo) if current is None else current.photo is not None
+        if has_photo != (view.photo is not None):
+            return 'replace'
+        if current is None or current.photo != view.photo:
+            return 'media' if view.photo else 'text'
+        if current == view:
+            return 'skip'
+        if current.text != view.text:
+            return 'caption' if view.photo else 'text'
+        return 'markup'
+
+    # Привести сообщение к виду: фото media (InputMediaPhoto с подписью text) или текст text,
+    # клавиатура markup. Возвращает выполненное действие.
+    async def edit(self, message: types.Message, text, markup=None, media=None):
+        view = MessageView(media.media if media is not None else None, text, _markup_json(markup))
+        action = self.plan(message, view)
+        self.actions[action] += 1
+        key = (message.chat.id, message.message_id)
+        if action == 'replace':
+            self._views.pop(key, None)
+            try:
+                await message.delete()
+            except (MessageCantBeDeleted, MessageToDeleteNotFound) as e:
+                # Старше 48 часов или уже удалено - новое сообщение все равно отправляется
+                logger.info(f"Сообщение {message.message_id} не удалено перед заменой: {e}")
+            if media is not None:
+                sent = await message.bot.send_photo(message.chat.id, photo=media.media, caption=text, reply_markup=markup)
+            else:
+                sent = await message.bot.send_message(message.chat.id, text, reply_markup=markup)
+            self._store((sent.chat.id, sent.message_id), view)
+            return action
+        try:
+            if action == 'media':
+                await message.edit_media(media=media, reply_markup=markup)
+            elif action == 'text':
+                await message.edit_text(text, reply_markup=markup)
+            elif action == 'caption':
+                await message.edit_caption(text, reply_markup=markup)
+            elif action == 'markup':
+                await message.edit_reply_markup(reply_markup=markup)
+        except MessageNotModified:
+            self.actions['not_modified'] += 1
+        except Exception:
+            # Что теперь показывает сообщение, неизвестно: следующая правка будет полной
+            self._views.pop(key, None)
+            raise
+        self._store(key, view)
+        return action
+
+    def stats(self):
+        return {'messages': len(self._views), **self.actions}
+
+
+if __name__ == '__main__':
+    import asyncio
+
+    from aiogram.types import InputMediaPhoto
+
+    # Заглушка сообщения: записывает вызовы Bot API и отвечает так, как ответил бы Telegram
+    class FakeMessage:
+        def __init__(self, calls, message_id, photo=None):
+            self.calls = calls
+            self.bot = self
+            self.chat = types.Chat(id=1, type='private')
+            self.message_id = message_id
+            self.photo = [types.PhotoSize(file_id=photo)] if photo else []
+
+        def __getattr__(self, method):
+            async def call(*args, **kwargs):
+                self.calls.append(method)
+                return FakeMessage(self.calls, self.message_id + 1, kwargs.get('photo'))
+            return call
+
+    markup = types.InlineKeyboardMarkup(inline_keyboard=[[types.InlineKeyboardButton("x", callback_data="x")]])
+    # (что показывает сообщение сейчас: None - незнакомо планировщику, что показать) -> ожидаемый вызов
+    cases = [
+        ((None, 'photo'), ('photo-1', 'a', markup), ['edit_media']),
+        ((None, 'text'), (None, 'a', markup), ['edit_text']),
+        ((None, 'photo'), (None, 'a', markup), ['delete', 'send_message']),
+        ((None, 'text'), ('photo-1', 'a', markup), ['delete', 'send_photo']),
+        (('photo-1', 'a', markup), ('photo-1', 'a', markup), []),
+        (('photo-1', 'a', markup), ('photo-1', 'a', None), ['edit_reply_markup']),
+        (('photo-1', 'a', markup), ('photo-1', 'b', markup), ['edit_caption']),
+        (('photo-1', 'a', markup), ('photo-2', 'a', markup), ['edit_media']),
+        (('photo-1', 'a', markup), (None, 'a', markup), ['delete', 'send_message']),
+        ((None, 'a', markup), (None, 'a', markup), []),
+        ((None, 'a', markup), (None, 'a', None), ['edit_reply_markup']),
+        ((None, 'a', markup), (None, 'b', markup), ['edit_text']),
+        ((None, 'a', markup), ('photo-1', 'a', markup), ['delete', 'send_photo']),
+    ]
+
+    async def check():
+        for shown, (photo, text, new_markup), expected in cases:
+            planner = MessageEditPlanner()
+            calls = []
+            if shown[0] is None and len(shown) == 2:
+                message = FakeMessage(calls, 1, 'photo-0' if shown[1] == 'photo' else None)
+            else:
+                message = FakeMessage(calls, 1, shown[0])
+                planner.remember(message, *shown)
+            media = InputMediaPhoto(media=photo, caption=text) if photo else None
+            await planner.edit(message, text, new_markup, media=media)
+            assert calls == expected, f"{shown} -> {(photo, text)}: {calls}, ожидалось {expected}"
+            # После замены планировщик знает новое сообщение: повторная правка ничего не вызывает
+            if calls[:1] == ['delete']:
+                calls.clear()
+                await planner.edit(FakeMessage(calls, 2, photo), text, new_markup, media=media)
+                assert calls == [], f"{shown} -> {(photo, text)}: повторная правка {calls}"
+        print(f"Переходов проверено: {len(cases)}")
+
+    asyncio.run(check())
@@ -0,0 +1,387 @@
+# migrations.py
+
+import logging
+
+import aiomysql
+
+from sqlite_pool import SQLitePool
+
+logger = logging.getLogger(__name__)
+
+# Коды ошибок MySQL, которые означают, что изменение уже применено (например, вручную по schema.sql)
+ER_DUP_FIELDNAME = 1060
+ER_DUP_KEYNAME = 1061
+ER_CANT_DROP_FIELD_OR_KEY = 1091
+ER_BAD_FIELD_ERROR = 1054
+ER_NO_SUCH_TABLE = 1146
+ALREADY_APPLIED_ERRORS = (ER_DUP_FIELDNAME, ER_DUP_KEYNAME, ER_CANT_DROP_FIELD_OR_KEY)
+
+
+# Перенос file_id из JSON-колонки объявления в ad_photos с сохранением порядка.
+# INSERT IGNORE делает повторный запуск после частично примененной миграции безопасным.
+# В базе, созданной по текущему schema.sql, JSON-колонок нет: ER_BAD_FIELD_ERROR значит, что переносить нечего.
+def _copy_photos(kind, column):
+    return f"""
+        INSERT IGNORE INTO ad_photos (ad_id, kind, position, file_id)
+        SELECT a.ad_id, '{kind}', j.n - 1, j.file_id
+        FROM ads a,
+             JSON_TABLE(a.{column}, '$[*]' COLUMNS (n FOR ORDINALITY, file_id VARCHAR(255) PATH '$')) j
+        WHERE a.{column} IS NOT NULL AND j.file_id IS NOT NULL
+    """, (ER_BAD_FIELD_ERROR,)
+
+
+# Версионированные миграции схемы: (версия, описание, список SQL-выражений).
+# Выражение может быть парой (SQL, коды ошибок), которые для него дополнительно означают "уже применено".
+# Новые изменения схемы добавляются только в конец списка с очередной версией,
+# schema.sql при этом обновляется, чтобы отражать итоговую схему.
+MIGRATIONS = [
+    (1, "Базовые таблицы", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username VARCHAR(255),
+            status ENUM('pending', 'approved', 'rejected') DEFAULT 'pending',
+            name VARCHAR(255),
+            phone VARCHAR(50),
+            city VARCHAR(100),
+            last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            cheque_file_id VARCHAR(255)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS ads (
+            ad_id INT AUTO_INCREMENT PRIMARY KEY,
+            title VARCHAR(255) NOT NULL,
+            model VARCHAR(255),
+            year INT,
+            price INT,
+            description TEXT,
+            photos JSON,
+            inspection_photos JSON,
+            thickness_photos JSON,
+            added_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS favorites (
+            user_id BIGINT,
+            ad_id INT,
+            PRIMARY KEY (user_id, ad_id),
+            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
+            FOREIGN KEY (ad_id) REFERENCES ads(ad_id) ON DELETE CASCADE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            rowid INT AUTO_INCREMENT PRIMARY KEY,
+            user_id BIGINT,
+            model VARCHAR(255),
+            price_min INT,
+            price_max INT,
+            year_min INT,
+            year_max INT,
+            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS bot_settings (
+            `key` VARCHAR(50) PRIMARY KEY,
+            `value` VARCHAR(50)
+        )
+        """,
+    ]),
+    (2, "Задания рассылки и состояние доставки", [
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            job_id INT AUTO_INCREMENT PRIMARY KEY,
+            text TEXT NOT NULL,
+            status ENUM('running', 'finished') DEFAULT 'running',
+            created_by BIGINT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            job_id INT,
+            user_id BIGINT,
+            status ENUM('pending', 'sending', 'sent', 'failed', 'unknown') DEFAULT 'pending',
+            error VARCHAR(255),
+            PRIMARY KEY (job_id, user_id),
+            INDEX idx_broadcast_deliveries_status (job_id, status),
+            FOREIGN KEY (job_id) REFERENCES broadcast_jobs(job_id) ON DELETE CASCADE
+        )
+        """,
+    ]),
+    (3, "Отметка последнего просмотренного объявления", [
+        "ALTER TABLE users ADD COLUMN last_seen_ad_id INT NOT NULL DEFAULT 0",
+        # Уже существующие пользователи видели текущий каталог: иначе первое ежедневное уведомление
+        # назвало бы новыми все объявления. last_active = last_active - без ON UPDATE CURRENT_TIMESTAMP
+        """
+        UPDATE users SET last_seen_ad_id = (SELECT COALESCE(MAX(ad_id), 0) FROM ads), last_active = last_active
+        WHERE last_seen_ad_id = 0
+        """,
+    ]),
+    (4, "Индексы для частых запросов", [
+        # Каталог и keyset-пагинация: ORDER BY added_date DESC, ad_id DESC
+        "CREATE INDEX idx_ads_added_date ON ads (added_date, ad_id)",
+        # Рассылки и ежедневные уведомления: status='approved' AND last_active <= ...
+        "CREATE INDEX idx_users_status_last_active ON users (status, last_active)",
+        # Статистика активных пользователей: last_active >= NOW() - INTERVAL 7 DAY
+        "CREATE INDEX idx_users_last_active ON users (last_active)",
+        # Подписки пользователя
+        "CREATE INDEX idx_subscriptions_user_id ON subscriptions (user_id)",
+    ]),
+    (5, "Фотографии объявлений в отдельной таблице", [
+        """
+        CREATE TABLE IF NOT EXISTS ad_photos (
+            ad_id INT NOT NULL,
+            kind ENUM('photo', 'inspection', 'thickness') NOT NULL,
+            position SMALLINT NOT NULL,
+            file_id VARCHAR(255) NOT NULL,
+            PRIMARY KEY (ad_id, kind, position),
+            FOREIGN KEY (ad_id) REFERENCES ads(ad_id) ON DELETE CASCADE
+        )
+        """,
+        _copy_photos('photo', 'photos'),
+        _copy_photos('inspection', 'inspection_photos'),
+        _copy_photos('thickness', 'thickness_photos'),
+    ]),
+    # Отдельной версией, чтобы колонки удалялись только после успешного переноса
+    (6, "Удаление JSON-колонок с фотографиями", [
+        "ALTER TABLE ads DROP COLUMN photos, DROP COLUMN inspection_photos, DROP COLUMN thickness_photos",
+    ]),
+    (7, "Хранилище состояний FSM", [
+        """
+        CREATE TABLE IF NOT EXISTS fsm_sessions (
+            chat_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            state VARCHAR(255),
+            data JSON,
+            bucket JSON,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            PRIMARY KEY (chat_id, user_id),
+            INDEX idx_fsm_sessions_updated_at (updated_at)
+        )
+        """,
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# Итоговая схема для SQLite (DB_BACKEND=sqlite), соответствует версии LATEST_VERSION.
+# Новая база SQLite создается сразу в этой схеме; при добавлении миграции ее нужно обновить вместе со schema.sql.
+# ON UPDATE CURRENT_TIMESTAMP у users.last_active заменяет триггер на изменение данных пользователя.
+SQLITE_NOW = "(datetime('now', 'localtime'))"
+SQLITE_SCHEMA = [
+    f"""
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        status TEXT DEFAULT 'pending' CHECK (status IN ('pending', 'approved', 'rejected')),
+        name TEXT,
+        phone TEXT,
+        city TEXT,
+        last_active TIMESTAMP DEFAULT {SQLITE_NOW},
+        cheque_file_id TEXT,
+        last_seen_ad_id INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_users_last_active
+    AFTER UPDATE OF username, status, name, phone, city, cheque_file_id ON users
+    WHEN NEW.last_active IS OLD.last_active
+    BEGIN
+        UPDATE users SET last_active = {SQLITE_NOW} WHERE user_id = NEW.user_id;
+    END
+    """,
+    # AUTOINCREMENT: ad_id не переиспользуются после удаления (на этом держится last_seen_ad_id)
+    f"""
+    CREATE TABLE IF NOT EXISTS ads (
+        ad_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        title TEXT NOT NULL,
+        model TEXT,
+        year INTEGER,
+        price INTEGER,
+        description TEXT,
+        added_date TIMESTAMP DEFAULT {SQLITE_NOW}
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS ad_photos (
+        ad_id INTEGER NOT NULL,
+        kind TEXT NOT NULL CHECK (kind IN ('photo', 'inspection', 'thickness')),
+        position INTEGER NOT NULL,
+        file_id TEXT NOT NULL,
+        PRIMARY KEY (ad_id, kind, position),
+        FOREIGN KEY (ad_id) REFERENCES ads(ad_id) ON DELETE CASCADE
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS favorites (
+        user_id INTEGER,
+        ad_id INTEGER,
+        PRIMARY KEY (user_id, ad_id),
+        FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
+        FOREIGN KEY (ad_id) REFERENCES ads(ad_id) ON DELETE CASCADE
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS subscriptions (
+        rowid INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        model TEXT,
+        price_min INTEGER,
+        price_max INTEGER,
+        year_min INTEGER,
+        year_max INTEGER,
+        FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS bot_settings (
+        `key` TEXT PRIMARY KEY,
+        `value` TEXT
+    )
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS broadcast_jobs (
+        job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        status TEXT DEFAULT 'running' CHECK (status IN ('running', 'finished')),
+        created_by INTEGER,
+        created_at TIMESTAMP DEFAULT {SQLITE_NOW},
+        finished_at TIMESTAMP NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+        job_id INTEGER,
+        user_id INTEGER,
+        status TEXT DEFAULT 'pending' CHECK (status IN ('pending', 'sending', 'sent', 'failed', 'unknown')),
+        error TEXT,
+        PRIMARY KEY (job_id, user_id),
+        FOREIGN KEY (job_id) REFERENCES broadcast_jobs(job_id) ON DELETE CASCADE
+    )
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS fsm_sessions (
+        chat_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        state TEXT,
+        data TEXT,
+        bucket TEXT,
+        updated_at TIMESTAMP DEFAULT {SQLITE_NOW},
+        PRIMARY KEY (chat_id, user_id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_broadcast_deliveries_status ON broadcast_deliveries (job_id, status)",
+    "CREATE INDEX IF NOT EXISTS idx_ads_added_date ON ads (added_date, ad_id)",
+    "CREATE INDEX IF NOT EXISTS idx_users_status_last_active ON users (status, last_active)",
+    "CREATE INDEX IF NOT EXISTS idx_users_last_active ON users (last_active)",
+    "CREATE INDEX IF NOT EXISTS idx_subscriptions_user_id ON subscriptions (user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_fsm_sessions_updated_at ON fsm_sessions (updated_at)",
+    f"""
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at TIMESTAMP DEFAULT {SQLITE_NOW}
+    )
+    """,
+]
+
+
+async def _current_version(cur):
+    try:
+        await cur.execute("SELECT MAX(version) FROM schema_migrations")
+    except aiomysql.Error as e:
+        if e.args[0] == ER_NO_SUCH_TABLE:
+            return None
+        raise
+    result = await cur.fetchone()
+    return result[0] or 0
+
+
+# Создание схемы SQLite одной транзакцией; версии записываются в schema_migrations, как после миграций MySQL
+async def _apply_sqlite_schema(pool):
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='schema_migrations'")
+            if await cur.fetchone():
+                await cur.execute("SELECT MAX(version) FROM schema_migrations")
+                current = (await cur.fetchone())[0] or 0
+                if current == LATEST_VERSION:
+                    logger.info(f"Схема базы данных SQLite актуальна (версия {current}).")
+                    return current
+                # Для SQLite нет пошаговых миграций: старую базу проще пересоздать (это тестовая или небольшая установка)
+                logger.critical(f"Схема базы SQLite устарела (версия {current}, нужна {LATEST_VERSION}), пересоздайте файл базы.")
+                raise RuntimeError(f"SQLite schema version {current} is older than {LATEST_VERSION}")
+            await conn.begin()
+            try:
+                for statement in SQLITE_SCHEMA:
+                    await cur.execute(statement)
+                await cur.executemany(
+                    "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                    [(version, description) for version, description, _ in MIGRATIONS]
+                )
+                await conn.commit()
+            except Exception as e:
+                await conn.rollback()
+                logger.critical(f"Ошибка при создании схемы SQLite: {e}")
+                raise
+            logger.info(f"Создана схема базы данных SQLite (версия {LATEST_VERSION}).")
+            return LATEST_VERSION
+
+
+# Применение недостающих миграций. Если схема уже актуальна, выполняется один SELECT и никакого DDL.
+# Параллельные запуски (несколько реплик) сериализуются через GET_LOCK.
+async def apply_migrations(pool):
+    if isinstance(pool, SQLitePool):
+        return await _apply_sqlite_schema(pool)
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            current = await _current_version(cur)
+            if current == LATEST_VERSION:
+                logger.info(f"Схема базы данных актуальна (версия {current}).")
+                return current
+
+            await cur.execute("SELECT GET_LOCK('schema_migrations', 60)")
+            (locked,) = await cur.fetchone()
+            if locked != 1:
+                # 0 - другая реплика держит блокировку дольше 60 секунд, NULL - ошибка при ее получении
+                logger.critical(f"Не удалось получить блокировку миграций (GET_LOCK вернул {locked}).")
+                raise RuntimeError(f"Could not acquire the schema_migrations lock (GET_LOCK returned {locked})")
+            try:
+                current = await _current_version(cur)
+                if current is None:
+                    await cur.execute(
+                        """
+                        CREATE TABLE IF NOT EXISTS schema_migrations (
+                            version INT PRIMARY KEY,
+                            description VARCHAR(255),
+                            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                        )
+                        """
+                    )
+                    current = 0
+                for version, description, statements in MIGRATIONS:
+                    if version <= current:
+                        continue
+                    for statement in statements:
+                        statement, tolerated = statement if isinstance(statement, tuple) else (statement, ())
+                        try:
+                            await cur.execute(statement)
+                        except aiomysql.Error as e:
+                            if e.args[0] not in ALREADY_APPLIED_ERRORS + tolerated:
+                                logger.critical(f"Ошибка миграции {version} ({description}): {e}")
+                                raise
+                            logger.info(f"Миграция {version}: изменение уже применено ({e.args[1]}).")
+                    await cur.execute(
+                        "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                        (version, description)
+                    )
+                    logger.info(f"Применена миграция {version}: {description}.")
+                    current = version
+            finally:
+                await cur.execute("SELECT RELEASE_LOCK('schema_migrations')")
+            return current
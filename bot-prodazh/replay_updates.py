@@ -0,0 +1,51 @@
+# replay_updates.py
+#
+# Отправка записанных апдейтов Telegram на локально запущенный вебхук (RUN_MODE=webhook):
+#   python replay_updates.py updates.jsonl --secret $WEBHOOK_SECRET
+# Файл - по одному JSON-апдейту в строке или JSON-массив апдейтов.
+
+import argparse
+import asyncio
+import json
+import time
+
+import aiohttp
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def load_updates(path):
+    with open(path, encoding='utf-8') as f:
+        content = f.read().strip()
+    if content.startswith('['):
+        return json.loads(content)
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+async def replay(updates, url, secret, delay):
+    headers = {SECRET_HEADER: secret} if secret else {}
+    timings = []
+    async with aiohttp.ClientSession() as session:
+        for update in updates:
+            started = time.perf_counter()
+            async with session.post(url, json=update, headers=headers) as response:
+                await response.read()
+                elapsed = (time.perf_counter() - started) * 1000
+                timings.append(elapsed)
+                print(f"update_id={update.get('update_id')}: HTTP {response.status}, {elapsed:.1f} мс")
+            if delay:
+                await asyncio.sleep(delay)
+    if timings:
+        timings.sort()
+        print(f"Отправлено {len(timings)} апдейтов, ответ p50 {timings[len(timings) // 2]:.1f} мс, "
+              f"max {timings[-1]:.1f} мс")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Отправка записанных апдейтов на вебхук бота")
+    parser.add_argument('file', help="файл с апдейтами (JSON Lines или JSON-массив)")
+    parser.add_argument('--url', default='http://127.0.0.1:8080/webhook', help="адрес вебхука")
+    parser.add_argument('--secret', default='', help="значение WEBHOOK_SECRET")
+    parser.add_argument('--delay', type=float, default=0.0, help="пауза между апдейтами, с")
+    args = parser.parse_args()
+    asyncio.run(replay(load_updates(args.file), args.url, args.secret, args.delay))
@@ -1,3 +1,6 @@
+-- Итоговая схема базы данных для справки.
+-- При запуске бот сам применяет недостающие версии из migrations.py (таблица schema_migrations).
+
 -- Таблица пользователей
 CREATE TABLE IF NOT EXISTS users (
     user_id BIGINT PRIMARY KEY,
@@ -7,7 +10,11 @@ CREATE TABLE IF NOT EXISTS users (
     phone VARCHAR(50),
     city VARCHAR(100),
     last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-    cheque_file_id VARCHAR(255)
+    cheque_file_id VARCHAR(255),
+    -- Отметка последнего просмотренного объявления для уведомлений о новых объявлениях
+    last_seen_ad_id INT NOT NULL DEFAULT 0,
+    INDEX idx_users_status_last_active (status, last_active),
+    INDEX idx_users_last_active (last_active)
 );
 
 -- Таблица объявлений
@@ -18,10 +25,20 @@ CREATE TABLE IF NOT EXISTS ads (
     year INT,
     price INT,
     description TEXT,
-    photos JSON,
-    inspection_photos JSON,
-    thickness_photos JSON,
-    added_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    added_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    -- Индекс для keyset-пагинации каталога (ORDER BY added_date DESC, ad_id DESC)
+    INDEX idx_ads_added_date (added_date, ad_id)
+);
+
+-- Фотографии объявлений: kind - обычные фото, акт осмотра или толщиномер, position - порядок в наборе.
+-- Обложка объявления - фото с kind='photo' и position=0
+CREATE TABLE IF NOT EXISTS ad_photos (
+    ad_id INT NOT NULL,
+    kind ENUM('photo', 'inspection', 'thickness') NOT NULL,
+    position SMALLINT NOT NULL,
+    file_id VARCHAR(255) NOT NULL,
+    PRIMARY KEY (ad_id, kind, position),
+    FOREIGN KEY (ad_id) REFERENCES ads(ad_id) ON DELETE CASCADE
 );
 
 -- Таблица избранных объявлений
@@ -42,6 +59,7 @@ CREATE TABLE IF NOT EXISTS subscriptions (
     price_max INT,
     year_min INT,
     year_max INT,
+    INDEX idx_subscriptions_user_id (user_id),
     FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
 );
 
@@ -49,4 +67,46 @@ CREATE TABLE IF NOT EXISTS subscriptions (
 CREATE TABLE IF NOT EXISTS bot_settings (
     `key` VARCHAR(50) PRIMARY KEY,
     `value` VARCHAR(50)
-);
\ No newline at end of file
+);
+
+-- Таблица заданий рассылки
+CREATE TABLE IF NOT EXISTS broadcast_jobs (
+    job_id INT AUTO_INCREMENT PRIMARY KEY,
+    text TEXT NOT NULL,
+    status ENUM('running', 'finished') DEFAULT 'running',
+    created_by BIGINT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP NULL
+);
+
+-- Таблица получателей рассылки и состояния доставки
+-- pending - ожидает, sending - взят в отправку, sent/failed - результат,
+-- unknown - отправка прервана перезапуском, повторно не отправляется
+CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+    job_id INT,
+    user_id BIGINT,
+    status ENUM('pending', 'sending', 'sent', 'failed', 'unknown') DEFAULT 'pending',
+    error VARCHAR(255),
+    PRIMARY KEY (job_id, user_id),
+    INDEX idx_broadcast_deliveries_status (job_id, status),
+    FOREIGN KEY (job_id) REFERENCES broadcast_jobs(job_id) ON DELETE CASCADE
+);
+
+-- Состояния FSM пользователей (см. fsm_storage.py)
+CREATE TABLE IF NOT EXISTS fsm_sessions (
+    chat_id BIGINT NOT NULL,
+    user_id BIGINT NOT NULL,
+    state VARCHAR(255),
+    data JSON,
+    bucket JSON,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (chat_id, user_id),
+    INDEX idx_fsm_sessions_updated_at (updated_at)
+);
+
+-- Таблица примененных миграций (см. migrations.py)
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INT PRIMARY KEY,
+    description VARCHAR(255),
+    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
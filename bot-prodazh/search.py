@@ -0,0 +1,407 @@
+# search.py
+
+import bisect
+import heapq
+import math
+import re
+import time
+
+# Порядок результатов поиска: ключ запроса -> (индекс, по убыванию)
+SORTS = {
+    'новые': ('date', True),
+    'дешевые': ('price', False),
+    'дорогие': ('price', True),
+    'год': ('year', True),
+}
+DEFAULT_SORT = 'новые'
+
+_TOKEN_RE = re.compile(r"\w+")
+_RANGE_RE = re.compile(r"^(\d*)-(\d*)$")
+_YEAR_RE = re.compile(r"^(19|20)\d\d$")
+
+
+def tokenize(text):
+    return _TOKEN_RE.findall(text.lower().replace('ё', 'е')) if text else []
+
+
+def _bounds(value):
+    # '2015-2020', '-2020', '2015-', '<2020', '>2015', '2018'
+    if value.startswith('<'):
+        return None, int(value[1:])
+    if value.startswith('>'):
+        return int(value[1:]), None
+    match = _RANGE_RE.match(value)
+    if match:
+        low, high = match.groups()
+        return int(low) if low else None, int(high) if high else None
+    number = int(value)
+    return number, number
+
+
+# Разобранный поисковый запрос.
+# Синтаксис: слова ищутся в названии, модели и описании (по началу слова, все слова обязательны),
+# "цена:5000000-10000000", "цена:<8000000", "год:2015-2020", "год:>2018", "сорт:новые|дешевые|дорогие|год".
+# Отдельный год или диапазон лет ("2018", "2015-2020") понимается без префикса.
+class SearchQuery:
+    __slots__ = ('terms', 'price_min', 'price_max', 'year_min', 'year_max', 'sort')
+
+    def __init__(self, terms=(), price_min=None, price_max=None, year_min=None, year_max=None, sort=DEFAULT_SORT):
+        self.terms = list(terms)
+        self.price_min = price_min
+        self.price_max = price_max
+        self.year_min = year_min
+        self.year_max = year_max
+        self.sort = sort
+
+    @classmethod
+    def parse(cls, text):
+        query = cls()
+        for word in text.split():
+            key, _, value = word.lower().partition(':')
+            try:
+                if value and key == 'цена':
+                    query.price_min, query.price_max = _bounds(value)
+                    continue
+                if value and key == 'год':
+                    query.year_min, query.year_max = _bounds(value)
+                    continue
+            except ValueError:
+                raise ValueError(f"bad range in {word!r}")
+            if value and key == 'сорт':
+                if value not in SORTS:
+                    raise ValueError(f"unknown sort {value!r}")
+                query.sort = value
+                continue
+            low, _, high = word.partition('-')
+            if _YEAR_RE.match(low) and (not high or _YEAR_RE.match(high)):
+                query.year_min, query.year_max = int(low), int(high or low)
+                continue
+            query.terms.extend(tokenize(word))
+        return query
+
+    def is_empty(self):
+        return not self.terms and self.price_min is None and self.price_max is None \
+            and self.year_min is None and self.year_max is None
+
+
+# Отсортированный массив пар (значение, ad_id) с выборкой диапазона через bisect
+class _SortedColumn:
+    __slots__ = ('items',)
+
+    def __init__(self, items=()):
+        self.items = sorted(items)
+
+    def add(self, value, ad_id):
+        bisect.insort(self.items, (value, ad_id))
+
+    def remove(self, value, ad_id):
+        position = bisect.bisect_left(self.items, (value, ad_id))
+        if position < len(self.items) and self.items[position] == (value, ad_id):
+            del self.items[position]
+
+    def _bounds(self, low, high):
+        start = 0 if low is None else bisect.bisect_left(self.items, (low, -1))
+        end = len(self.items) if high is None else bisect.bisect_right(self.items, (high, float('inf')))
+        return start, end
+
+    def range(self, low, high):
+        start, end = self._bounds(low, high)
+        return self.items[start:end]
+
+    def count(self, low, high):
+        start, end = self._bounds(low, high)
+        return max(end - start, 0)
+
+
+# Поисковый индекс каталога: инвертированный индекс слов названия, модели и описания
+# (с отсортированным словарем для поиска по началу слова) и отсортированные массивы цены, года
+# и даты добавления для диапазонов и порядка выдачи. Поддерживается add_ad/delete_ad через add/remove,
+# целиком перестраивается при перезагрузке кэша каталога (generation - поколение кэша).
+# search считает точное число найденных: все пересечения и фильтры идут по множествам ad_id, страница
+# выбирается heapq по позиции объявления в отсортированном массиве (позиции пересчитываются лениво).
+# page число не считает и работает ограниченно: см. комментарий к нему.
+class CatalogIndex:
+    def __init__(self, ads=(), generation=None):
+        self.generation = generation
+        self._ads = {}
+        self._postings = {}
+        self._vocabulary = []
+        self._columns = {'date': _SortedColumn(), 'price': _SortedColumn(), 'year': _SortedColumn()}
+        self._values = {'price': {}, 'year': {}}
+        self._ranks = {}
+        ads = list(ads)
+        for ad in ads:
+            self._ads[ad.ad_id] = ad
+            for token in self._tokens(ad):
+                self._postings.setdefault(token, set()).add(ad.ad_id)
+            for name, values in self._values.items():
+                values[ad.ad_id] = self._value(ad, name)
+        self._vocabulary = sorted(self._postings)
+        for name, column in self._columns.items():
+            column.items = sorted((self._value(ad, name), ad.ad_id) for ad in ads)
+
+    def __len__(self):
+        return len(self._ads)
+
+    @staticmethod
+    def _tokens(ad):
+        return set(tokenize(ad.title)) | set(tokenize(ad.model)) | set(tokenize(ad.description))
+
+    @staticmethod
+    def _value(ad, name):
+        if name == 'date':
+            return ad.added_date
+        value = ad.price if name == 'price' else ad.year
+        return value if value is not None else 0
+
+    def add(self, ad):
+        if ad.ad_id in self._ads:
+            self.remove(ad.ad_id)
+        self._ads[ad.ad_id] = ad
+        for token in self._tokens(ad):
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = set()
+                bisect.insort(self._vocabulary, token)
+            postings.add(ad.ad_id)
+        for name, column in self._columns.items():
+            column.add(self._value(ad, name), ad.ad_id)
+        for name, values in self._values.items():
+            values[ad.ad_id] = self._value(ad, name)
+        self._ranks = {}
+
+    def remove(self, ad_id):
+        ad = self._ads.pop(ad_id, None)
+        if ad is None:
+            return
+        for token in self._tokens(ad):
+            postings = self._postings[token]
+            postings.discard(ad_id)
+            if not postings:
+                del self._postings[token]
+                del self._vocabulary[bisect.bisect_left(self._vocabulary, token)]
+        for name, column in self._columns.items():
+            column.remove(self._value(ad, name), ad_id)
+        for values in self._values.values():
+            del values[ad_id]
+        self._ranks = {}
+
+    # Позиции объявлений в отсортированном массиве name
+    def _rank(self, name):
+        rank = self._ranks.get(name)
+        if rank is None:
+            rank = self._ranks[name] = {ad_id: position for position, (_, ad_id) in enumerate(self._columns[name].items)}
+        return rank
+
+    # Списки объявлений всех слов словаря, начинающихся с term
+    def _prefix_sets(self, term):
+        position = bisect.bisect_left(self._vocabulary, term)
+        postings = []
+        while position < len(self._vocabulary) and self._vocabulary[position].startswith(term):
+            postings.append(self._postings[self._vocabulary[position]])
+            position += 1
+        return postings
+
+    # Объявления, в которых есть слово, начинающееся с term
+    def _prefix_ids(self, term):
+        postings = self._prefix_sets(term)
+        if len(postings) == 1:
+            return postings[0]
+        return set().union(*postings)
+
+    # Множество подходящих ad_id или None, если запрос ничем не ограничивает каталог.
+    # Множества пересекаются от меньшего к большему; диапазон проверяется по значениям кандидатов,
+    # если их меньше, чем объявлений в диапазоне.
+    def _candidates(self, query):
+        return self._in_ranges(self._term_candidates(query), self._ranges(query))
+
+    def _term_candidates(self, query):
+        sets = sorted((self._prefix_ids(term) for term in set(query.terms)), key=len)
+        return sets[0].intersection(*sets[1:]) if sets else None
+
+    # Заданные в запросе диапазоны: (name, low, high), границы без значения - бесконечности
+    @staticmethod
+    def _ranges(query):
+        return [
+            (name, -math.inf if low is None else low, math.inf if high is None else high)
+            for name, low, high in (('price', query.price_min, query.price_max), ('year', query.year_min, query.year_max))
+            if low is not None or high is not None
+        ]
+
+    def _in_ranges(self, candidates, ranges):
+        for name, low, high in ranges:
+            if candidates is None:
+                candidates = {ad_id for _, ad_id in self._columns[name].range(low, high)}
+                continue
+            if not candidates:
+                break
+            if len(candidates) <= self._columns[name].count(low, high):
+                values = self._values[name]
+                candidates = {ad_id for ad_id in candidates if low <= values[ad_id] <= high}
+            else:
+                candidates = candidates.intersection([ad_id for _, ad_id in self._columns[name].range(low, high)])
+        return candidates
+
+    # Поиск: (всего найдено, объявления страницы [offset, offset + limit)) в порядке query.sort
+    def search(self, query, offset=0, limit=10):
+        name, descending = SORTS[query.sort]
+        column = self._columns[name].items
+        order = range(len(column) - 1, -1, -1) if descending else range(len(column))
+        candidates = self._candidates(query)
+        if candidates is None:
+            return len(column), [self._ads[column[position][1]] for position in order[offset:offset + limit]]
+        total = len(candidates)
+        ad_ids = self._walk(column, order, candidates, offset, limit) if total else []
+        if ad_ids is None:
+            ad_ids = self._select(name, descending, candidates, offset + limit)[offset:]
+        return total, [self._ads[ad_id] for ad_id in ad_ids]
+
+    # Страница без подсчета: (объявления [offset, offset + limit), есть ли следующие).
+    # Кандидаты не собираются целиком, если страница набирается раньше: по размерам списков слов
+    # и диапазонов оценивается доля подходящих объявлений, и если offset + limit + 1 результатов
+    # ожидается за меньшее число шагов, чем объявлений в самом узком условии, отсортированный массив
+    # обходится по порядку выдачи с проверкой каждого объявления по спискам и значениям. Обход
+    # не длиннее самого узкого условия; не набралась страница - выбор из кандидатов, как в search.
+    def page(self, query, offset=0, limit=10):
+        name, descending = SORTS[query.sort]
+        column = self._columns[name].items
+        order = range(len(column) - 1, -1, -1) if descending else range(len(column))
+        needed = offset + limit + 1
+        sets = sorted((self._prefix_ids(term) for term in set(query.terms)), key=len)
+        ranges = self._ranges(query)
+        sizes = [len(ad_ids) for ad_ids in sets] + [self._columns[key].count(low, high) for key, low, high in ranges]
+        found = None
+        if not sizes:
+            found = [column[position][1] for position in order[:needed]]
+        elif min(sizes):
+            expected = len(column)
+            for size in sizes:
+                expected = expected * size / len(column)
+            if needed * len(column) < expected * min(sizes):
+                found = self._filter_walk(column, order, sets, ranges, needed, min(sizes))
+        if found is None:
+            candidates = self._candidates(query)
+            found = self._select(name, descending, candidates, needed) if candidates else []
+        ad_ids = found[offset:]
+        return [self._ads[ad_id] for ad_id in ad_ids[:limit]], len(ad_ids) > limit
+
+    # Первые needed объявлений в порядке order, которые есть во всех множествах sets и подходят
+    # под диапазоны ranges, или None, если за budget шагов они не нашлись
+    def _filter_walk(self, column, order, sets, ranges, needed, budget):
+        checks = [(self._values[name], low, high) for name, low, high in ranges]
+        found = []
+        for position in order[:budget]:
+            ad_id = column[position][1]
+            for ad_ids in sets:
+                if ad_id not in ad_ids:
+                    break
+            else:
+                for values, low, high in checks:
+                    if not low <= values[ad_id] <= high:
+                        break
+                else:
+                    found.append(ad_id)
+                    if len(found) >= needed:
+                        return found
+        return found if budget >= len(column) else None
+
+    def _select(self, name, descending, candidates, count):
+        select = heapq.nlargest if descending else heapq.nsmallest
+        return select(count, candidates, key=self._rank(name).__getitem__)
+
+    # Страница обходом отсортированного массива: выгодно, когда кандидатов много и нужная страница
+    # набирается за несколько шагов. Обход ограничен числом кандидатов; None - не набралась, нужен heapq.
+    def _walk(self, column, order, candidates, offset, limit):
+        needed = min(offset + limit, len(candidates))
+        if needed * len(column) >= len(candidates) ** 2:
+            return None
+        found = []
+        for step, position in enumerate(order):
+            if step >= len(candidates):
+                return None
+            ad_id = column[position][1]
+            if ad_id in candidates:
+                found.append(ad_id)
+                if len(found) >= needed:
+                    return found[offset:]
+        return found[offset:]
+
+
+# Прямой перебор каталога, оставлен для сравнения в бенчмарке
+def _linear_search(ads, query):
+    name, descending = SORTS[query.sort]
+    found = []
+    for ad in ads:
+        tokens = CatalogIndex._tokens(ad)
+        if not all(any(token.startswith(term) for token in tokens) for term in query.terms):
+            continue
+        price = ad.price or 0
+        year = ad.year or 0
+        if query.price_min is not None and price < query.price_min or query.price_max is not None and price > query.price_max:
+            continue
+        if query.year_min is not None and year < query.year_min or query.year_max is not None and year > query.year_max:
+            continue
+        found.append(ad)
+    found.sort(key=lambda ad: (CatalogIndex._value(ad, name), ad.ad_id), reverse=descending)
+    return found
+
+
+# Бенчмарк: python search.py [количество объявлений]
+if __name__ == '__main__':
+    import random
+    import sys
+    from datetime import datetime, timedelta
+
+    from ad_record import Ad
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    brands = ['Toyota', 'Hyundai', 'Kia', 'Lexus', 'BMW', 'Mercedes', 'Volkswagen', 'Skoda', 'Chevrolet', 'Nissan']
+    names = ['Camry', 'Corolla', 'Land Cruiser', 'RAV4', 'Sonata', 'Elantra', 'Tucson', 'X5', 'E-Class', 'Octavia',
+             'Polo', 'Rio', 'Sportage', 'Accent', 'Highlander', 'Prado', 'RX', 'Malibu', 'Cobalt', 'Nexia']
+    words = ['один', 'владелец', 'не', 'битый', 'не', 'крашеный', 'полный', 'привод', 'автомат', 'механика',
+             'кожаный', 'салон', 'обслужен', 'у', 'дилера', 'зимняя', 'резина', 'в', 'подарок', 'торг']
+    rng = random.Random(42)
+    start = datetime(2024, 1, 1)
+    ads = []
+    for ad_id in range(1, count + 1):
+        model = f"{rng.choice(brands)} {rng.choice(names)}"
+        ads.append(Ad(
+            ad_id, f"{model} {rng.randint(2005, 2024)}", model, rng.randint(2005, 2024),
+            rng.randrange(2_000_000, 40_000_000, 10_000), ' '.join(rng.choices(words, k=12)),
+            start + timedelta(minutes=ad_id), f"photo-{ad_id}",
+        ))
+    queries = [SearchQuery.parse(text) for text in (
+        'camry', 'toyota camry 2018', 'land cruiser цена:<20000000 сорт:дешевые', 'полный привод год:2015-2020',
+        'цена:5000000-8000000', 'сорт:дорогие', 'bmw x5 кожаный', 'ki', 'год:>2020 сорт:год', 'nexia автомат торг',
+    )]
+
+    started = time.perf_counter()
+    index = CatalogIndex(ads)
+    build_time = time.perf_counter() - started
+
+    rounds = 20
+    started = time.perf_counter()
+    for _ in range(rounds):
+        actual = [index.search(query, 0, 10) for query in queries]
+    index_time = (time.perf_counter() - started) / (rounds * len(queries))
+
+    started = time.perf_counter()
+    expected = [_linear_search(ads, query) for query in queries]
+    linear_time = (time.perf_counter() - started) / len(queries)
+
+    pages = [(query, offset) for query in queries for offset in (0, 10, 100)]
+    started = time.perf_counter()
+    for _ in range(rounds):
+        paged = [index.page(query, offset, 10) for query, offset in pages]
+    page_time = (time.perf_counter() - started) / (rounds * len(pages))
+
+    for (total, page), found in zip(actual, expected):
+        assert total == len(found) and [ad.ad_id for ad in page] == [ad.ad_id for ad in found[:10]], \
+            "Результаты индекса не совпадают с перебором"
+    for ((query, offset), (page, has_more)), found in zip(zip(pages, paged), [found for found in expected for _ in range(3)]):
+        assert [ad.ad_id for ad in page] == [ad.ad_id for ad in found[offset:offset + 10]] \
+            and has_more == (offset + 10 < len(found)), "Страница индекса не совпадает с перебором"
+    print(f"Объявлений: {count}, построение индекса: {build_time * 1000:.0f} мс")
+    print(f"Перебор: {linear_time * 1000:.2f} мс на запрос")
+    print(f"Индекс, с подсчетом: {index_time * 1000:.3f} мс на запрос ({linear_time / index_time:.0f}x)")
+    print(f"Индекс, страница без подсчета: {page_time * 1000:.3f} мс на запрос ({linear_time / page_time:.0f}x)")
@@ -0,0 +1,66 @@
+# sql_dialects.py
+
+# Различия SQL между MySQL и SQLite, которые встречаются в запросах database.py.
+# Плейсхолдеры везде %s: курсор SQLite (sqlite_pool.py) сам переводит их в ?.
+
+
+class MySQLDialect:
+    name = 'mysql'
+
+    def now(self):
+        return "NOW()"
+
+    # Момент amount единиц назад; amount - число или плейсхолдер %s
+    def ago(self, amount, unit):
+        return f"NOW() - INTERVAL {amount} {unit}"
+
+    def greatest(self, *args):
+        return f"GREATEST({', '.join(args)})"
+
+    # INSERT с обновлением при совпадении ключа keys.
+    # update - колонки, которые берутся из вставляемой строки, или пары (колонка, выражение);
+    # пустой update - существующая строка остается как есть.
+    def upsert(self, table, columns, keys, update):
+        if update:
+            assignments = ", ".join(self._assignment(item) for item in update)
+        else:
+            assignments = f"{keys[0]}={keys[0]}"
+        return f"{self._insert(table, columns)} ON DUPLICATE KEY UPDATE {assignments}"
+
+    def _assignment(self, item):
+        if isinstance(item, tuple):
+            return f"{item[0]}={item[1]}"
+        return f"{item}=VALUES({item})"
+
+    def _insert(self, table, columns):
+        return f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})"
+
+
+# Время в SQLite хранится текстом 'YYYY-MM-DD HH:MM:SS' в локальном часовом поясе, как NOW() у MySQL
+class SQLiteDialect(MySQLDialect):
+    name = 'sqlite'
+
+    def now(self):
+        return "datetime('now', 'localtime')"
+
+    def ago(self, amount, unit):
+        return f"datetime('now', 'localtime', '-' || {amount} || ' {unit.lower()}s')"
+
+    def greatest(self, *args):
+        return f"MAX({', '.join(args)})"
+
+    def upsert(self, table, columns, keys, update):
+        target = f"ON CONFLICT ({', '.join(keys)})"
+        if not update:
+            return f"{self._insert(table, columns)} {target} DO NOTHING"
+        assignments = ", ".join(self._assignment(item) for item in update)
+        return f"{self._insert(table, columns)} {target} DO UPDATE SET {assignments}"
+
+    def _assignment(self, item):
+        if isinstance(item, tuple):
+            return f"{item[0]}={item[1]}"
+        return f"{item}=excluded.{item}"
+
+
+MYSQL = MySQLDialect()
+SQLITE = SQLiteDialect()
@@ -0,0 +1,243 @@
+# sqlite_pool.py
+
+import asyncio
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from aiomysql import DictCursor, SSCursor, SSDictCursor
+
+logger = logging.getLogger(__name__)
+
+# Время хранится текстом 'YYYY-MM-DD HH:MM:SS', колонки TIMESTAMP читаются обратно в datetime
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+sqlite3.register_converter('TIMESTAMP', lambda value: datetime.fromisoformat(value.decode()))
+
+
+# Соединение SQLite со своим потоком: все вызовы sqlite3 выполняются в нем, цикл событий не блокируется.
+# Повторяет ту часть интерфейса соединения aiomysql, которой пользуется database.py.
+class SQLiteConnection:
+    def __init__(self, path, busy_timeout):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+        self._conn = None
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _open(self):
+        # isolation_level=None - автокоммит, как autocommit=True у пула aiomysql; транзакции через begin()
+        conn = sqlite3.connect(
+            self.path, timeout=self.busy_timeout, isolation_level=None, detect_types=sqlite3.PARSE_DECLTYPES
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        self._conn = conn
+
+    async def open(self):
+        await self.run(self._open)
+
+    def cursor(self, cursor_class=None):
+        return SQLiteCursor(self, cursor_class)
+
+    async def begin(self):
+        await self.run(self._conn.execute, "BEGIN")
+
+    async def commit(self):
+        await self.run(self._conn.execute, "COMMIT")
+
+    def _rollback(self):
+        if self._conn.in_transaction:
+            self._conn.execute("ROLLBACK")
+
+    async def rollback(self):
+        await self.run(self._rollback)
+
+    async def close(self):
+        await self.run(self._conn.close)
+        self._executor.shutdown(wait=False)
+
+
+# Курсор поверх sqlite3: плейсхолдеры %s переводятся в ?, DictCursor отдает строки словарями.
+# Обычный курсор читает результат целиком при execute (rowcount - число строк, как у aiomysql),
+# SSCursor отдает строки по мере fetchmany.
+class SQLiteCursor:
+    def __init__(self, connection, cursor_class=None):
+        self._connection = connection
+        self._as_dict = cursor_class is not None and issubclass(cursor_class, (DictCursor, SSDictCursor))
+        self._stream = cursor_class is not None and issubclass(cursor_class, SSCursor)
+        self._cursor = None
+        self._rows = []
+        self._columns = None
+        self.rowcount = -1
+        self.lastrowid = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _execute(self, method, query, args):
+        self._close_cursor()
+        cursor = self._connection._conn.cursor()
+        getattr(cursor, method)(query.replace('%s', '?'), args)
+        self.lastrowid = cursor.lastrowid
+        self._rows = []
+        if cursor.description is None:
+            self._columns = None
+            self.rowcount = cursor.rowcount
+            cursor.close()
+            return
+        self._columns = [column[0] for column in cursor.description]
+        if self._stream:
+            self._cursor = cursor
+            self.rowcount = -1
+        else:
+            self._rows = cursor.fetchall()
+            self.rowcount = len(self._rows)
+            cursor.close()
+
+    async def execute(self, query, args=None):
+        await self._connection.run(self._execute, 'execute', query, args if args is not None else ())
+        return self.rowcount
+
+    async def executemany(self, query, args):
+        await self._connection.run(self._execute, 'executemany', query, args)
+        return self.rowcount
+
+    def _convert(self, rows):
+        if self._as_dict:
+            return [dict(zip(self._columns, row)) for row in rows]
+        return rows
+
+    def _take(self, size):
+        if self._cursor is not None:
+            return self._cursor.fetchmany(size) if size is not None else self._cursor.fetchall()
+        rows = self._rows if size is None else self._rows[:size]
+        self._rows = [] if size is None else self._rows[size:]
+        return rows
+
+    async def fetchone(self):
+        rows = await self.fetchmany(1)
+        return rows[0] if rows else None
+
+    async def fetchmany(self, size=None):
+        if self._cursor is not None:
+            rows = await self._connection.run(self._take, size or 1)
+        else:
+            rows = self._take(size or 1)
+        return self._convert(rows)
+
+    async def fetchall(self):
+        if self._cursor is not None:
+            rows = await self._connection.run(self._take, None)
+        else:
+            rows = self._take(None)
+        return self._convert(rows)
+
+    def _close_cursor(self):
+        if self._cursor is not None:
+            self._cursor.close()
+            self._cursor = None
+
+    async def close(self):
+        if self._cursor is not None:
+            await self._connection.run(self._close_cursor)
+
+
+# Пул соединений SQLite с интерфейсом пула aiomysql (acquire/size/freesize/maxsize/close/wait_closed).
+# В режиме WAL читатели не блокируют друг друга и писателя; одновременные записи ждут друг друга
+# до busy_timeout секунд. Незавершенная транзакция откатывается при возврате соединения в пул.
+class SQLitePool:
+    def __init__(self, path, maxsize=10, busy_timeout=5.0):
+        self.path = path
+        self.maxsize = maxsize
+        self.busy_timeout = busy_timeout
+        self._free = []
+        self._used = set()
+        self._creating = 0
+        self._closing = False
+        self._condition = asyncio.Condition()
+
+    @property
+    def size(self):
+        return len(self._free) + len(self._used) + self._creating
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    async def _acquire(self):
+        async with self._condition:
+            while True:
+                if self._closing:
+                    raise RuntimeError("SQLite pool is closed")
+                if self._free:
+                    conn = self._free.pop()
+                    self._used.add(conn)
+                    return conn
+                if self.size < self.maxsize:
+                    break
+                await self._condition.wait()
+            self._creating += 1
+        conn = SQLiteConnection(self.path, self.busy_timeout)
+        opened = False
+        try:
+            await conn.open()
+            opened = True
+        finally:
+            async with self._condition:
+                self._creating -= 1
+                if opened:
+                    self._used.add(conn)
+                self._condition.notify()
+        return conn
+
+    # Отмена задачи, возвращающей соединение (например, замененного inline-запроса), не должна
+    # прерывать возврат: иначе соединение останется занятым навсегда и wait_closed не завершится.
+    # Откат выполняется в потоке соединения раньше любого следующего вызова, поэтому вернуть его безопасно.
+    async def _release(self, conn):
+        await asyncio.shield(self._return(conn))
+
+    async def _return(self, conn):
+        try:
+            await conn.rollback()
+        except sqlite3.Error as e:
+            logger.error(f"Не удалось откатить транзакцию SQLite при возврате соединения: {e}")
+        async with self._condition:
+            self._used.discard(conn)
+            self._free.append(conn)
+            self._condition.notify_all()
+
+    @asynccontextmanager
+    async def acquire(self):
+        conn = await self._acquire()
+        try:
+            yield conn
+        finally:
+            await self._release(conn)
+
+    def close(self):
+        self._closing = True
+
+    async def wait_closed(self):
+        async with self._condition:
+            self._condition.notify_all()
+            while self._used or self._creating:
+                await self._condition.wait()
+            free, self._free = self._free, []
+        for conn in free:
+            await conn.close()
+
+
+async def create_sqlite_pool(path, maxsize=10, busy_timeout=5.0):
+    pool = SQLitePool(path, maxsize=maxsize, busy_timeout=busy_timeout)
+    # Первое соединение открывается сразу, чтобы ошибка пути к файлу была видна при запуске
+    async with pool.acquire():
+        pass
+    return pool
@@ -0,0 +1,236 @@
+# subscription_index.py
+
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+NEG_INF = float('-inf')
+POS_INF = float('inf')
+
+
+# Ключ модели - как в прежней проверке "model.lower() in ad['model'].lower()", пробелы не схлопываются
+def normalize_model(model):
+    return model.lower() if model else ''
+
+
+# Статическое центрированное дерево интервалов: stab(x) возвращает ключи всех интервалов,
+# содержащих x, за O(log n + k). Интервалы - кортежи (low, high, key) с low <= high.
+class _IntervalTree:
+    __slots__ = ('center', 'by_low', 'by_high', 'left', 'right')
+
+    def __init__(self, intervals):
+        points = sorted(point for low, high, _ in intervals for point in (low, high) if abs(point) != POS_INF)
+        self.center = points[len(points) // 2] if points else 0
+        left, right, here = [], [], []
+        for interval in intervals:
+            if interval[1] < self.center:
+                left.append(interval)
+            elif interval[0] > self.center:
+                right.append(interval)
+            else:
+                here.append(interval)
+        self.by_low = sorted(here, key=lambda interval: interval[0])
+        self.by_high = sorted(here, key=lambda interval: interval[1], reverse=True)
+        self.left = _IntervalTree(left) if left else None
+        self.right = _IntervalTree(right) if right else None
+
+    def stab(self, x, out):
+        node = self
+        while node is not None:
+            if x < node.center:
+                for low, _, key in node.by_low:
+                    if low > x:
+                        break
+                    out.append(key)
+                node = node.left
+            elif x > node.center:
+                for _, high, key in node.by_high:
+                    if high < x:
+                        break
+                    out.append(key)
+                node = node.right
+            else:
+                out.extend(key for _, _, key in node.by_low)
+                break
+        return out
+
+
+# Группа подписок с одинаковой моделью. Дерево по цене строится лениво после изменений.
+class _Bucket:
+    __slots__ = ('rowids', '_tree')
+
+    def __init__(self):
+        self.rowids = set()
+        self._tree = None
+
+    def stab(self, subscriptions, price):
+        if self._tree is None:
+            intervals = [
+                (_low(subscriptions[rowid]['price_min']), _high(subscriptions[rowid]['price_max']), rowid)
+                for rowid in self.rowids
+            ]
+            # Подписки с минимальной ценой больше максимальной не совпадут ни с одним объявлением
+            self._tree = _IntervalTree([interval for interval in intervals if interval[0] <= interval[1]])
+        return self._tree.stab(price, [])
+
+    def add(self, rowid):
+        self.rowids.add(rowid)
+        self._tree = None
+
+    def discard(self, rowid):
+        self.rowids.discard(rowid)
+        self._tree = None
+
+
+def _low(value):
+    return value if value else NEG_INF
+
+
+def _high(value):
+    return value if value else POS_INF
+
+
+# Индекс подписок для notify_subscribers.
+# Подписки группируются по нормализованной модели (инвертированный индекс), внутри группы
+# кандидаты отбираются деревом интервалов по цене, год проверяется у оставшихся.
+# Семантика совпадает с прежней проверкой: модель подписки - подстрока модели объявления,
+# нулевые/пустые границы цены и года не ограничивают.
+class SubscriptionIndex:
+    def __init__(self, subscriptions=()):
+        self._subscriptions = {}
+        self._buckets = {}
+        self._key_lengths = {}
+        for subscription in subscriptions:
+            self.add(subscription)
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def add(self, subscription):
+        rowid = subscription['rowid']
+        if rowid in self._subscriptions:
+            self.remove(rowid)
+        key = normalize_model(subscription['model'])
+        self._subscriptions[rowid] = subscription
+        self._buckets.setdefault(key, _Bucket()).add(rowid)
+        self._key_lengths[len(key)] = self._key_lengths.get(len(key), 0) + 1
+
+    def remove(self, rowid):
+        subscription = self._subscriptions.pop(rowid, None)
+        if subscription is None:
+            return
+        key = normalize_model(subscription['model'])
+        bucket = self._buckets[key]
+        bucket.discard(rowid)
+        if not bucket.rowids:
+            del self._buckets[key]
+        self._key_lengths[len(key)] -= 1
+        if not self._key_lengths[len(key)]:
+            del self._key_lengths[len(key)]
+
+    # Ключи групп, подходящие модели объявления: все ее подстроки нужной длины плюс пустая модель
+    def _matching_keys(self, ad_model):
+        model = normalize_model(ad_model)
+        keys = set()
+        for length in self._key_lengths:
+            for start in range(len(model) - length + 1):
+                keys.add(model[start:start + length])
+        return keys
+
+    def match(self, ad):
+        price = ad['price'] if ad['price'] is not None else 0
+        year = ad['year'] if ad['year'] is not None else 0
+        matched = []
+        for key in self._matching_keys(ad['model']):
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                continue
+            for rowid in bucket.stab(self._subscriptions, price):
+                subscription = self._subscriptions[rowid]
+                if _low(subscription['year_min']) <= year <= _high(subscription['year_max']):
+                    matched.append(subscription)
+        return matched
+
+
+# Прежняя линейная проверка, оставлена для сравнения в бенчмарке
+def _linear_match(subscriptions, ad):
+    matched = []
+    for sub in subscriptions:
+        model = sub['model']
+        if model and model.lower() not in ad['model'].lower():
+            continue
+        if sub['price_min'] and ad['price'] < sub['price_min']:
+            continue
+        if sub['price_max'] and ad['price'] > sub['price_max']:
+            continue
+        if sub['year_min'] and ad['year'] < sub['year_min']:
+            continue
+        if sub['year_max'] and ad['year'] > sub['year_max']:
+            continue
+        matched.append(sub)
+    return matched
+
+
+# Бенчмарк: python subscription_index.py [количество подписок]
+if __name__ == '__main__':
+    import random
+    import sys
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    brands = ['Toyota', 'Hyundai', 'Kia', 'Lexus', 'BMW', 'Mercedes', 'Volkswagen', 'Skoda', 'Chevrolet', 'Nissan']
+    names = ['Camry', 'Corolla', 'Land Cruiser', 'RAV4', 'Sonata', 'Elantra', 'Tucson', 'X5', 'E-Class', 'Octavia',
+             'Polo', 'Rio', 'Sportage', 'Accent', 'Highlander', 'Prado', 'RX', 'Malibu', 'Cobalt', 'Nexia',
+             'Santa Fe', 'K5', 'Sorento', 'Tiguan', 'Passat', 'Qashqai', 'X-Trail', 'Patrol', 'GX', 'LX']
+    models = [f"{brand} {name}" for brand in brands for name in names]
+    rng = random.Random(42)
+
+    def bound(low, high):
+        return rng.choice([None, 0, rng.randint(low, high)])
+
+    # Среди моделей подписок есть варианты с другим регистром и двойным пробелом ("TOYOTA  CAMRY"):
+    # они совпадают только с такой же записью модели, как и при линейной проверке
+    variants = [model.upper().replace(' ', '  ') for model in models]
+    subscriptions = [
+        {
+            'rowid': rowid,
+            'user_id': rng.randint(1, count // 4),
+            'model': rng.choice([rng.choice(models), rng.choice(names), rng.choice(variants), None]) if rng.random() < 0.1 else rng.choice(models),
+            'price_min': bound(1_000_000, 15_000_000),
+            'price_max': bound(5_000_000, 40_000_000),
+            'year_min': bound(2000, 2020),
+            'year_max': bound(2010, 2025),
+        }
+        for rowid in range(1, count + 1)
+    ]
+    ads = [
+        {
+            'model': rng.choice(models),
+            'price': rng.randint(2_000_000, 30_000_000),
+            'year': rng.randint(2005, 2024),
+        }
+        for _ in range(200)
+    ]
+
+    started = time.perf_counter()
+    index = SubscriptionIndex(subscriptions)
+    build_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    expected = [_linear_match(subscriptions, ad) for ad in ads]
+    linear_time = (time.perf_counter() - started) / len(ads)
+
+    index.match(ads[0])  # первое сопоставление строит деревья интервалов
+    started = time.perf_counter()
+    actual = [index.match(ad) for ad in ads]
+    index_time = (time.perf_counter() - started) / len(ads)
+
+    assert all(
+        sorted(sub['rowid'] for sub in a) == sorted(sub['rowid'] for sub in e)
+        for a, e in zip(actual, expected)
+    ), "Результаты индекса не совпадают с линейной проверкой"
+    matches = sum(len(result) for result in actual) / len(ads)
+    print(f"Подписок: {count}, совпадений на объявление: {matches:.0f}")
+    print(f"Построение индекса: {build_time * 1000:.1f} мс")
+    print(f"Линейная проверка: {linear_time * 1000:.2f} мс на объявление")
+    print(f"Индекс: {index_time * 1000:.2f} мс на объявление ({linear_time / index_time:.1f}x)")
@@ -0,0 +1,104 @@
+# webhook.py
+
+import asyncio
+import hmac
+import logging
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+
+from config import WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBAPP_HOST, WEBAPP_PORT
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+# Прием апдейтов по вебхуку на aiohttp.
+# Запрос проверяется по секрету (заголовок X-Telegram-Bot-Api-Secret-Token), Telegram сразу
+# получает 200, а апдейт обрабатывается в фоновой задаче через dp.process_updates со всеми
+# middleware. Так медленный обработчик не задерживает ответ и не вызывает повторную доставку.
+class WebhookServer:
+    def __init__(self, dp: Dispatcher, path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET,
+                 shutdown_timeout: float = 10.0):
+        self.dp = dp
+        self.path = path
+        self.secret = secret
+        self.shutdown_timeout = shutdown_timeout
+        self.tasks = set()
+
+    async def handle_update(self, request: web.Request):
+        if self.secret and not hmac.compare_digest(
+            request.headers.get(SECRET_HEADER, '').encode(), self.secret.encode()
+        ):
+            logger.warning(f"Запрос к вебхуку с неверным секретом от {request.remote}.")
+            return web.Response(status=401)
+        try:
+            update = types.Update(**await request.json())
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Некорректный апдейт в запросе к вебхуку: {e}")
+            return web.Response(status=400)
+        task = asyncio.create_task(self._process(update))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return web.Response(text='ok')
+
+    async def _process(self, update):
+        Bot.set_current(self.dp.bot)
+        Dispatcher.set_current(self.dp)
+        try:
+            await self.dp.process_updates([update])
+        except Exception as e:
+            logger.error(f"Ошибка при обработке апдейта {update.update_id}: {e}")
+
+    async def handle_health(self, request: web.Request):
+        return web.Response(text='ok')
+
+    # Дождаться обработки уже принятых апдейтов перед остановкой
+    async def drain(self):
+        if not self.tasks:
+            return
+        logger.info(f"Ожидание обработки {len(self.tasks)} апдейтов перед остановкой.")
+        done, pending = await asyncio.wait(set(self.tasks), timeout=self.shutdown_timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(f"Не дождались обработки {len(pending)} апдейтов, они отменены.")
+
+    def make_app(self, on_startup=None, on_shutdown=None, webhook_url: str = WEBHOOK_URL):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get('/', self.handle_health)
+
+        async def startup(app):
+            if on_startup:
+                await on_startup(self.dp)
+            if webhook_url:
+                # drop_pending_updates=False: накопившиеся за время перезапуска апдейты будут доставлены
+                await self.dp.bot.set_webhook(
+                    webhook_url.rstrip('/') + self.path, secret_token=self.secret or None, drop_pending_updates=False
+                )
+                logger.info(f"Вебхук установлен на {webhook_url.rstrip('/') + self.path}.")
+            else:
+                # Локальный запуск: апдейты присылает replay_updates.py
+                logger.info(f"WEBHOOK_URL не задан, вебхук в Telegram не устанавливается, апдейты принимаются на {self.path}.")
+
+        async def shutdown(app):
+            await self.drain()
+            if on_shutdown:
+                await on_shutdown(self.dp)
+            await self.dp.storage.close()
+            await self.dp.storage.wait_closed()
+            session = await self.dp.bot.get_session()
+            await session.close()
+
+        app.on_startup.append(startup)
+        app.on_shutdown.append(shutdown)
+        return app
+
+
+def start_webhook(dp: Dispatcher, on_startup=None, on_shutdown=None, host: str = WEBAPP_HOST, port: int = WEBAPP_PORT):
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET is required in webhook mode")
+    server = WebhookServer(dp)
+    web.run_app(server.make_app(on_startup, on_shutdown), host=host, port=port)